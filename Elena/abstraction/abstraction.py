@@ -1,24 +1,57 @@
-import osmnx as ox
-import networkx as nx
 import os
 import numpy as np
 import pickle as p
 from Elena.abstraction.config import API
+from Elena.abstraction.spatial_index import SpatialIndex
+from Elena.abstraction.routing_graph import RoutingGraph
+from Elena.abstraction import graph_store, landmarks, contraction, build
 
 class Graph_Abstraction:
     def __init__(self):
         print("Initializing the model")        
         self.GOOGLEAPIKEY=API["googleapikey"]        
-        if os.path.exists("./graph.p"):
+        self.index, self.R = None, None
+        self.store_path = None # graph store file, when the routing graph was loaded from or saved to one
+        self.landmarks = None # ALT landmarks from graph.landmarks.npz, when built for this graph
+        self.contraction = None # contraction hierarchy from graph.ch.npz, when built for this graph
+        if os.path.exists("./graph.bin"):
+            # Prebuilt routing graph, mapped read-only and shared with other workers
+            self.G = None
+            self.R = graph_store.load("graph.bin")
+            self.store_path = "graph.bin"
+            self.index = SpatialIndex.from_routing(self.R)
+            self.landmarks = landmarks.load_for(self.R)
+            self.contraction = contraction.load_for(self.R)
+            self.init = True
+            print("Graph store loaded")
+        elif os.path.exists("./graph.p"):
             self.G = p.load( open( "graph.p", "rb" ) )
+            self.build_routing(self.G)
+            self.landmarks = landmarks.load_for(self.R)
+            self.contraction = contraction.load_for(self.R)
             self.init = True
             print("Graph loaded")
         else:
             self.init = False
 
+    @classmethod
+    def from_graph(cls, G):
+        # Abstraction over a graph that is already in memory, e.g. a synthetic one. graph.p and graph.bin are not touched.
+        abstract = cls.__new__(cls)
+        abstract.GOOGLEAPIKEY = API["googleapikey"]
+        abstract.G, abstract.store_path, abstract.landmarks, abstract.contraction, abstract.init = G, None, None, None, True
+        abstract.build_routing(G)
+        return abstract
+
+    def build_routing(self, G):
+        # Precomputes the compact routing graph and the snapping index, once per graph.
+        # The searches run on the simplified graph when SIMPLIFY is enabled; routes come back with every node of G.
+        self.R = build.routing_graph(G)
+        self.index = SpatialIndex.from_routing(self.R)
+
     def elevation_graph(self, G):
-        # Returns networkx graph with eleveation data and rise or fall grade.
-        G = ox.add_node_elevations(G, api_key=self.GOOGLEAPIKEY)        
+        # Returns networkx graph with eleveation data, from the provider configured in ELEVATION.
+        G = build.add_elevations(G, api_key=self.GOOGLEAPIKEY)
         return G
 
     def dist_nodes(self,lat1,long1,lat2,long2):
@@ -36,7 +69,9 @@ class Graph_Abstraction:
 
     def add_dist_frm_endpt(self,G,endpt):
         #Distance from all nodes in the graph to the final destination is added
-        end_node=G.nodes[ox.get_nearest_node(G, point=endpt)]
+        #The routing algorithms no longer read this field, they use a per-query DistanceHeuristic.
+        index = self.index if self.index is not None and G is self.G else SpatialIndex.from_graph(G)
+        end_node=G.nodes[index.nearest(endpt)]
         lat1, long1 =end_node["y"],end_node["x"]        
         for node,data in G.nodes(data=True):
             lat2=G.nodes[node]['y']
@@ -46,18 +81,21 @@ class Graph_Abstraction:
             
         return G
 
-    def get_graph(self, endpt):    
+    def get_graph(self, endpt = None):    
         #Returns elevation data with the graph.
+        #When started from graph.bin the networkx graph is only unpickled here, on demand. Routing only needs self.R.
+        #The graph is shared by all requests, so nothing query specific is written into it.
+        #Without a graph it is built here, which needs osmnx; build it offline with python -m Elena.abstraction.build instead.
    
-        start = [42.384803, -72.529262]
         if not self.init:
             print("Loading the Graph")
-            self.G = ox.graph_from_point(start, distance=20000, network_type='walk')
-            self.G = self.elevation_graph(self.G)                         
-            p.dump( self.G, open( "graph.p", "wb" ) )
+            self.G, self.R = build.build()
+            self.index = SpatialIndex.from_routing(self.R)
+            self.store_path = "graph.bin"
             self.init = True
             print("The Graph has been saved")
-        self.G = self.add_dist_frm_endpt(self.G,endpt)
+        elif self.G is None and os.path.exists("./graph.p"):
+            self.G = p.load( open( "graph.p", "rb" ) )
         return self.G
 
     
@@ -0,0 +1,300 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import argparse
+import pickle as p
+from concurrent.futures import ProcessPoolExecutor
+from Elena.abstraction.config import API, ELEVATION, SIMPLIFY
+from Elena.abstraction.elevation import get_provider, add_node_elevations
+from Elena.abstraction.routing_graph import RoutingGraph
+from Elena.abstraction.simplify import simplify
+from Elena.abstraction import graph_store, landmarks, contraction, regions
+
+# Offline graph building. Everything that needs osmnx, and with it geopandas, shapely and matplotlib, is here and
+# imports it when first called, so the web workers, which only load the prebuilt graph.bin, never do.
+CENTER = (42.384803, -72.529262) # Amherst
+DISTANCE = 20000 # meters around CENTER
+
+# The build runs in stages, each writing its artifacts to a work directory:
+#   extract    walk network from a local OSM extract, or downloaded around a point    extract.p
+#   elevation  node elevations from the ELEVATION provider                            elevation.p
+#   edges      routing graph with the derived edge lengths, gains and drops           routing.bin
+#   indexes    simplified routing graph, ALT landmarks and contraction hierarchy     graph.bin, graph.landmarks.npz, graph.ch.npz
+#   serialize  graph.p, graph.bin and the indexes in the output directory, and tiles  (output files)
+# build.json in the work directory records what every stage was run with. A rerun skips the stages whose inputs are
+# unchanged and whose artifacts are still there, so a failed build resumes from the stage that failed.
+STAGES = ("extract", "elevation", "edges", "indexes", "serialize")
+MANIFEST = "build.json"
+
+
+def download(center = CENTER, distance = DISTANCE):
+    # Walk network around center from OpenStreetMap.
+    import osmnx as ox
+    return ox.graph_from_point(center, distance = distance, network_type = 'walk')
+
+
+def add_elevations(G, api_key = None):
+    # Node elevations from the provider configured in ELEVATION.
+    return add_node_elevations(G, get_provider(ELEVATION, api_key = api_key or API["googleapikey"]))
+
+
+def routing_graph(G):
+    # Routing graph the server loads, simplified when SIMPLIFY is enabled.
+    R = RoutingGraph.from_networkx(G)
+    if SIMPLIFY['enabled']:
+        R = simplify(R, SIMPLIFY['max_length'])
+    return R
+
+
+def reset_peak():
+    # Restarts the peak resident memory count of this process, where Linux allows it.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_memory():
+    # Peak resident memory of this process in MB, since reset_peak when that worked.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# Tasks run in the worker processes. They open the routing graph from its graph store, which the workers share
+# through the page cache, and return (result, seconds, peak memory in MB).
+def landmarks_task(store_path, path, count):
+    start_time = time.time()
+    built = landmarks.Landmarks.build(graph_store.load(store_path), count)
+    built.save(path)
+    return len(built.positions), time.time() - start_time, peak_memory()
+
+
+def contraction_task(store_path, path):
+    start_time = time.time()
+    hierarchy = contraction.ContractionHierarchy.build(graph_store.load(store_path))
+    hierarchy.save(path)
+    return hierarchy.shortcuts, time.time() - start_time, peak_memory()
+
+
+def tile_task(store_path, directory, keys, size, overlap):
+    start_time = time.time()
+    R = graph_store.load(store_path)
+    tiles = {regions.tile_name(key) : regions.build_tile(R, directory, key, size, overlap) for key in keys}
+    return tiles, time.time() - start_time, peak_memory()
+
+
+def replace_copy(src, dst):
+    # Copies src over dst without readers (e.g. a server mapping graph.bin) ever seeing a half written file.
+    shutil.copyfile(src, dst + ".tmp")
+    os.replace(dst + ".tmp", dst)
+
+
+class Pipeline:
+    # The staged build of one graph, and optionally its tiles, from osm (a local extract) or a download around center.
+    # provider overrides the ELEVATION provider; workers is the size of the process pool (None = one per CPU).
+    def __init__(self, work = "build", out = ".", osm = None, center = CENTER, distance = DISTANCE, tiles = None,
+                 tile_size = regions.TILE_SIZE, overlap = 500.0, landmark_count = 16, contraction = True, workers = None,
+                 provider = None, log = True):
+        self.work, self.out, self.osm = work, out, osm
+        self.center, self.distance = tuple(center), distance
+        self.tiles, self.tile_size, self.overlap = tiles, tile_size, overlap
+        self.landmark_count, self.contraction = landmark_count, contraction
+        self.workers = workers or os.cpu_count()
+        self.provider = provider
+        self.log = log
+        os.makedirs(work, exist_ok = True)
+        try:
+            with open(self.path(MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {"stages" : {}}
+
+    def path(self, name):
+        return os.path.join(self.work, name)
+
+    def params(self, stage):
+        # What the artifacts of stage depend on, besides the stages before it.
+        if stage == "extract":
+            if self.osm is None:
+                return {"center" : list(self.center), "distance" : self.distance}
+            stat = os.stat(self.osm)
+            return {"osm" : os.path.abspath(self.osm), "size" : stat.st_size, "mtime" : stat.st_mtime}
+        if stage == "elevation":
+            return {"provider" : type(self.provider).__name__} if self.provider is not None else dict(ELEVATION)
+        if stage == "indexes":
+            return {"simplify" : dict(SIMPLIFY), "landmarks" : self.landmark_count, "contraction" : self.contraction}
+        if stage == "serialize":
+            return {"out" : os.path.abspath(self.out), "tiles" : self.tiles and os.path.abspath(self.tiles),
+                    "tile_size" : self.tile_size, "overlap" : self.overlap}
+        return {}
+
+    def key(self, stage):
+        i = STAGES.index(stage)
+        previous = self.manifest["stages"].get(STAGES[i - 1], {}).get("key") if i else None
+        return hashlib.sha1(json.dumps([stage, self.params(stage), previous], sort_keys = True, default = str).encode("utf-8")).hexdigest()
+
+    def done(self, stage, key):
+        entry = self.manifest["stages"].get(stage)
+        return entry is not None and entry["key"] == key and all(os.path.exists(path) for path in entry["artifacts"])
+
+    def save_manifest(self):
+        tmp = self.path(MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent = 1)
+        os.replace(tmp, self.path(MANIFEST))
+
+    def run(self, start = None):
+        # Runs every stage that is not done yet, and all of them from stage start on. Returns a report per stage.
+        report = []
+        for i, stage in enumerate(STAGES):
+            key = self.key(stage)
+            if (start is None or i < STAGES.index(start)) and self.done(stage, key):
+                report.append(dict(self.manifest["stages"][stage], stage = stage, skipped = True))
+                if self.log:
+                    print("%-10s up to date" % stage)
+                continue
+            reset_peak()
+            start_time = time.time()
+            artifacts, info = getattr(self, stage)()
+            entry = dict(info, key = key, artifacts = artifacts, seconds = time.time() - start_time, peak_mb = peak_memory(), finished = time.time())
+            self.manifest["stages"][stage] = entry
+            self.save_manifest()
+            report.append(dict(entry, stage = stage, skipped = False))
+            if self.log:
+                print("%-10s %8.2f s %8.1f MB peak  %s" % (stage, entry["seconds"], entry["peak_mb"],
+                                                          ", ".join("%s %s" % item for item in sorted(info.items()) if not isinstance(item[1], dict))))
+        return report
+
+    def load(self, name):
+        with open(self.path(name), "rb") as f:
+            return p.load(f)
+
+    def dump(self, G, name):
+        path = self.path(name)
+        with open(path + ".tmp", "wb") as f:
+            p.dump(G, f)
+        os.replace(path + ".tmp", path)
+        return path
+
+    def extract(self):
+        G = regions.read_osm(self.osm) if self.osm is not None else download(self.center, self.distance)
+        return [self.dump(G, "extract.p")], {"nodes" : G.number_of_nodes(), "edges" : G.number_of_edges()}
+
+    def elevation(self):
+        G = self.load("extract.p")
+        G = add_node_elevations(G, self.provider) if self.provider is not None else add_elevations(G)
+        return [self.dump(G, "elevation.p")], {"nodes" : G.number_of_nodes()}
+
+    def edges(self):
+        R = RoutingGraph.from_networkx(self.load("elevation.p"))
+        path = self.path("routing.bin")
+        graph_store.save(R, path, meta = {"source" : os.path.basename(self.osm) if self.osm else "osm", "created" : time.time()})
+        return [path], {"nodes" : len(R), "edges" : len(R.targets)}
+
+    def indexes(self):
+        # Simplifies the routing graph here, then builds the landmarks and the contraction hierarchy of the result side by side.
+        R = graph_store.load(self.path("routing.bin"))
+        if SIMPLIFY['enabled']:
+            R = simplify(R, SIMPLIFY['max_length'])
+        store_path = self.path("graph.bin")
+        graph_store.save(R, store_path, meta = {"source" : os.path.basename(self.osm) if self.osm else "osm", "center" : list(self.center),
+                                                "distance" : self.distance, "created" : time.time()})
+        artifacts, info = [store_path], {"routable" : int(R.routable().sum()), "edges" : len(R.targets), "workers" : {}}
+        tasks = {}
+        with ProcessPoolExecutor(max_workers = min(self.workers, 2)) as executor:
+            if self.landmark_count:
+                tasks["landmarks"] = (self.path(landmarks.LANDMARKS_FILE),
+                                      executor.submit(landmarks_task, store_path, self.path(landmarks.LANDMARKS_FILE), self.landmark_count))
+            if self.contraction:
+                tasks["shortcuts"] = (self.path(contraction.CONTRACTION_FILE),
+                                      executor.submit(contraction_task, store_path, self.path(contraction.CONTRACTION_FILE)))
+            for name, (path, future) in tasks.items():
+                info[name], seconds, peak = future.result()
+                info["workers"][name] = {"seconds" : seconds, "peak_mb" : peak}
+                artifacts.append(path)
+        return artifacts, info
+
+    def serialize(self):
+        # Copies the graph and its indexes to the output directory and cuts the tiles over the process pool.
+        # Indexes this build skipped are removed from the output directory, so the server never loads ones of an earlier build.
+        os.makedirs(self.out, exist_ok = True)
+        artifacts, indexed = [], self.manifest["stages"]["indexes"]["artifacts"]
+        for name, target in (("elevation.p", "graph.p"), ("graph.bin", "graph.bin"),
+                             (landmarks.LANDMARKS_FILE, landmarks.LANDMARKS_FILE), (contraction.CONTRACTION_FILE, contraction.CONTRACTION_FILE)):
+            if name == "elevation.p" or self.path(name) in indexed:
+                replace_copy(self.path(name), os.path.join(self.out, target))
+                artifacts.append(os.path.join(self.out, target))
+            elif os.path.exists(os.path.join(self.out, target)):
+                os.remove(os.path.join(self.out, target))
+        info = {"files" : len(artifacts), "workers" : {}}
+        if self.tiles is not None:
+            os.makedirs(self.tiles, exist_ok = True)
+            store_path = self.path("routing.bin")
+            keys = regions.tile_keys(graph_store.load(store_path), self.tile_size)
+            tiles = {}
+            with ProcessPoolExecutor(max_workers = self.workers) as executor:
+                futures = [executor.submit(tile_task, store_path, self.tiles, keys[i::self.workers], self.tile_size, self.overlap)
+                           for i in range(min(self.workers, len(keys)))]
+                for i, future in enumerate(futures):
+                    done, seconds, peak = future.result()
+                    tiles.update(done)
+                    info["workers"]["tiles %d" % i] = {"seconds" : seconds, "peak_mb" : peak}
+            regions.write_index(self.tiles, tiles, self.tile_size, self.overlap, source = os.path.basename(self.osm) if self.osm else None)
+            artifacts.append(os.path.join(self.tiles, regions.INDEX_FILE))
+            info["tiles"] = len(tiles)
+        return artifacts, info
+
+
+def build(center = CENTER, distance = DISTANCE, work = None, out = "."):
+    # Builds graph.p and graph.bin in out, without the landmarks and the contraction hierarchy, which take minutes
+    # on a large graph. Returns the networkx and the routing graph.
+    # The stage artifacts go to work, or to a temporary directory removed afterwards when it is not given.
+    temporary = work is None
+    if temporary:
+        work = tempfile.mkdtemp(prefix = "elena-build-")
+    try:
+        Pipeline(work, out, center = center, distance = distance, landmark_count = 0, contraction = False).run()
+    finally:
+        if temporary:
+            shutil.rmtree(work, ignore_errors = True)
+    with open(os.path.join(out, "graph.p"), "rb") as f:
+        G = p.load(f)
+    return G, graph_store.load(os.path.join(out, "graph.bin"))
+
+
+if __name__ == "__main__":
+    # python -m Elena.abstraction.build [lat,long] [distance in meters] [--osm extract.osm] [--tiles tiles/] ...
+    parser = argparse.ArgumentParser(description = "Staged Elena graph build, resumed from the last finished stage")
+    parser.add_argument("center", nargs = "?", default = ",".join(map(str, CENTER)), help = "lat,long to download around")
+    parser.add_argument("distance", nargs = "?", type = float, default = DISTANCE, help = "meters around center")
+    parser.add_argument("--osm", help = "local OSM extract (.osm, .osm.bz2 or .osm.gz) instead of downloading")
+    parser.add_argument("--work", default = "build", help = "directory of the stage artifacts and build.json")
+    parser.add_argument("--out", default = ".", help = "directory graph.p, graph.bin and the indexes are written to")
+    parser.add_argument("--tiles", help = "also cut the graph into region tiles in this directory")
+    parser.add_argument("--tile-size", type = float, default = regions.TILE_SIZE, help = "tile size in degrees")
+    parser.add_argument("--overlap", type = float, default = 500.0, help = "tile overlap in meters")
+    parser.add_argument("--landmarks", type = int, default = 16, help = "number of ALT landmarks, 0 for none")
+    parser.add_argument("--no-contraction", action = "store_true", help = "skip the contraction hierarchy")
+    parser.add_argument("--workers", type = int, help = "worker processes, one per CPU by default")
+    parser.add_argument("--from", dest = "start", choices = STAGES, help = "rerun this stage and the ones after it")
+    args = parser.parse_args()
+    center = tuple(float(value) for value in args.center.split(","))
+    start_time = time.time()
+    # the worker tasks have to be pickled by module name, which __main__ is not
+    from Elena.abstraction import build as module
+    pipeline = module.Pipeline(args.work, args.out, osm = args.osm, center = center, distance = args.distance, tiles = args.tiles,
+                        tile_size = args.tile_size, overlap = args.overlap, landmark_count = args.landmarks,
+                        contraction = not args.no_contraction, workers = args.workers)
+    report = pipeline.run(args.start)
+    print("Built in %.1f s (%d of %d stages up to date)" % (time.time() - start_time, sum(entry["skipped"] for entry in report), len(STAGES)))
@@ -0,0 +1,306 @@
+import os
+import sys
+import time
+import random
+import numpy as np
+from bisect import bisect_left
+from heapq import heappush, heappop
+from Elena.abstraction.landmarks import fingerprint
+
+# Contraction hierarchy over edge lengths, for the shortest route every request starts with.
+# Nodes are contracted one at a time, least important first. Contracting v adds a shortcut u -> w (through v) for
+# every pair of neighbours whose shortest connection ran through v, so distances between the remaining nodes are
+# kept. A query then only follows edges towards more important nodes, from both ends, and meets in the middle
+# after settling a few hundred nodes. Shortcuts remember the node they skip, to unpack them back into the route.
+CONTRACTION_FILE = "graph.ch.npz"
+
+
+def to_csr(n, edges):
+    # edges[v] is a list of (node, length, middle); returns offsets, nodes, lengths, middles sorted by node.
+    offsets = np.zeros(n + 1, dtype = np.int64)
+    np.cumsum([len(edges[v]) for v in range(n)], out = offsets[1:])
+    flat = [edge for v in range(n) for edge in sorted(edges[v])]
+    nodes = np.array([edge[0] for edge in flat], dtype = np.int32)
+    lengths = np.array([edge[1] for edge in flat], dtype = np.float64)
+    middles = np.array([edge[2] for edge in flat], dtype = np.int32)
+    return offsets, nodes, lengths, middles
+
+
+class ContractionHierarchy:
+    # up_*: for every position v, the edges v -> w to more important nodes w.
+    # down_*: for every position v, the edges u -> v from more important nodes u (down_nodes holds u).
+    # middle is the contracted node a shortcut skips, -1 for an edge of the graph.
+    ARRAYS = ("rank", "up_offsets", "up_nodes", "up_length", "up_middle", "down_offsets", "down_nodes", "down_length", "down_middle")
+
+    def __init__(self, rank, up_offsets, up_nodes, up_length, up_middle, down_offsets, down_nodes, down_length, down_middle,
+                 graph = None, path = None):
+        self.rank = np.asarray(rank, dtype = np.int32)
+        self.up_offsets, self.up_nodes = np.asarray(up_offsets, dtype = np.int64), np.asarray(up_nodes, dtype = np.int32)
+        self.up_length, self.up_middle = np.asarray(up_length, dtype = np.float64), np.asarray(up_middle, dtype = np.int32)
+        self.down_offsets, self.down_nodes = np.asarray(down_offsets, dtype = np.int64), np.asarray(down_nodes, dtype = np.int32)
+        self.down_length, self.down_middle = np.asarray(down_length, dtype = np.float64), np.asarray(down_middle, dtype = np.int32)
+        self.graph = graph # fingerprint of the routing graph
+        self.path = path
+        self.lists = None
+
+    @classmethod
+    def build(cls, R, witness_limit = 60):
+        # Contracts the nodes of R in order of edge difference (shortcuts added minus edges removed), plus the
+        # number of contracted neighbours and the depth in the hierarchy to spread the contraction evenly, updated
+        # lazily. Witness searches settle at most witness_limit nodes; a missed witness only costs an unneeded
+        # shortcut, never a wrong distance.
+        n = len(R)
+        out = [dict() for _ in range(n)] # out[u][w] = (length, middle) among the nodes not contracted yet
+        inn = [dict() for _ in range(n)]
+        for u, w, length in zip(R.sources.tolist(), R.targets.tolist(), R.length.astype(np.float64).tolist()):
+            if u != w and (w not in out[u] or length < out[u][w][0]):
+                out[u][w] = (length, -1)
+                inn[w][u] = (length, -1)
+        contracted = [False] * n
+        neighbours_done = [0] * n
+
+        def witness(u, skip, limit, targets):
+            # Distances from u among uncontracted nodes other than skip, up to limit or until every target is settled.
+            dist, heap, settled, left = {u : 0.0}, [(0.0, u)], 0, len(targets)
+            while heap and settled < witness_limit:
+                d, node = heappop(heap)
+                if d > dist[node]:
+                    continue
+                if d > limit:
+                    break
+                settled += 1
+                if node in targets:
+                    left -= 1
+                    if not left:
+                        break
+                for w, (length, _) in out[node].items():
+                    if w == skip:
+                        continue
+                    nd = d + length
+                    if nd < dist.get(w, float("inf")):
+                        dist[w] = nd
+                        heappush(heap, (nd, w))
+            return dist
+
+        def shortcuts(v):
+            # Shortcuts contracting v would add, as (u, w, length).
+            added = []
+            targets = list(out[v].items())
+            if not targets:
+                return added
+            longest = max(length for _, (length, _) in targets)
+            for u, (in_length, _) in inn[v].items():
+                dist = witness(u, v, in_length + longest, out[v])
+                for w, (out_length, _) in targets:
+                    if w != u and dist.get(w, float("inf")) > in_length + out_length:
+                        added.append((u, w, in_length + out_length))
+            return added
+
+        def priority(v, added):
+            return len(added) - len(inn[v]) - len(out[v]) + neighbours_done[v] + level[v]
+
+        level = [0] * n
+        heap = [(priority(v, shortcuts(v)), v) for v in range(n)]
+        heap.sort()
+        rank = np.zeros(n, dtype = np.int32)
+        up, down = [[] for _ in range(n)], [[] for _ in range(n)]
+        order = 0
+        while heap:
+            p, v = heappop(heap)
+            if contracted[v]:
+                continue
+            added = shortcuts(v)
+            current = priority(v, added)
+            if heap and current > heap[0][0]:
+                heappush(heap, (current, v)) # lazy update: its priority went up, try the next one first
+                continue
+            for u, w, length in added:
+                if w not in out[u] or length < out[u][w][0]:
+                    out[u][w] = (length, v)
+                    inn[w][u] = (length, v)
+            rank[v] = order
+            order += 1
+            contracted[v] = True
+            up[v] = [(w, length, middle) for w, (length, middle) in out[v].items()]
+            down[v] = [(u, length, middle) for u, (length, middle) in inn[v].items()]
+            for w in out[v]:
+                del inn[w][v]
+                neighbours_done[w] += 1
+                level[w] = max(level[w], level[v] + 1)
+            for u in inn[v]:
+                del out[u][v]
+                neighbours_done[u] += 1
+                level[u] = max(level[u], level[v] + 1)
+            out[v], inn[v] = {}, {}
+        return cls(rank, *to_csr(n, up), *to_csr(n, down), graph = fingerprint(R))
+
+    def save(self, path):
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, graph = self.graph, **{name : getattr(self, name) for name in self.ARRAYS})
+        os.replace(tmp, path)
+        self.path = path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(*[data[name] for name in cls.ARRAYS], graph = str(data["graph"]), path = path)
+
+    def matches(self, R):
+        return self.graph == fingerprint(R)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    @property
+    def shortcuts(self):
+        return int((self.up_middle >= 0).sum() + (self.down_middle >= 0).sum())
+
+    def get_lists(self):
+        # Python lists of the arrays, which the query loops index much faster than numpy arrays. Built once.
+        if self.lists is None:
+            self.lists = (self.rank.tolist(), self.up_offsets.tolist(), self.up_nodes.tolist(), self.up_length.tolist(), self.up_middle.tolist(),
+                          self.down_offsets.tolist(), self.down_nodes.tolist(), self.down_length.tolist(), self.down_middle.tolist())
+        return self.lists
+
+    def warm_up(self):
+        self.get_lists()
+        return self
+
+    def search(self, source, target):
+        # Bidirectional upward Dijkstra. Returns (distance, meeting node, forward parents, backward parents).
+        # Stall on demand: a node reached more cheaply through an edge from a more important node already seen
+        # is not expanded, since no shortest route goes through it that way.
+        _, up_offsets, up_nodes, up_length, _, down_offsets, down_nodes, down_length, _ = self.get_lists()
+        dist = ({source : 0.0}, {target : 0.0})
+        parent = ({source : -1}, {target : -1})
+        heaps = ([(0.0, source)], [(0.0, target)])
+        # per side: the edges to relax, and the edges into the node from more important ones, for stalling
+        graphs = (((up_offsets, up_nodes, up_length), (down_offsets, down_nodes, down_length)),
+                  ((down_offsets, down_nodes, down_length), (up_offsets, up_nodes, up_length)))
+        best, meet = float("inf"), -1
+        if source == target:
+            return 0.0, source, parent[0], parent[1]
+        inf = float("inf")
+        while heaps[0] or heaps[1]:
+            # a side stops once its next node is no closer than the best meeting found
+            side = 0 if heaps[0] and (not heaps[1] or heaps[0][0][0] <= heaps[1][0][0]) else 1
+            heap, mine, parents = heaps[side], dist[side], parent[side]
+            d, node = heappop(heap)
+            if d >= best:
+                heap.clear()
+                continue
+            if d > mine[node]:
+                continue
+            other = dist[1 - side].get(node)
+            if other is not None and d + other < best:
+                best, meet = d + other, node
+            (offsets, nodes, lengths), (stall_offsets, stall_nodes, stall_lengths) = graphs[side]
+            stalled = False
+            for k in range(stall_offsets[node], stall_offsets[node+1]):
+                if mine.get(stall_nodes[k], inf) + stall_lengths[k] < d:
+                    stalled = True
+                    break
+            if stalled:
+                continue
+            for k in range(offsets[node], offsets[node+1]):
+                w, nd = nodes[k], d + lengths[k]
+                if nd < mine.get(w, inf):
+                    mine[w] = nd
+                    parents[w] = node
+                    heappush(heap, (nd, w))
+        return best, meet, parent[0], parent[1]
+
+    def edge_middle(self, u, w):
+        # Node skipped by the hierarchy edge u -> w, -1 for a graph edge. The edge is stored at the less important end.
+        rank, up_offsets, up_nodes, _, up_middle, down_offsets, down_nodes, _, down_middle = self.get_lists()
+        if rank[u] < rank[w]:
+            return up_middle[bisect_left(up_nodes, w, up_offsets[u], up_offsets[u+1])]
+        return down_middle[bisect_left(down_nodes, u, down_offsets[w], down_offsets[w+1])]
+
+    def unpack(self, u, w):
+        # Graph route of the hierarchy edge u -> w, without u.
+        route, stack = [], [(u, w)]
+        while stack:
+            a, b = stack.pop()
+            middle = self.edge_middle(a, b)
+            if middle < 0:
+                route.append(b)
+            else:
+                stack.append((middle, b))
+                stack.append((a, middle))
+        return route
+
+    def shortest_path(self, source, target):
+        # Same contract as RoutingGraph.shortest_path: (route of positions, distance), (None, inf) if unreachable.
+        distance, meet, forward, backward = self.search(source, target)
+        if meet < 0:
+            return None, float("inf")
+        ups = [meet]
+        while forward[ups[-1]] != -1:
+            ups.append(forward[ups[-1]])
+        downs = [meet]
+        while backward[downs[-1]] != -1:
+            downs.append(backward[downs[-1]])
+        hops = ups[::-1] + downs[1:]
+        route = [source]
+        for u, w in zip(hops[:-1], hops[1:]):
+            route.extend(self.unpack(u, w))
+        return route, distance
+
+
+def check(G, R, hierarchy, pairs):
+    # Largest difference between hierarchy and networkx shortest distances over pairs of OSM node ids,
+    # and the number of routes that do not follow the graph's edges. Both are 0 for a correct hierarchy.
+    import networkx as nx
+    worst, broken = 0.0, 0
+    for u, v in pairs:
+        route, distance = hierarchy.shortest_path(R.index[u], R.index[v])
+        try:
+            expected = nx.shortest_path_length(G, u, v, weight = "length")
+        except nx.NetworkXNoPath:
+            expected = float("inf")
+        if route is None or expected == float("inf"):
+            broken += (route is None) != (expected == float("inf"))
+            continue
+        worst = max(worst, abs(distance - expected))
+        try:
+            R.edge_ids(route)
+        except KeyError:
+            broken += 1
+    return worst, broken
+
+
+def load_for(R, path = CONTRACTION_FILE):
+    # Hierarchy for R from path, or None when there is none or it was built for another graph.
+    if not os.path.exists(path):
+        return None
+    hierarchy = ContractionHierarchy.load(path)
+    if not hierarchy.matches(R):
+        print("%s was built for another graph and is ignored, rebuild it with python -m Elena.abstraction.contraction" % path)
+        return None
+    return hierarchy
+
+
+if __name__ == "__main__":
+    # python -m Elena.abstraction.contraction [graph.bin or graph.p] [graph.ch.npz] [pairs to check against networkx]
+    # Built over the routing graph the server loads: graph.bin, or graph.p simplified as the build does.
+    import pickle as p
+    from Elena.abstraction import graph_store
+    from Elena.abstraction.build import routing_graph
+    src = sys.argv[1] if len(sys.argv) > 1 else ("graph.bin" if os.path.exists("graph.bin") else "graph.p")
+    dst = sys.argv[2] if len(sys.argv) > 2 else CONTRACTION_FILE
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    pickled = src if not src.endswith(".bin") else os.path.join(os.path.dirname(src), "graph.p")
+    G = p.load(open(pickled, "rb")) if os.path.exists(pickled) else None
+    R = graph_store.load(src) if src.endswith(".bin") else routing_graph(G)
+    start_time = time.time()
+    hierarchy = ContractionHierarchy.build(R)
+    hierarchy.save(dst)
+    print("Wrote %s: %d nodes, %d shortcuts, %.1f MB in %.2f s" % (dst, len(R), hierarchy.shortcuts, hierarchy.nbytes / 1e6, time.time() - start_time))
+    if G is not None and count:
+        # the nodes routes can start and end at, junctions only in a simplified graph
+        rnd = random.Random(0)
+        nodes = R.nodes[R.routable()].tolist()
+        worst, broken = check(G, R, hierarchy, [(rnd.choice(nodes), rnd.choice(nodes)) for _ in range(count)])
+        print("Checked %d pairs against networkx: largest difference %.6f m, %d broken routes" % (count, worst, broken))
@@ -0,0 +1,174 @@
+import sqlite3
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ElevationCache:
+    # Persistent elevation per coordinate, in an sqlite file. Coordinates are rounded to 1e-6 degrees (about 10 cm).
+    # Lookups bind two parameters per coordinate, CHUNK coordinates per query, within the 999 parameters
+    # SQLite before 3.32 allows.
+    CHUNK = 499
+
+    def __init__(self, path = "elevation_cache.sqlite"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS elevation (lat INTEGER, long INTEGER, elevation REAL, PRIMARY KEY (lat, long))")
+        self.db.commit()
+
+    def keys(self, lat, long):
+        return np.round(np.asarray(lat) * 1e6).astype(np.int64), np.round(np.asarray(long) * 1e6).astype(np.int64)
+
+    def get_many(self, lat, long):
+        # Cached elevations for the coordinates, nan where missing.
+        klat, klong = self.keys(lat, long)
+        found = {}
+        with self.lock:
+            for i in range(0, len(klat), self.CHUNK):
+                pairs = list(zip(klat[i:i+self.CHUNK].tolist(), klong[i:i+self.CHUNK].tolist()))
+                where = " OR ".join(["(lat = ? AND long = ?)"] * len(pairs))
+                rows = self.db.execute("SELECT lat, long, elevation FROM elevation WHERE " + where, [v for pair in pairs for v in pair])
+                found.update(((a, b), e) for a, b, e in rows)
+        return np.array([found.get(pair, np.nan) for pair in zip(klat.tolist(), klong.tolist())], dtype = np.float64)
+
+    def put_many(self, lat, long, elevation):
+        klat, klong = self.keys(lat, long)
+        rows = [(a, b, float(e)) for a, b, e in zip(klat.tolist(), klong.tolist(), np.asarray(elevation).tolist()) if not np.isnan(e)]
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO elevation VALUES (?, ?, ?)", rows)
+            self.db.commit()
+
+
+class CachedProvider:
+    # Only asks the wrapped provider for coordinates that are not in the cache yet.
+    def __init__(self, provider, cache):
+        self.provider = provider
+        self.cache = cache
+
+    def elevations(self, lat, long):
+        lat, long = np.asarray(lat, dtype = np.float64), np.asarray(long, dtype = np.float64)
+        result = self.cache.get_many(lat, long)
+        missing = np.isnan(result)
+        if missing.any():
+            result[missing] = self.provider.elevations(lat[missing], long[missing])
+            self.cache.put_many(lat[missing], long[missing], result[missing])
+        return result
+
+
+class GoogleElevationProvider:
+    # Google Elevation API, in batches of batch_size locations fetched by several threads at once.
+    URL = "https://maps.googleapis.com/maps/api/elevation/json"
+
+    def __init__(self, api_key, batch_size = 256, workers = 8, timeout = 30):
+        self.api_key = api_key
+        self.batch_size = batch_size
+        self.workers = workers
+        self.timeout = timeout
+
+    def fetch(self, lat, long):
+        import requests
+        locations = "|".join("%.6f,%.6f" % point for point in zip(lat.tolist(), long.tolist()))
+        response = requests.get(self.URL, params = {"locations" : locations, "key" : self.api_key}, timeout = self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        if data.get("status") != "OK":
+            raise RuntimeError("Google Elevation API error: %s" % data.get("status"))
+        return [r["elevation"] for r in data["results"]]
+
+    def elevations(self, lat, long):
+        lat, long = np.asarray(lat, dtype = np.float64), np.asarray(long, dtype = np.float64)
+        batches = [(lat[i:i+self.batch_size], long[i:i+self.batch_size]) for i in range(0, len(lat), self.batch_size)]
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            results = list(executor.map(lambda batch: self.fetch(*batch), batches))
+        return np.array([e for batch in results for e in batch], dtype = np.float64)
+
+
+class DEMProvider:
+    # Local digital elevation model raster, sampled with bilinear interpolation over all points at once.
+    # Reads ESRI ASCII grids (.asc) directly and GeoTIFFs through rasterio when it is installed.
+    # The raster must be in lat/long (EPSG:4326) and north-up. Points outside it get nan.
+    def __init__(self, path):
+        self.path = path
+        if path.lower().endswith((".tif", ".tiff")):
+            self.load_geotiff(path)
+        else:
+            self.load_ascii_grid(path)
+
+    def load_ascii_grid(self, path):
+        header = {}
+        with open(path) as f:
+            while len(header) < 6:
+                pos = f.tell()
+                parts = f.readline().split()
+                if not parts or not parts[0][0].isalpha():
+                    f.seek(pos)
+                    break
+                header[parts[0].lower()] = float(parts[1])
+            data = np.loadtxt(f, dtype = np.float64, ndmin = 2)
+        nrows, cell = int(header["nrows"]), header["cellsize"]
+        # corner or center registered origin
+        x0 = header["xllcorner"] if "xllcorner" in header else header["xllcenter"] - cell / 2
+        y0 = header["yllcorner"] if "yllcorner" in header else header["yllcenter"] - cell / 2
+        self.set_raster(data, x0, y0 + nrows * cell, cell, cell, header.get("nodata_value"))
+
+    def load_geotiff(self, path):
+        try:
+            import rasterio
+        except ImportError:
+            raise ImportError("Reading GeoTIFF elevation rasters needs rasterio (pip install rasterio); "
+                              "ESRI ASCII grids (.asc) work without it")
+        with rasterio.open(path) as src:
+            t = src.transform
+            self.set_raster(src.read(1).astype(np.float64), t.c, t.f, t.a, -t.e, src.nodata)
+
+    def set_raster(self, data, left, top, dx, dy, nodata):
+        # data[0, 0] is the north-west cell; dx, dy are cell sizes in degrees.
+        if nodata is not None:
+            data = np.where(data == nodata, np.nan, data)
+        self.data, self.left, self.top, self.dx, self.dy = data, left, top, dx, dy
+
+    def elevations(self, lat, long):
+        lat, long = np.asarray(lat, dtype = np.float64), np.asarray(long, dtype = np.float64)
+        nrows, ncols = self.data.shape
+        # fractional row/column of each point relative to cell centers
+        fx = (long - self.left) / self.dx - 0.5
+        fy = (self.top - lat) / self.dy - 0.5
+        inside = (fx >= -0.5) & (fx <= ncols - 0.5) & (fy >= -0.5) & (fy <= nrows - 0.5)
+        fx = np.clip(fx, 0, max(ncols - 1, 0))
+        fy = np.clip(fy, 0, max(nrows - 1, 0))
+        j0 = np.minimum(np.floor(fx).astype(np.int64), max(ncols - 2, 0))
+        i0 = np.minimum(np.floor(fy).astype(np.int64), max(nrows - 2, 0))
+        j1, i1 = np.minimum(j0 + 1, ncols - 1), np.minimum(i0 + 1, nrows - 1)
+        wx, wy = fx - j0, fy - i0
+        result = np.zeros(len(lat))
+        for i, j, w in ((i0, j0, (1 - wx) * (1 - wy)), (i0, j1, wx * (1 - wy)), (i1, j0, (1 - wx) * wy), (i1, j1, wx * wy)):
+            # corners with no weight are skipped, so a nodata cell only spoils the points it actually touches
+            result += np.where(w > 0, self.data[i, j] * w, 0.0)
+        result[~inside] = np.nan
+        return result
+
+
+def get_provider(config, api_key = None):
+    # Builds the provider described by the ELEVATION config dict, wrapped in the persistent cache.
+    if config.get("dem_path"):
+        provider = DEMProvider(config["dem_path"])
+    else:
+        provider = GoogleElevationProvider(api_key, batch_size = config.get("batch_size", 256), workers = config.get("workers", 8))
+    if config.get("cache"):
+        provider = CachedProvider(provider, ElevationCache(config["cache"]))
+    return provider
+
+
+def add_node_elevations(G, provider):
+    # Sets the 'elevation' attribute of every node from one vectorized provider call.
+    nodes = list(G.nodes())
+    lat = np.array([G.nodes[node]["y"] for node in nodes], dtype = np.float64)
+    long = np.array([G.nodes[node]["x"] for node in nodes], dtype = np.float64)
+    elevation = provider.elevations(lat, long)
+    missing = int(np.isnan(elevation).sum())
+    if missing:
+        print("No elevation for %d nodes, they are set to 0" % missing)
+    for node, e in zip(nodes, np.nan_to_num(elevation).tolist()):
+        G.nodes[node]["elevation"] = round(e, 3)
+    return G
@@ -0,0 +1,91 @@
+import sys
+import os
+import json
+import mmap
+import time
+import numpy as np
+import pickle as p
+from Elena.abstraction.routing_graph import RoutingGraph
+
+# Binary graph store layout:
+#   MAGIC (8 bytes) | version (uint32) | header length (uint32) | JSON header | arrays
+# The header lists each array's dtype, shape and byte offset. Arrays start on ALIGN byte
+# boundaries so they can be viewed straight out of a read-only mmap, which the OS shares
+# between every process that opens the same file.
+MAGIC = b"ELENAGRF"
+VERSION = 1
+ALIGN = 64
+
+
+def _aligned(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def save(R, path, meta = None):
+    # Writes the routing graph arrays to path. meta is any JSON-serializable dict stored alongside.
+    arrays = {name : np.ascontiguousarray(getattr(R, name)) for name in R.ARRAYS + R.CHAIN_ARRAYS if getattr(R, name) is not None}
+    if arrays["nodes"].dtype.kind not in "iu":
+        raise ValueError("graph store only supports integer node ids")
+    header = {"arrays" : {}, "meta" : meta or {}}
+    offset = 0
+    for name, a in arrays.items():
+        header["arrays"][name] = {"dtype" : a.dtype.str, "shape" : list(a.shape), "offset" : offset}
+        offset = _aligned(offset + a.nbytes)
+    encoded = json.dumps(header).encode("utf-8")
+    start = _aligned(len(MAGIC) + 8 + len(encoded))
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.array([VERSION, len(encoded)], dtype = "<u4").tobytes())
+        f.write(encoded)
+        for name, a in arrays.items():
+            f.seek(start + header["arrays"][name]["offset"])
+            f.write(a.tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp, path) # readers never see a half written file
+
+
+def read_header(buf):
+    # Parses and checks the fixed header. Returns (JSON header, start of the array section).
+    if bytes(buf[:len(MAGIC)]) != MAGIC:
+        raise ValueError("not an Elena graph store")
+    version, length = np.frombuffer(buf, dtype = "<u4", count = 2, offset = len(MAGIC))
+    if version != VERSION:
+        raise ValueError("unsupported graph store version %d (expected %d)" % (version, VERSION))
+    end = len(MAGIC) + 8 + int(length)
+    header = json.loads(bytes(buf[len(MAGIC) + 8 : end]).decode("utf-8"))
+    return header, _aligned(end)
+
+
+def load(path):
+    # Opens a graph store as a RoutingGraph whose arrays are read-only views of a shared mmap.
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    header, start = read_header(buf)
+    arrays = {}
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"])
+        count = int(np.prod(info["shape"]))
+        arrays[name] = np.frombuffer(buf, dtype = dtype, count = count, offset = start + info["offset"]).reshape(info["shape"])
+    R = RoutingGraph(**arrays)
+    R.meta = header["meta"]
+    return R
+
+
+def convert(pickle_path, store_path):
+    # One-shot conversion of a pickled osmnx graph (graph.p) to the binary store, simplified as the build does.
+    from Elena.abstraction.build import routing_graph # build imports this module
+    G = p.load(open(pickle_path, "rb"))
+    R = routing_graph(G)
+    save(R, store_path, meta = {"source" : os.path.basename(pickle_path), "created" : time.time()})
+    return R
+
+
+if __name__ == "__main__":
+    # python -m Elena.abstraction.graph_store [graph.p] [graph.bin]
+    src = sys.argv[1] if len(sys.argv) > 1 else "graph.p"
+    dst = sys.argv[2] if len(sys.argv) > 2 else "graph.bin"
+    start_time = time.time()
+    R = convert(src, dst)
+    print("Wrote %s: %d nodes, %d edges, %.1f MB in %.2f s" % (dst, len(R), len(R.targets), os.path.getsize(dst) / 1e6, time.time() - start_time))
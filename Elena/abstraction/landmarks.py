@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import hashlib
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+# ALT (A*, landmarks, triangle inequality) preprocessing. For a few landmark nodes L the walking distance and the
+# least elevation gain from L to every node and from every node to L are stored. At query time the triangle
+# inequality turns them into lower bounds towards any end node t:
+#   d(v, t) >= d(v, L) - d(t, L)   and   d(v, t) >= d(L, t) - d(L, v)
+# and the same for gain. An inf bound means the end cannot be reached at all; pairs that are both unreachable say nothing.
+LANDMARKS_FILE = "graph.landmarks.npz"
+
+
+def fingerprint(R):
+    # Identifies the graph the landmarks were built for, so stale ones are not used after the graph changes:
+    # a hash of its nodes, edges, lengths and elevations, which any edit changes.
+    digest = hashlib.sha1()
+    for array in (R.nodes, R.offsets, R.targets, R.length, R.elevation):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def triangle_bounds(to_landmark, from_landmark, end):
+    # Largest lower bound over all landmarks for every node, towards position end. Arrays are (landmarks, nodes).
+    # fmax skips the nan of inf - inf
+    bound = np.zeros(to_landmark.shape[1], dtype = to_landmark.dtype)
+    with np.errstate(invalid = "ignore"):
+        for to_l, from_l in zip(to_landmark, from_landmark):
+            np.fmax(bound, to_l - to_l[end], out = bound)
+            np.fmax(bound, from_l[end] - from_l, out = bound)
+    return bound
+
+
+class Landmarks:
+    # Per landmark distance and gain potentials, as float32 arrays of shape (landmarks, nodes) over RoutingGraph positions.
+    def __init__(self, positions, distance_to, distance_from, gain_to, gain_from, graph = None, path = None):
+        self.positions = np.asarray(positions, dtype = np.int64)
+        self.distance_to = np.asarray(distance_to, dtype = np.float32) # distance_to[l, v] = d(v, landmark l)
+        self.distance_from = np.asarray(distance_from, dtype = np.float32) # distance_from[l, v] = d(landmark l, v)
+        self.gain_to = np.asarray(gain_to, dtype = np.float32)
+        self.gain_from = np.asarray(gain_from, dtype = np.float32)
+        self.graph = graph # fingerprint of the routing graph
+        self.path = path # file they were loaded from, for process workers
+
+    @classmethod
+    def build(cls, R, count = 16, seed = 0):
+        # Picks count landmarks by farthest point selection: each new landmark is the node farthest (there and back)
+        # from the ones chosen so far, which spreads them around the edge of the graph where the bounds are tightest.
+        n = len(R)
+        lengths = R.matrix()
+        gains = csr_matrix((R.gain, R.targets, R.offsets), shape = (n, n))
+        reverse_lengths, reverse_gains = lengths.T.tocsr(), gains.T.tocsr()
+        count = min(count, n)
+
+        rnd = np.random.RandomState(seed)
+        # chain nodes of a simplified graph have no edges, a search from one would reach nothing
+        routable = np.flatnonzero(R.routable())
+        start = int(routable[rnd.randint(len(routable))]) if len(routable) else 0
+        spread = dijkstra(lengths, directed = True, indices = start)
+        positions, distance_to, distance_from = [], [], []
+        closest = np.full(n, np.inf)
+        for _ in range(count):
+            score = np.where(np.isfinite(spread), spread, -1.0) if not positions else np.where(np.isfinite(closest), closest, -1.0)
+            landmark = int(np.argmax(score))
+            if positions and score[landmark] <= 0:
+                break
+            positions.append(landmark)
+            distance_from.append(dijkstra(lengths, directed = True, indices = landmark))
+            distance_to.append(dijkstra(reverse_lengths, directed = True, indices = landmark))
+            closest = np.minimum(closest, distance_from[-1] + distance_to[-1])
+        gain_from = dijkstra(gains, directed = True, indices = positions)
+        gain_to = dijkstra(reverse_gains, directed = True, indices = positions)
+        return cls(positions, distance_to, distance_from, gain_to, gain_from, graph = fingerprint(R))
+
+    def save(self, path):
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, positions = self.positions, distance_to = self.distance_to, distance_from = self.distance_from,
+                 gain_to = self.gain_to, gain_from = self.gain_from, graph = self.graph)
+        os.replace(tmp, path)
+        self.path = path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["positions"], data["distance_to"], data["distance_from"], data["gain_to"], data["gain_from"],
+                       graph = str(data["graph"]), path = path)
+
+    def matches(self, R):
+        return self.graph == fingerprint(R)
+
+    @property
+    def nbytes(self):
+        return self.distance_to.nbytes + self.distance_from.nbytes + self.gain_to.nbytes + self.gain_from.nbytes
+
+    def distance_bounds(self, end):
+        # Lower bound on the walking distance from every node to position end.
+        return triangle_bounds(self.distance_to, self.distance_from, end)
+
+    def gain_bounds(self, end):
+        # Lower bound on the elevation gain of any route from every node to position end.
+        return triangle_bounds(self.gain_to, self.gain_from, end)
+
+
+def load_for(R, path = LANDMARKS_FILE):
+    # Landmarks for R from path, or None when there are none or they were built for another graph.
+    if not os.path.exists(path):
+        return None
+    landmarks = Landmarks.load(path)
+    if not landmarks.matches(R):
+        print("%s was built for another graph and is ignored, rebuild it with python -m Elena.abstraction.landmarks" % path)
+        return None
+    return landmarks
+
+
+if __name__ == "__main__":
+    # python -m Elena.abstraction.landmarks [graph.bin or graph.p] [graph.landmarks.npz] [number of landmarks]
+    # Built over the routing graph the server loads: graph.bin, or graph.p simplified as the build does.
+    import pickle as p
+    from Elena.abstraction import graph_store
+    from Elena.abstraction.build import routing_graph
+    src = sys.argv[1] if len(sys.argv) > 1 else ("graph.bin" if os.path.exists("graph.bin") else "graph.p")
+    dst = sys.argv[2] if len(sys.argv) > 2 else LANDMARKS_FILE
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    start_time = time.time()
+    R = graph_store.load(src) if src.endswith(".bin") else routing_graph(p.load(open(src, "rb")))
+    landmarks = Landmarks.build(R, count)
+    landmarks.save(dst)
+    print("Wrote %s: %d landmarks over %d nodes, %.1f MB in %.2f s" % (dst, len(landmarks.positions), len(R), landmarks.nbytes / 1e6, time.time() - start_time))
@@ -0,0 +1,284 @@
+import os
+import sys
+import bz2
+import gzip
+import json
+import math
+import time
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
+from Elena.abstraction.routing_graph import RoutingGraph
+from Elena.abstraction.spatial_index import SpatialIndex, EARTH_RADIUS
+from Elena.abstraction import graph_store
+from Elena.abstraction.elevation import add_node_elevations
+
+# Several towns served from one deployment. The map is cut into square tiles of TILE_SIZE degrees, each a graph
+# store file built offline from a local OSM extract. Tiles overlap by a band of overlap meters, so a street that
+# crosses a tile boundary is in both tiles with the same node ids and neighbouring tiles stitch together.
+# RegionManager loads the tiles a query needs on first use and keeps a memory bounded LRU of loaded regions.
+TILE_SIZE = 0.05
+INDEX_FILE = "regions.json"
+
+# highway values that are not walkable, as in osmnx's 'walk' network
+NOT_WALKABLE = {"motorway", "motorway_link", "trunk", "trunk_link", "construction", "proposed", "raceway", "bus_guideway",
+                "escalator", "elevator", "abandoned", "platform"}
+
+
+def open_extract(path):
+    # .osm, .osm.bz2 or .osm.gz
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def walkable(tags):
+    highway = tags.get("highway")
+    if highway is None or highway in NOT_WALKABLE or tags.get("area") == "yes":
+        return False
+    return tags.get("foot") != "no" and tags.get("access") not in ("private", "no")
+
+
+def haversine(lat1, long1, lat2, long2):
+    lat1, long1, lat2, long2 = map(np.radians, (lat1, long1, lat2, long2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def read_osm(path):
+    # Walk network of an OSM XML extract as an osmnx style MultiDiGraph (node 'x'/'y', edge 'length'/'name'/'osmid'),
+    # with an edge in each direction of every walkable way. Parsed as a stream, without any network access.
+    coords, ways = {}, []
+    with open_extract(path) as f:
+        for _, element in ET.iterparse(f, events = ("end",)):
+            if element.tag == "node":
+                coords[int(element.get("id"))] = (float(element.get("lat")), float(element.get("lon")))
+                element.clear()
+            elif element.tag == "way":
+                tags = {tag.get("k") : tag.get("v") for tag in element.iter("tag")}
+                if walkable(tags):
+                    refs = [int(nd.get("ref")) for nd in element.iter("nd")]
+                    ways.append((int(element.get("id")), refs, tags.get("name")))
+                element.clear()
+    import networkx as nx
+    G = nx.MultiDiGraph()
+    for osmid, refs, name in ways:
+        refs = [ref for ref in refs if ref in coords]
+        for u, v in zip(refs[:-1], refs[1:]):
+            if u == v:
+                continue
+            for node in (u, v):
+                if node not in G:
+                    G.add_node(node, y = coords[node][0], x = coords[node][1])
+            length = float(haversine(coords[u][0], coords[u][1], coords[v][0], coords[v][1]))
+            data = {"length" : length, "osmid" : osmid}
+            if name:
+                data["name"] = name
+            G.add_edge(u, v, **data)
+            G.add_edge(v, u, **data)
+    return G
+
+
+def tile_key(lat, long, size = TILE_SIZE):
+    return int(math.floor(lat / size)), int(math.floor(long / size))
+
+
+def tile_name(key):
+    return "%d_%d" % key
+
+
+def tile_bounds(key, size = TILE_SIZE):
+    # (south, west, north, east) in degrees
+    return key[0] * size, key[1] * size, (key[0] + 1) * size, (key[1] + 1) * size
+
+
+def expand(bounds, meters):
+    # bounds grown by meters on every side
+    south, west, north, east = bounds
+    dlat = meters / 111320.0
+    dlong = meters / (111320.0 * max(math.cos(math.radians((south + north) / 2)), 1e-6))
+    return south - dlat, west - dlong, north + dlat, east + dlong
+
+
+def subgraph(R, mask):
+    # Routing graph of the nodes where mask is set and the edges between them.
+    position = np.cumsum(mask) - 1
+    keep = mask[R.sources] & mask[R.targets]
+    pairs = np.column_stack((position[R.sources[keep]], position[R.targets[keep]]))
+    return RoutingGraph.from_edges(R.nodes[mask], R.lat[mask], R.long[mask], R.elevation[mask], pairs, R.length[keep])
+
+
+def stitch(graphs):
+    # One routing graph from tiles whose overlap bands share node ids. Nodes and edges in several tiles are kept once.
+    if len(graphs) == 1:
+        return graphs[0]
+    nodes = np.concatenate([R.nodes for R in graphs])
+    ids, first, inverse = np.unique(nodes, return_index = True, return_inverse = True)
+    offsets = np.cumsum([0] + [len(R) for R in graphs])
+    pairs = np.concatenate([np.column_stack((inverse[offset + R.sources], inverse[offset + R.targets])) for offset, R in zip(offsets, graphs)])
+    length = np.concatenate([R.length for R in graphs])
+    perm = np.lexsort((length, pairs[:, 1], pairs[:, 0]))
+    pairs, length = pairs[perm], length[perm]
+    keep = np.ones(len(pairs), dtype = bool)
+    keep[1:] = np.any(pairs[1:] != pairs[:-1], axis = 1)
+    return RoutingGraph.from_edges(ids, np.concatenate([R.lat for R in graphs])[first], np.concatenate([R.long for R in graphs])[first],
+                                   np.concatenate([R.elevation for R in graphs])[first], pairs[keep], length[keep])
+
+
+def tile_keys(R, size = TILE_SIZE):
+    # Keys of the tiles holding at least one node of R.
+    rows, cols = np.floor(R.lat / size).astype(np.int64), np.floor(R.long / size).astype(np.int64)
+    return sorted(set(zip(rows.tolist(), cols.tolist())))
+
+
+def build_tile(R, directory, key, size = TILE_SIZE, overlap = 500.0):
+    # Writes the graph store of one tile, the nodes within overlap meters of its bounds. Returns its index entry.
+    south, west, north, east = expand(tile_bounds(key, size), overlap)
+    mask = (R.lat >= south) & (R.lat <= north) & (R.long >= west) & (R.long <= east)
+    tile = subgraph(R, mask)
+    graph_store.save(tile, os.path.join(directory, tile_name(key) + ".bin"), meta = {"tile" : list(key), "size" : size})
+    return {"nodes" : len(tile), "edges" : len(tile.targets), "bounds" : list(tile_bounds(key, size))}
+
+
+def write_index(directory, tiles, size = TILE_SIZE, overlap = 500.0, source = None):
+    # Writes the tile index, tiles being the index entries by tile name. Returns the index.
+    index = {"size" : size, "overlap" : overlap, "source" : source, "created" : time.time(), "tiles" : tiles}
+    with open(os.path.join(directory, INDEX_FILE), "w") as f:
+        json.dump(index, f, indent = 1)
+    return index
+
+
+def build_tiles(G, directory, size = TILE_SIZE, overlap = 500.0, source = None):
+    # Cuts a graph with elevations into tile graph stores in directory and writes the tile index.
+    # Returns the index. Every tile holds the nodes within overlap meters of its bounds.
+    os.makedirs(directory, exist_ok = True)
+    R = RoutingGraph.from_networkx(G)
+    tiles = {tile_name(key) : build_tile(R, directory, key, size, overlap) for key in tile_keys(R, size)}
+    return write_index(directory, tiles, size, overlap, source)
+
+
+def build_from_extract(osm_path, directory, provider, size = TILE_SIZE, overlap = 500.0):
+    # Offline tile build: walk network from a local OSM extract, elevations from provider (e.g. a DEMProvider).
+    G = add_node_elevations(read_osm(osm_path), provider)
+    return build_tiles(G, directory, size, overlap, source = os.path.basename(osm_path))
+
+
+class Region:
+    # A loaded tile, or several stitched tiles, with its snapping index and the Algorithms that route on it.
+    def __init__(self, keys, R, store_path = None):
+        self.keys = keys
+        self.R = R.warm_up()
+        self.store_path = store_path # graph store of a single tile, None for stitched regions
+        self.index = SpatialIndex.from_routing(R)
+        self.algorithms = None
+        self.batch = None
+
+    @property
+    def nbytes(self):
+        tree = self.index.tree
+        return self.R.nbytes + tree.data.nbytes + tree.indices.nbytes + self.index.nodes.nbytes
+
+    def close(self):
+        # Stops the worker pools of an evicted region once the requests still using them are done.
+        for owner in (self.algorithms, self.batch):
+            if owner is not None:
+                owner.close()
+
+
+class RegionManager:
+    # Picks and loads the tiles covering a query. Loaded regions are kept in an LRU bounded by max_bytes;
+    # the least recently used ones are dropped when it is exceeded. Safe to use from several threads: regions are
+    # loaded outside the lock, so queries on loaded regions never wait for a load, and queries needing a region
+    # that is being loaded wait for that load instead of starting their own.
+    def __init__(self, directory, max_bytes = 512 * 1024 * 1024, margin = 2000.0, setup = None):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            self.tiles = json.load(f)
+        self.size = self.tiles["size"]
+        self.max_bytes = max_bytes
+        self.margin = margin # meters around the query endpoints that must be loaded, room for the detour
+        self.setup = setup # called with each new Region, e.g. to attach its Algorithms
+        self.loaded = OrderedDict()
+        self.loading = {} # keys -> Future of the region being loaded
+        self.loads, self.evictions = 0, 0
+        self.lock = threading.Lock()
+
+    def keys_for(self, points):
+        # Tiles covering the bounding box of points grown by margin. Raises ValueError when none is built.
+        points = np.asarray(points, dtype = np.float64).reshape(-1, 2)
+        south, west, north, east = expand((points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()), self.margin)
+        (row0, col0), (row1, col1) = tile_key(south, west, self.size), tile_key(north, east, self.size)
+        keys = tuple((row, col) for row in range(row0, row1 + 1) for col in range(col0, col1 + 1) if tile_name((row, col)) in self.tiles["tiles"])
+        if not keys:
+            raise ValueError("no region covers %s" % points.tolist())
+        return keys
+
+    def path(self, key):
+        return os.path.join(self.directory, tile_name(key) + ".bin")
+
+    def load(self, keys):
+        graphs = [graph_store.load(self.path(key)) for key in keys]
+        region = Region(keys, stitch(graphs), self.path(keys[0]) if len(keys) == 1 else None)
+        if self.setup is not None:
+            self.setup(region)
+        return region
+
+    def get(self, keys):
+        # The region made of keys, loaded (and stitched) on first use.
+        with self.lock:
+            if keys in self.loaded:
+                self.loaded.move_to_end(keys)
+                return self.loaded[keys]
+            future = self.loading.get(keys)
+            first = future is None
+            if first:
+                future = self.loading[keys] = Future()
+        if not first:
+            return future.result()
+        try:
+            region = self.load(keys)
+        except BaseException as error:
+            with self.lock:
+                del self.loading[keys]
+            future.set_exception(error)
+            raise
+        with self.lock:
+            del self.loading[keys]
+            self.loaded[keys] = region
+            self.loads += 1
+            # The region just loaded always stays, even when it alone is over the limit
+            while len(self.loaded) > 1 and self.nbytes > self.max_bytes:
+                _, evicted = self.loaded.popitem(last = False)
+                evicted.close()
+                self.evictions += 1
+        future.set_result(region)
+        return region
+
+    def region_for(self, points):
+        # The region a query between points is routed on.
+        return self.get(self.keys_for(points))
+
+    @property
+    def nbytes(self):
+        return sum(region.nbytes for region in self.loaded.values())
+
+    def stats(self):
+        with self.lock:
+            return {"tiles" : len(self.tiles["tiles"]), "loaded" : [[tile_name(key) for key in keys] for keys in self.loaded],
+                    "bytes" : self.nbytes, "max_bytes" : self.max_bytes, "loads" : self.loads, "evictions" : self.evictions}
+
+
+if __name__ == "__main__":
+    # python -m Elena.abstraction.regions extract.osm[.bz2] tiles/ [tile size in degrees] [overlap in meters]
+    from Elena.abstraction.config import API, ELEVATION
+    from Elena.abstraction.elevation import get_provider
+    src, dst = sys.argv[1], sys.argv[2]
+    size = float(sys.argv[3]) if len(sys.argv) > 3 else TILE_SIZE
+    overlap = float(sys.argv[4]) if len(sys.argv) > 4 else 500.0
+    start_time = time.time()
+    index = build_from_extract(src, dst, get_provider(ELEVATION, api_key = API["googleapikey"]), size, overlap)
+    print("Wrote %d tiles to %s in %.2f s" % (len(index["tiles"]), dst, time.time() - start_time))
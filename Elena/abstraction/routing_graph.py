@@ -0,0 +1,287 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+
+class NodeIndex:
+    # Read-only mapping of OSM node id -> RoutingGraph position backed by a sorted order array.
+    def __init__(self, nodes, order):
+        self.nodes = nodes
+        self.order = order
+
+    def __getitem__(self, node):
+        i = np.searchsorted(self.nodes, node, sorter = self.order)
+        if i >= len(self.order) or self.nodes[self.order[i]] != node:
+            raise KeyError(node)
+        return int(self.order[i])
+
+    def positions(self, nodes):
+        # Positions of many OSM node ids in one vectorized lookup. Raises KeyError if any id is missing.
+        nodes = np.asarray(nodes)
+        i = np.searchsorted(self.nodes, nodes, sorter = self.order)
+        found = self.order[np.minimum(i, len(self.order) - 1)]
+        missing = self.nodes[found] != nodes
+        if missing.any():
+            raise KeyError(nodes[missing][0].item())
+        return found
+
+    def __contains__(self, node):
+        try:
+            self[node]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+class RoutingGraph:
+    # Compact array-backed (CSR) copy of the walk graph used by the routing algorithms.
+    # Nodes are numbered 0..n-1; self.nodes maps a position back to its OSM node id.
+    # The out-edges of node i are targets[offsets[i]:offsets[i+1]], sorted by target,
+    # with one edge per node pair (the shortest of any parallel edges).
+    # Arrays written by graph_store, in this order. Derived ones are recomputed when not given.
+    ARRAYS = ("nodes", "order", "lat", "long", "elevation", "offsets", "targets", "sources", "length", "gain", "drop")
+    # Written as well when present: the chain nodes of super-edges after simplify, see Elena.abstraction.simplify.
+    # via[via_offsets[k]:via_offsets[k+1]] are the positions edge k passes, via_distance how far along edge k each one is.
+    CHAIN_ARRAYS = ("via_offsets", "via", "via_distance")
+
+    def __init__(self, nodes, lat, long, elevation, offsets, targets, length, order = None, sources = None, gain = None, drop = None,
+                 via_offsets = None, via = None, via_distance = None):
+        self.nodes = np.asarray(nodes)
+        self.lat = np.asarray(lat, dtype = np.float64)
+        self.long = np.asarray(long, dtype = np.float64)
+        self.elevation = np.asarray(elevation, dtype = np.float64)
+        self.offsets = np.asarray(offsets, dtype = np.int64)
+        self.targets = np.asarray(targets, dtype = np.int32)
+        self.length = np.asarray(length, dtype = np.float32)
+        if order is None:
+            order = np.argsort(self.nodes, kind = "stable")
+        self.order = np.asarray(order, dtype = np.int64) # positions sorted by OSM id, for id lookups
+        if sources is None:
+            sources = np.repeat(np.arange(len(self.nodes), dtype = np.int32), np.diff(self.offsets))
+        self.sources = np.asarray(sources, dtype = np.int32)
+        if gain is None or drop is None:
+            rise = self.elevation[self.targets] - self.elevation[self.sources]
+            gain, drop = np.maximum(rise, 0.0), np.maximum(-rise, 0.0)
+        self.gain = np.asarray(gain, dtype = np.float32)
+        self.drop = np.asarray(drop, dtype = np.float32)
+        self.via_offsets, self.via, self.via_distance = None, None, None
+        if via_offsets is not None:
+            self.via_offsets = np.asarray(via_offsets, dtype = np.int64)
+            self.via = np.asarray(via, dtype = np.int32)
+            self.via_distance = np.asarray(via_distance, dtype = np.float32)
+        self._index = None
+        self._reverse = None
+        self._matrix = None
+        self._keys = None
+        self._grade = None
+        self._via_edge = None
+
+    @classmethod
+    def from_networkx(cls, G):
+        # Builds the arrays from a networkx graph. Edge length is read from 'length' (OSM graphs)
+        # or 'weight' (plain weighted graphs); undirected graphs get an edge in each direction.
+        nodes = list(G.nodes())
+        index = {node : i for i, node in enumerate(nodes)}
+        lat = [G.nodes[node].get("y", 0.0) for node in nodes]
+        long = [G.nodes[node].get("x", 0.0) for node in nodes]
+        elevation = [G.nodes[node].get("elevation", 0.0) for node in nodes]
+
+        best = {}
+        for u, v, data in G.edges(data = True):
+            w = data.get("length", data.get("weight", 1.0))
+            pairs = [(index[u], index[v])] if G.is_directed() else [(index[u], index[v]), (index[v], index[u])]
+            for pair in pairs:
+                if pair not in best or w < best[pair]:
+                    best[pair] = w
+        return cls.from_edges(nodes, lat, long, elevation, list(best.keys()), list(best.values()))
+
+    @classmethod
+    def from_edges(cls, nodes, lat, long, elevation, pairs, length, order = None):
+        # Builds the CSR arrays from (source position, target position) pairs and their lengths.
+        n = len(nodes)
+        pairs = np.asarray(pairs, dtype = np.int64).reshape(-1, 2)
+        length = np.asarray(length, dtype = np.float64)
+        perm = np.lexsort((pairs[:, 1], pairs[:, 0]))
+        src, dst, length = pairs[perm, 0], pairs[perm, 1], length[perm]
+        offsets = np.zeros(n + 1, dtype = np.int64)
+        np.cumsum(np.bincount(src, minlength = n), out = offsets[1:])
+        return cls(nodes, lat, long, elevation, offsets, dst, length, order = order)
+
+    @property
+    def index(self):
+        # OSM node id -> position. Looks ids up in the sorted order array, so no per-process dict is built.
+        if self._index is None:
+            self._index = NodeIndex(self.nodes, self.order)
+        return self._index
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def nbytes(self):
+        # Memory held by the arrays.
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS + self.CHAIN_ARRAYS if getattr(self, name) is not None)
+
+    def edges(self, i):
+        # Out-edges of position i as parallel lists of (target, length, gain, drop).
+        lo, hi = self.offsets[i], self.offsets[i+1]
+        return zip(self.targets[lo:hi].tolist(), self.length[lo:hi].tolist(), self.gain[lo:hi].tolist(), self.drop[lo:hi].tolist())
+
+    def edge_id(self, u, v):
+        # Position of the edge u -> v in the edge arrays.
+        lo, hi = self.offsets[u], self.offsets[u+1]
+        k = lo + np.searchsorted(self.targets[lo:hi], v)
+        if k >= hi or self.targets[k] != v:
+            raise KeyError((u, v))
+        return k
+
+    def edge_ids(self, route):
+        # Positions of the edges route[0] -> route[1] -> ... in the edge arrays, in one vectorized lookup.
+        # Edges are sorted by (source, target), so source * n + target is a sorted key to search.
+        route = np.asarray(route, dtype = np.int64)
+        if self._keys is None:
+            self._keys = self.sources.astype(np.int64) * len(self.nodes) + self.targets
+        if len(route) < 2:
+            return np.zeros(0, dtype = np.int64)
+        wanted = route[:-1] * len(self.nodes) + route[1:]
+        k = np.minimum(np.searchsorted(self._keys, wanted), len(self._keys) - 1)
+        missing = self._keys[k] != wanted
+        if missing.any():
+            i = int(np.argmax(missing))
+            raise KeyError((int(route[i]), int(route[i+1])))
+        return k
+
+    @property
+    def grade(self):
+        # Rise over length of every edge, 0 for zero length edges. Derived from the stored arrays when first used.
+        if self._grade is None:
+            rise = self.elevation[self.targets] - self.elevation[self.sources]
+            length = self.length.astype(np.float64)
+            self._grade = np.divide(rise, length, out = np.zeros(len(length)), where = length > 0).astype(np.float32)
+        return self._grade
+
+    def patched(self, length = None, elevation = None, gain = None, drop = None):
+        # Graph with the same nodes and edges and new edge lengths or elevations, e.g. for closures.
+        # The structure arrays and the id index are shared, so node and edge positions stay valid.
+        R = RoutingGraph(self.nodes, self.lat, self.long, self.elevation if elevation is None else elevation, self.offsets, self.targets,
+                         self.length if length is None else length, order = self.order, sources = self.sources,
+                         gain = self.gain if gain is None else gain, drop = self.drop if drop is None else drop,
+                         via_offsets = self.via_offsets, via = self.via, via_distance = self.via_distance)
+        R._index, R._keys, R._via_edge = self._index, self._keys, self._via_edge
+        return R
+
+    def reverse(self):
+        # Graph with every edge flipped, used for searches from the destination. Built once.
+        if self._reverse is None:
+            pairs = np.column_stack((self.targets, self.sources))
+            self._reverse = RoutingGraph.from_edges(self.nodes, self.lat, self.long, self.elevation, pairs, self.length, order = self.order)
+            self._reverse._index = self._index
+            self._reverse._reverse = self
+        return self._reverse
+
+    def warm_up(self):
+        # Builds the lazily derived structures up front, before the graph is shared between threads.
+        self.index
+        self.grade
+        self.edge_ids([])
+        self.matrix()
+        self.reverse().matrix()
+        return self
+
+    def routable(self):
+        # Mask of the positions routes can start and end at: all of them, or after simplify the ones left with edges.
+        if self.via is None:
+            return np.ones(len(self.nodes), dtype = bool)
+        return (np.diff(self.offsets) > 0) | (np.bincount(self.targets, minlength = len(self.nodes)) > 0)
+
+    def chain(self, k):
+        # Positions edge k passes from its source to its target, chain nodes included.
+        if self.via is None:
+            return [int(self.sources[k]), int(self.targets[k])]
+        return [int(self.sources[k])] + self.via[self.via_offsets[k]:self.via_offsets[k+1]].tolist() + [int(self.targets[k])]
+
+    def chain_edges(self, mask):
+        # Ids of the super-edges whose chain passes a position in mask. Empty on graphs that were not simplified.
+        if self.via is None:
+            return np.zeros(0, dtype = np.int64)
+        if self._via_edge is None:
+            self._via_edge = np.repeat(np.arange(len(self.targets)), np.diff(self.via_offsets))
+        return np.unique(self._via_edge[mask[self.via]])
+
+    def expand(self, route):
+        # Route of positions with the chain nodes of its super-edges put back, as a list. Unchanged on graphs that were not simplified.
+        if self.via is None or len(route) < 2:
+            return list(route)
+        k = self.edge_ids(route)
+        parts = [route[:1]]
+        for i, (lo, hi) in enumerate(zip(self.via_offsets[k].tolist(), self.via_offsets[k+1].tolist())):
+            parts.append(self.via[lo:hi])
+            parts.append(route[i+1:i+2])
+        return np.concatenate(parts).astype(np.int64).tolist()
+
+    def to_ids(self, route):
+        # Positions -> OSM node ids.
+        return self.nodes[np.asarray(route, dtype = np.int64)].tolist()
+
+    def coordinates(self, route):
+        # [long, lat] pairs for a route of positions, as used by the GeoJSON output.
+        route = np.asarray(route, dtype = np.int64)
+        return np.column_stack((self.long[route], self.lat[route])).tolist()
+
+    def route_stats(self, route, profile = False):
+        # Total length, elevation gain and elevation drop along a route of positions, summed over its edges at once.
+        # With profile, also a dict of per node "distance" (from the start) and "elevation" and per edge "grade".
+        k = self.edge_ids(route)
+        stats = (float(self.length[k].sum(dtype = np.float64)), float(self.gain[k].sum(dtype = np.float64)),
+                 float(self.drop[k].sum(dtype = np.float64)))
+        if not profile:
+            return stats
+        if self.via is None:
+            distance = np.concatenate(([0.0], np.cumsum(self.length[k], dtype = np.float64)))
+            elevation = self.elevation[np.asarray(route, dtype = np.int64)]
+            return stats + ({"distance" : distance, "elevation" : elevation, "grade" : self.grade[k]},)
+        # over the chain nodes as well, from how far along its super-edge each one is
+        along = [np.concatenate((self.via_distance[self.via_offsets[e]:self.via_offsets[e+1]], [self.length[e]])) for e in k.tolist()]
+        pieces = np.concatenate([np.diff(np.concatenate(([0.0], a))) for a in along]) if along else np.zeros(0)
+        distance = np.concatenate(([0.0], np.cumsum(pieces, dtype = np.float64)))
+        elevation = self.elevation[np.asarray(self.expand(route), dtype = np.int64)]
+        grade = np.divide(np.diff(elevation), pieces, out = np.zeros(len(pieces)), where = pieces > 0).astype(np.float32)
+        return stats + ({"distance" : distance, "elevation" : elevation, "grade" : grade},)
+
+    def matrix(self):
+        # Edge lengths as a scipy CSR matrix sharing this graph's arrays, for scipy.sparse.csgraph.
+        if self._matrix is None:
+            n = len(self.nodes)
+            self._matrix = csr_matrix((self.length, self.targets, self.offsets), shape = (n, n))
+        return self._matrix
+
+    def shortest_lengths(self, source, cutoff = None, reverse = False):
+        # Dijkstra over edge lengths from source (towards source when reverse), stopping past cutoff.
+        # Returns arrays of distance (inf when not reached) and predecessor (negative for none).
+        R = self.reverse() if reverse else self
+        limit = np.inf if cutoff is None else cutoff
+        return dijkstra(R.matrix(), directed = True, indices = source, limit = limit, return_predecessors = True)
+
+    def shortest_path_towards(self, source, target, tree):
+        # shortest_path read off tree = shortest_lengths(target, reverse = True), whose predecessors lead to target.
+        dist, parent = tree
+        if not np.isfinite(dist[source]):
+            return None, float("inf")
+        route = [source]
+        while route[-1] != target:
+            route.append(int(parent[route[-1]]))
+        return route, float(dist[source])
+
+    def shortest_path(self, source, target, tree = None):
+        # Shortest route by length between two positions, as (route, distance). (None, inf) if unreachable.
+        # tree is shortest_lengths(source) when it was already computed, e.g. for several targets.
+        dist, parent = tree if tree is not None else self.shortest_lengths(source)
+        if not np.isfinite(dist[target]):
+            return None, float("inf")
+        route = [target]
+        while route[-1] != source:
+            route.append(int(parent[route[-1]]))
+        return route[::-1], float(dist[target])
@@ -0,0 +1,114 @@
+import os
+import sys
+import time
+import numpy as np
+from Elena.abstraction.routing_graph import RoutingGraph
+
+# Degree-2 chain contraction. OSM walk graphs draw every bend of a trail as a node with exactly two neighbours,
+# and the searches would push, pop and relax each of them. simplify replaces every such chain by one super-edge
+# between the nodes at its ends, with the summed length, elevation gain and drop, in each direction the chain can
+# be walked. All nodes keep their positions; chain nodes are left without edges, queries no longer snap to them and
+# every super-edge lists the chain nodes it passes (via), so routes are expanded back to full node sequences.
+# Chains longer than max_length meters keep a node every max_length or so, which bounds how far a point on a long
+# trail snaps away. Two chains between the same nodes, or a chain back to where it started, keep a node as well,
+# since the routing graph holds one edge per node pair and would otherwise lose the other way round.
+
+
+def chain_mask(R):
+    # Positions a chain only passes through: two distinct neighbours, entered from one and left to the other,
+    # both ways for a two-way trail or one way for a oneway one.
+    n = len(R)
+    out_degree = np.diff(R.offsets)
+    in_degree = np.bincount(R.targets, minlength = n)
+    in_offsets = np.zeros(n + 1, dtype = np.int64)
+    np.cumsum(in_degree, out = in_offsets[1:])
+    in_sources = R.sources[np.lexsort((R.sources, R.targets))]
+    positions = np.arange(n)
+
+    mask = np.zeros(n, dtype = bool)
+    two = np.flatnonzero((out_degree == 2) & (in_degree == 2))
+    t1, t2 = R.targets[R.offsets[two]], R.targets[R.offsets[two] + 1]
+    s1, s2 = in_sources[in_offsets[two]], in_sources[in_offsets[two] + 1]
+    mask[two] = (t1 == s1) & (t2 == s2) & (t1 != two) & (t2 != two)
+    one = np.flatnonzero((out_degree == 1) & (in_degree == 1))
+    t, s = R.targets[R.offsets[one]], in_sources[in_offsets[one]]
+    mask[one] = (t != s) & (t != positions[one]) & (s != positions[one])
+    return mask
+
+
+def walk(R, chain, a, k):
+    # Follows the chain that leaves position a by edge k. Returns (end position, chain positions, edge ids).
+    via, edges = [], [k]
+    previous, node = a, int(R.targets[k])
+    while chain[node]:
+        via.append(node)
+        lo, hi = R.offsets[node], R.offsets[node + 1]
+        k = lo if hi - lo == 1 or R.targets[lo] != previous else lo + 1
+        edges.append(int(k))
+        previous, node = node, int(R.targets[k])
+    return node, via, edges
+
+
+def keep_splits(R, chain, max_length = None):
+    # Takes chain nodes out of chain until no chain is longer than max_length and no two chains, or a chain
+    # and an edge, join the same pair of nodes. The node kept is the one nearest the middle of the chain.
+    while True:
+        ends, split = {}, set()
+        for a in np.flatnonzero(~chain).tolist():
+            for k in range(R.offsets[a], R.offsets[a + 1]):
+                b, via, edges = walk(R, chain, a, k)
+                ends.setdefault((a, b), []).append((via, edges))
+        for (a, b), found in ends.items():
+            for via, edges in found:
+                if not via:
+                    continue
+                length = np.cumsum(R.length[edges], dtype = np.float64)
+                if a == b or len(found) > 1 or (max_length is not None and length[-1] > max_length):
+                    split.add(via[int(np.argmin(np.abs(length[:-1] - length[-1] / 2)))])
+        if not split:
+            return chain
+        chain[list(split)] = False
+
+
+def simplify(R, max_length = 150.0):
+    # Routing graph of R with its degree-2 chains contracted into super-edges (see above).
+    chain = keep_splits(R, chain_mask(R), max_length)
+    best = {}
+    for a in np.flatnonzero(~chain).tolist():
+        for k in range(R.offsets[a], R.offsets[a + 1]):
+            b, via, edges = walk(R, chain, a, k)
+            length = float(R.length[edges].sum(dtype = np.float64))
+            if (a, b) not in best or length < best[a, b][0]:
+                best[a, b] = (length, float(R.gain[edges].sum(dtype = np.float64)), float(R.drop[edges].sum(dtype = np.float64)),
+                              via, np.cumsum(R.length[edges], dtype = np.float64)[:-1])
+
+    pairs = np.array(list(best.keys()), dtype = np.int64).reshape(-1, 2)
+    values = list(best.values())
+    perm = np.lexsort((pairs[:, 1], pairs[:, 0]))
+    values = [values[i] for i in perm.tolist()]
+    offsets = np.zeros(len(R) + 1, dtype = np.int64)
+    np.cumsum(np.bincount(pairs[perm, 0], minlength = len(R)), out = offsets[1:])
+    via_offsets = np.zeros(len(values) + 1, dtype = np.int64)
+    np.cumsum([len(value[3]) for value in values], out = via_offsets[1:])
+    via = np.array([node for value in values for node in value[3]], dtype = np.int32)
+    via_distance = np.concatenate([value[4] for value in values] + [np.zeros(0)]).astype(np.float32)
+    return RoutingGraph(R.nodes, R.lat, R.long, R.elevation, offsets, pairs[perm, 1], [value[0] for value in values], order = R.order,
+                        gain = [value[1] for value in values], drop = [value[2] for value in values],
+                        via_offsets = via_offsets, via = via, via_distance = via_distance)
+
+
+if __name__ == "__main__":
+    # python -m Elena.abstraction.simplify [graph.bin or graph.p] [graph.bin] [max chain length in meters]
+    import pickle as p
+    from Elena.abstraction import graph_store
+    src = sys.argv[1] if len(sys.argv) > 1 else ("graph.bin" if os.path.exists("graph.bin") else "graph.p")
+    dst = sys.argv[2] if len(sys.argv) > 2 else "graph.bin"
+    max_length = float(sys.argv[3]) if len(sys.argv) > 3 else 150.0
+    start_time = time.time()
+    R = graph_store.load(src) if src.endswith(".bin") else RoutingGraph.from_networkx(p.load(open(src, "rb")))
+    if R.via is not None:
+        sys.exit("%s is already simplified" % src)
+    S = simplify(R, max_length)
+    graph_store.save(S, dst, meta = {"source" : os.path.basename(src), "created" : time.time(), "simplified" : max_length})
+    print("Wrote %s: %d of %d nodes and %d of %d edges left to route over, in %.2f s" % (dst, int(np.count_nonzero(S.routable())), len(R),
+                                                                                        len(S.targets), len(R.targets), time.time() - start_time))
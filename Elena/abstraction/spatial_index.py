@@ -0,0 +1,48 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS = 6371008.8
+
+
+def to_unit_sphere(lat, long):
+    # Converts degrees to 3D points on the unit sphere, where chord length grows with great-circle distance.
+    lat, long = np.radians(lat), np.radians(long)
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(long), cos_lat * np.sin(long), np.sin(lat)))
+
+
+class SpatialIndex:
+    # KD-tree over graph node coordinates for nearest node snapping. Built once when the graph is loaded.
+    def __init__(self, nodes, lat, long):
+        self.nodes = np.asarray(nodes)
+        self.tree = cKDTree(to_unit_sphere(np.asarray(lat, dtype = np.float64), np.asarray(long, dtype = np.float64)))
+
+    @classmethod
+    def from_graph(cls, G):
+        nodes = list(G.nodes())
+        lat = [G.nodes[node]["y"] for node in nodes]
+        long = [G.nodes[node]["x"] for node in nodes]
+        return cls(nodes, lat, long)
+
+    @classmethod
+    def from_routing(cls, R, mask = None):
+        # Index of the positions of a RoutingGraph that routes can start and end at, only those in mask when given.
+        keep = R.routable() if mask is None else R.routable() & mask
+        if keep.all():
+            return cls(R.nodes, R.lat, R.long)
+        return cls(R.nodes[keep], R.lat[keep], R.long[keep])
+
+    def nearest_many(self, points):
+        # Snaps many (lat, long) points in one call. Returns node ids and great-circle distances in meters.
+        points = np.asarray(points, dtype = np.float64).reshape(-1, 2)
+        chord, i = self.tree.query(to_unit_sphere(points[:, 0], points[:, 1]))
+        dist = 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1.0))
+        return self.nodes[i].tolist(), dist
+
+    def nearest(self, point, return_dist = False):
+        # Same contract as ox.get_nearest_node for a single (lat, long) point.
+        nodes, dist = self.nearest_many([point])
+        node = nodes[0]
+        if return_dist:
+            return node, float(dist[0])
+        return node
@@ -0,0 +1,100 @@
+import math
+import numpy as np
+import networkx as nx
+from scipy.spatial import cKDTree
+
+# Synthetic walk graphs with elevation, shaped like the osmnx graphs the app loads
+# (MultiDiGraph, node 'x'/'y'/'elevation', edge 'length'), for benchmarks and tests that run offline.
+ORIGIN = (42.384803, -72.529262) # Amherst, where the real graph is centred
+
+
+def meters_to_degrees(lat0):
+    # Degrees of latitude and longitude per meter around latitude lat0.
+    return 1.0 / 111320.0, 1.0 / (111320.0 * math.cos(math.radians(lat0)))
+
+
+def elevation_surface(lat, long, seed = 0, hills = 12, relief = 60.0):
+    # Smooth terrain in meters at the given coordinates: a few random gaussian hills and valleys over a gentle tilt.
+    rnd = np.random.RandomState(seed)
+    lat, long = np.asarray(lat, dtype = np.float64), np.asarray(long, dtype = np.float64)
+    lat0, long0 = lat.mean(), long.mean()
+    dlat, dlong = meters_to_degrees(lat0)
+    y, x = (lat - lat0) / dlat, (long - long0) / dlong
+    extent = max(np.ptp(x), np.ptp(y), 1.0)
+    elevation = 80.0 + relief * 0.2 * (x / extent) + relief * 0.1 * (y / extent)
+    for _ in range(hills):
+        cx, cy = rnd.uniform(x.min(), x.max()), rnd.uniform(y.min(), y.max())
+        width = rnd.uniform(0.05, 0.25) * extent
+        elevation += rnd.uniform(-0.5, 1.0) * relief * np.exp(-((x - cx)**2 + (y - cy)**2) / (2 * width**2))
+    return elevation + rnd.uniform(0.0, 1.0, len(lat))
+
+
+def add_edge_pair(G, u, v, length):
+    G.add_edge(u, v, key = 0, length = length)
+    G.add_edge(v, u, key = 0, length = length)
+
+
+def grid_graph(rows = 60, cols = 60, spacing = 50.0, seed = 0, origin = ORIGIN):
+    # rows x cols street grid with spacing meters between intersections and slightly uneven block lengths.
+    rnd = np.random.RandomState(seed)
+    dlat, dlong = meters_to_degrees(origin[0])
+    r, c = np.divmod(np.arange(rows * cols), cols)
+    lat, long = origin[0] + r * spacing * dlat, origin[1] + c * spacing * dlong
+    elevation = elevation_surface(lat, long, seed)
+    G = nx.MultiDiGraph()
+    for i in range(rows * cols):
+        G.add_node(i, y = float(lat[i]), x = float(long[i]), elevation = round(float(elevation[i]), 3))
+    for i in range(rows * cols):
+        if c[i] + 1 < cols:
+            add_edge_pair(G, i, i + 1, spacing * rnd.uniform(1.0, 1.3))
+        if r[i] + 1 < rows:
+            add_edge_pair(G, i, i + cols, spacing * rnd.uniform(1.0, 1.3))
+    return G
+
+
+def geometric_graph(n = 3000, size = 3000.0, radius = 90.0, seed = 0, origin = ORIGIN):
+    # Random geometric graph: n points scattered over a size x size meter square, joined when closer than
+    # radius meters. Only the largest connected component is kept, so every query has a route.
+    rnd = np.random.RandomState(seed)
+    xy = rnd.uniform(0.0, size, (n, 2))
+    dlat, dlong = meters_to_degrees(origin[0])
+    lat, long = origin[0] + xy[:, 1] * dlat, origin[1] + xy[:, 0] * dlong
+    elevation = elevation_surface(lat, long, seed)
+    G = nx.MultiDiGraph()
+    for i in range(n):
+        G.add_node(i, y = float(lat[i]), x = float(long[i]), elevation = round(float(elevation[i]), 3))
+    pairs = np.array(sorted(cKDTree(xy).query_pairs(radius)), dtype = np.int64).reshape(-1, 2)
+    lengths = np.hypot(*(xy[pairs[:, 0]] - xy[pairs[:, 1]]).T) * rnd.uniform(1.0, 1.1, len(pairs))
+    for (u, v), length in zip(pairs.tolist(), lengths.tolist()):
+        add_edge_pair(G, u, v, length)
+    largest = max(nx.weakly_connected_components(G), key = len)
+    return G.subgraph(largest).copy()
+
+
+def subdivide(G, spacing = 15.0, bumps = 1.5, seed = 0):
+    # Copy of G with shape nodes every spacing meters along each edge, like the bends osmnx keeps along trails.
+    # Their elevation follows the line between the ends with up to bumps meters of noise. Edges come in pairs, both
+    # directions through the same shape nodes.
+    rnd = np.random.RandomState(seed)
+    H = nx.MultiDiGraph()
+    H.add_nodes_from(G.nodes(data = True))
+    next_id = max(G.nodes()) + 1
+    for u, v, data in G.edges(data = True):
+        if u > v and G.has_edge(v, u):
+            continue
+        pieces = max(1, int(data["length"] // spacing))
+        chain = [u]
+        for i in range(1, pieces):
+            t = i / pieces
+            a, b = G.nodes[u], G.nodes[v]
+            H.add_node(next_id, y = a["y"] + t * (b["y"] - a["y"]), x = a["x"] + t * (b["x"] - a["x"]),
+                       elevation = round(a["elevation"] + t * (b["elevation"] - a["elevation"]) + rnd.uniform(-bumps, bumps), 3))
+            chain.append(next_id)
+            next_id += 1
+        chain.append(v)
+        for a, b in zip(chain[:-1], chain[1:]):
+            if G.has_edge(v, u):
+                add_edge_pair(H, a, b, data["length"] / pieces)
+            else:
+                H.add_edge(a, b, key = 0, length = data["length"] / pieces)
+    return H
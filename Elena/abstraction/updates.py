@@ -0,0 +1,155 @@
+import numpy as np
+from Elena.abstraction.spatial_index import SpatialIndex
+
+# Trail closures, reopenings and elevation corrections applied to a loaded graph without rebuilding it.
+# Changes are kept as a GraphState on top of the base routing graph as loaded. Every update builds a new routing
+# graph from the base and the whole state: closed edges get an infinite length, so no search uses them, and
+# corrected elevations only recompute the gain and drop of the edges that touch them. The CSR structure, and so
+# every node position and the id index, is shared with the base graph, which is never modified. On a simplified graph
+# an edge or node inside a chain closes, or changes the gain and drop of, the super-edge that passes it.
+
+
+class GraphUpdate:
+    # One batch of changes, by OSM node ids. Edges are (u, v) pairs and are closed in both directions unless
+    # both_ways is False; closing a node closes every edge at it. elevations maps node ids to corrected meters.
+    def __init__(self, close_edges = (), open_edges = (), close_nodes = (), open_nodes = (), elevations = None, both_ways = True):
+        self.close_edges = [tuple(edge) for edge in close_edges]
+        self.open_edges = [tuple(edge) for edge in open_edges]
+        self.close_nodes = list(close_nodes)
+        self.open_nodes = list(open_nodes)
+        self.elevations = dict(elevations or {})
+        self.both_ways = both_ways
+
+    @classmethod
+    def from_dict(cls, data):
+        # From a JSON body: {"close_edges" : [[u, v], ...], "open_edges" : [...], "close_nodes" : [...],
+        # "open_nodes" : [...], "elevations" : {"node" : meters} or [[node, meters], ...], "both_ways" : true}
+        elevations = data.get("elevations") or {}
+        pairs = elevations.items() if isinstance(elevations, dict) else elevations
+        return cls(data.get("close_edges", ()), data.get("open_edges", ()), data.get("close_nodes", ()), data.get("open_nodes", ()),
+                   {int(node) : float(meters) for node, meters in pairs}, data.get("both_ways", True))
+
+    def to_dict(self):
+        return {"close_edges" : [list(edge) for edge in self.close_edges], "open_edges" : [list(edge) for edge in self.open_edges],
+                "close_nodes" : self.close_nodes, "open_nodes" : self.open_nodes,
+                "elevations" : [[node, meters] for node, meters in self.elevations.items()], "both_ways" : self.both_ways}
+
+    def edges(self, pairs):
+        return pairs + [(v, u) for u, v in pairs] if self.both_ways else pairs
+
+
+class GraphState:
+    # Changes in effect on a base routing graph, by position: closed edge ids, closed nodes and corrected elevations.
+    # Never modified; apply returns a new state.
+    def __init__(self, closed_edges = (), closed_nodes = (), elevations = None):
+        self.closed_edges = frozenset(closed_edges)
+        self.closed_nodes = frozenset(closed_nodes)
+        self.elevations = dict(elevations or {})
+
+    @property
+    def closures(self):
+        return bool(self.closed_edges or self.closed_nodes)
+
+    def __bool__(self):
+        return bool(self.closures or self.elevations)
+
+    def apply(self, base, update):
+        # New state with update applied, and what it changed: the edges and nodes it closed (positions), whether it
+        # reopened anything and the nodes whose elevation it changed. Raises KeyError for unknown nodes or edges.
+        index = base.index
+        close_edges = {k for u, v in update.edges(update.close_edges) for k in edge_ids(base, index[u], index[v])}
+        open_edges = {k for u, v in update.edges(update.open_edges) for k in edge_ids(base, index[u], index[v])}
+        close_nodes = {int(index[node]) for node in update.close_nodes}
+        open_nodes = {int(index[node]) for node in update.open_nodes}
+        elevations = {int(index[node]) : meters for node, meters in update.elevations.items()}
+
+        closed_edges = (self.closed_edges - open_edges) | close_edges
+        closed_nodes = (self.closed_nodes - open_nodes) | close_nodes
+        merged = dict(self.elevations)
+        merged.update(elevations)
+        # a correction back to the surveyed value is no correction at all
+        merged = {node : meters for node, meters in merged.items() if meters != float(base.elevation[node])}
+        state = GraphState(closed_edges, closed_nodes, merged)
+        changes = {"closed_edges" : sorted(close_edges - self.closed_edges), "closed_nodes" : sorted(close_nodes - self.closed_nodes),
+                   "reopened" : bool((self.closed_edges & open_edges) or (self.closed_nodes & open_nodes)),
+                   "elevations" : sorted(node for node in set(merged) | set(self.elevations) if merged.get(node) != self.elevations.get(node))}
+        return state, changes
+
+    def to_dict(self):
+        # Plain lists, to hand the state to worker processes.
+        return {"closed_edges" : sorted(self.closed_edges), "closed_nodes" : sorted(self.closed_nodes),
+                "elevations" : sorted(self.elevations.items())}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["closed_edges"], data["closed_nodes"], {int(node) : meters for node, meters in data["elevations"]})
+
+
+def edge_ids(base, u, v):
+    # Ids of the edges that walk from position u to v: the edge u -> v, or on a simplified graph the super-edges
+    # whose chain passes u and v in that order. Raises KeyError when there is none.
+    try:
+        return [int(base.edge_id(u, v))]
+    except KeyError:
+        mask = np.zeros(len(base), dtype = bool)
+        mask[[u, v]] = True
+        found = [int(k) for k in base.chain_edges(mask) if (u, v) in zip(base.chain(k)[:-1], base.chain(k)[1:])]
+        if not found:
+            raise
+        return found
+
+
+def climb(base, edges, elevation):
+    # Elevation gain and drop of edges for the given node elevations, over their chain nodes too.
+    if base.via is None:
+        rise = elevation[base.targets[edges]] - elevation[base.sources[edges]]
+        return np.maximum(rise, 0.0), np.maximum(-rise, 0.0)
+    gain, drop = np.zeros(len(edges)), np.zeros(len(edges))
+    for i, k in enumerate(edges.tolist()):
+        rise = np.diff(elevation[base.chain(k)])
+        gain[i], drop[i] = rise[rise > 0].sum(), -rise[rise < 0].sum()
+    return gain, drop
+
+
+def patch(base, state):
+    # Routing graph of base with state in effect. Shares the structure and the id index with base.
+    if not state:
+        return base
+    length, elevation, gain, drop = None, None, None, None
+    if state.closures:
+        length = base.length.copy()
+        closed = np.zeros(len(length), dtype = bool)
+        closed[list(state.closed_edges)] = True
+        if state.closed_nodes:
+            nodes = np.zeros(len(base), dtype = bool)
+            nodes[list(state.closed_nodes)] = True
+            closed |= nodes[base.sources] | nodes[base.targets]
+            closed[base.chain_edges(nodes)] = True
+        length[closed] = np.inf
+    if state.elevations:
+        positions = np.fromiter(state.elevations.keys(), dtype = np.int64, count = len(state.elevations))
+        elevation = base.elevation.copy()
+        elevation[positions] = np.fromiter(state.elevations.values(), dtype = np.float64, count = len(positions))
+        touched = np.zeros(len(base), dtype = bool)
+        touched[positions] = True
+        edges = np.union1d(np.flatnonzero(touched[base.sources] | touched[base.targets]), base.chain_edges(touched))
+        gain, drop = base.gain.copy(), base.drop.copy()
+        gain[edges], drop[edges] = climb(base, edges, elevation)
+    return base.patched(length = length, elevation = elevation, gain = gain, drop = drop)
+
+
+def open_index(base, base_index, state):
+    # Snapping index without the closed nodes; the base one while no node is closed.
+    if not state.closed_nodes:
+        return base_index
+    mask = np.ones(len(base), dtype = bool)
+    mask[list(state.closed_nodes)] = False
+    return SpatialIndex.from_routing(base, mask)
+
+
+def route_touches(route, points, pairs):
+    # True if a cached route (a list of [long, lat]) passes one of points or follows one of pairs of coordinates.
+    coordinates = [tuple(point) for point in route]
+    if points and any(point in points for point in coordinates):
+        return True
+    return bool(pairs) and any(pair in pairs for pair in zip(coordinates[:-1], coordinates[1:]))
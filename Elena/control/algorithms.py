@@ -1,22 +1,304 @@
-import osmnx as ox
-import networkx as nx
 from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from heapq import *
+import copy
 import time
+import threading
+import weakref
+import numpy as np
+from Elena.control.heuristics import DistanceHeuristic, LandmarkHeuristic
+from Elena.abstraction.spatial_index import SpatialIndex
+from Elena.abstraction.routing_graph import RoutingGraph
+from Elena.abstraction import graph_store
+from Elena.abstraction.landmarks import Landmarks
+from Elena.abstraction import updates
+from Elena.control.cache import RouteCache, ReverseTreeCache
+from Elena.control.metrics import stage
+
+ENGINES = ("dijkstra", "a_star", "constrained") # candidate elevation searches, in tie-break order (later wins ties)
+ENGINE_NAMES = {"dijkstra" : "Dijkstra", "a_star" : "A star", "constrained" : "Constrained label search"}
+
+
+class Query:
+    # State of one elevation search. Engines only read the graph and write here,
+    # so several queries can run at once on the same Algorithms object.
+    def __init__(self, start_node, end_node, x, elev_type, shortest_dist, deadline = None):
+        self.start_node = start_node # OSM node ids
+        self.end_node = end_node
+        self.x = x # fraction, 0.5 = 50%
+        self.elev_type = elev_type
+        self.shortest_dist = shortest_dist
+        self.deadline = deadline # time.time() after which engines give up
+        self.heuristic = None
+        self.expanded = 0 # nodes (or labels) popped
+        self.relaxed = 0 # heap pushes
+        self.heap_peak = 0 # largest heap size
+        self.timed_out = False # an engine gave up at the deadline
+        self.best = self.empty_best()
+
+    def empty_best(self):
+        #[path, totalDist, totalElevGain, totalElevDrop] before any route is found
+        if self.elev_type == "maximize": 
+            return [[], 0.0, float('-inf'), float('-inf')]
+        return [[], 0.0, float('inf'), float('-inf')]
+
+    def expired(self):
+        # Engines check this and give up when it is True, so it also records that the search was cut short.
+        if self.deadline is not None and time.time() > self.deadline:
+            self.timed_out = True
+        return self.timed_out
+
+    def copy(self):
+        return Query(self.start_node, self.end_node, self.x, self.elev_type, self.shortest_dist, self.deadline)
+
+
+# Process workers each open the graph store once; its pages are shared between them.
+worker = None
+
+def worker_init(store_path, exact_bound, label_bucket, length_bucket, landmarks_path = None, state = None, budget = None):
+    global worker
+    landmarks = Landmarks.load(landmarks_path) if landmarks_path is not None else None
+    R = graph_store.load(store_path)
+    if state is not None:
+        # replay the closures and corrections in effect when the pool was created
+        R = updates.patch(R, updates.GraphState.from_dict(state))
+    worker = Algorithms(None, exact_bound = exact_bound, routing = R, budget = budget,
+                        label_bucket = label_bucket, length_bucket = length_bucket, landmarks = landmarks)
+
+def worker_run(engine, query):
+    getattr(worker, engine)(query)
+    query.heuristic = None # holds graph arrays, not worth sending back
+    return query
+
 
 class Algorithms:
-    def __init__(self, G, x = 0.0, elev_type = "maximize"):
+    def __init__(self, G, x = 0.0, elev_type = "maximize", exact_bound = False, index = None, routing = None, cache = None,
+                 search_mode = "sequential", budget = None, first_acceptable = False, store_path = None, label_bucket = 2.0,
+                 length_bucket = 0.05, landmarks = None, contraction = None, trees = None):
 
         self.G = G
+        self.index = index # SpatialIndex for snapping, built on first use if not given
+        self.R = routing # RoutingGraph the searches run on, built on first use if not given
         self.elev_type = elev_type
         self.x = x
         self.best = [[], 0.0, float('-inf'), 0.0]
         self.start_node= None
         self.end_node =None
-
-    def reload(self, G):
-        # Reinitialize with modified G
-        self.G = G
+        self.exact_bound = exact_bound # prune with exact network distance to the destination
+        self.cache = cache if cache is not None else RouteCache() # get_shortest_path results
+        self.trees = trees if trees is not None else ReverseTreeCache() # reverse shortest path trees of recent end nodes
+        # "sequential" runs the engines one after the other, "thread" or "process" runs them in parallel
+        # workers. With a budget (seconds) the best route found before the deadline is returned.
+        self.search_mode = search_mode
+        self.budget = budget
+        self.first_acceptable = first_acceptable # return the first route that beats the shortest path
+        self.store_path = store_path # graph store the process workers open
+        # Elevation (meters) and length (fraction of the length limit) within which the constrained search
+        # treats labels as equal. 0 and 0 keep it exact; larger values keep fewer labels per node, at most about
+        # 1/length_bucket, and trade a little route quality for speed.
+        self.label_bucket = label_bucket
+        self.length_bucket = length_bucket
+        self.landmarks = landmarks # Landmarks of the routing graph for tighter search bounds, None to go without
+        self.contraction = contraction # ContractionHierarchy of the routing graph for the shortest route, None for a Dijkstra
+        self.executor = None
+        self.lock = threading.RLock() # reentrant: a pinned copy can be collected, and release it, while the lock is held
+        self.users = {} # process pool -> pinned copies still using it
+        self.retired = set() # pools replaced by apply_update or close, shut down when their last user is gone
+        self.closed = False
+        # Closures and elevation corrections applied with apply_update, over the graph as loaded (self.base)
+        self.state = updates.GraphState()
+        self.base = None
+        self.update_lock = threading.Lock()
+        self.generation = None # cache generation a pinned copy started in, so it never caches routes of a replaced graph
+
+    def reload(self, G, index = None, routing = None, contraction = None, landmarks = None):
+        # Reinitialize with modified G. Cached routes, reverse trees, landmarks, the contraction hierarchy and the
+        # process workers' graph are all of the old graph; contraction and landmarks are those of the new one, if built.
+        with self.lock:
+            self.G = G
+            self.index = index
+            self.R = routing
+            self.contraction = contraction
+            self.landmarks = landmarks
+            self.state, self.base = updates.GraphState(), None
+            if self.trees is not None:
+                self.trees.clear()
+            if self.search_mode == "process":
+                self.retire_executor()
+        self.cache.clear()
+
+
+    def retire_executor(self):
+        # Drops the worker pool, e.g. a process pool after the graph changed. Pools still used by pinned copies
+        # are shut down after their last one, see release. Called with self.lock held.
+        if self.executor is not None:
+            if self.executor in self.users:
+                self.retired.add(self.executor)
+            else:
+                self.executor.shutdown(wait = False)
+            self.executor = None
+
+
+    def close(self):
+        # Stops the worker pool once the requests that pinned it are done, e.g. when a region is evicted.
+        # Copies pinned afterwards get a pool of their own, shut down after their last one as well.
+        with self.lock:
+            self.closed = True
+            self.retire_executor()
+
+
+    def pinned(self):
+        # Shallow copy holding the current graph, index and worker pool, so a request sees one graph from start
+        # to end even when apply_update swaps in a new one meanwhile.
+        with self.lock:
+            executor = self.create_executor()
+            view = copy.copy(self)
+            view.generation = self.cache.generation
+            if executor is not None:
+                self.users[executor] = self.users.get(executor, 0) + 1
+                weakref.finalize(view, self.release, executor)
+                if self.closed:
+                    self.retire_executor()
+            return view
+
+
+    def release(self, executor):
+        # A pinned copy using executor is gone. A pool replaced by apply_update, or of a closed Algorithms, is shut
+        # down after its last one.
+        with self.lock:
+            self.users[executor] -= 1
+            if self.users[executor] == 0:
+                del self.users[executor]
+                if executor in self.retired:
+                    self.retired.discard(executor)
+                    executor.shutdown(wait = False)
+
+
+    def apply_update(self, update):
+        # Applies an updates.GraphUpdate (closures, reopenings, elevation corrections) without rebuilding the graph.
+        # The new routing graph is built and warmed up next to the live one, then swapped in at once: running
+        # requests finish on the graph they pinned and never wait. Only what the update invalidates is dropped:
+        # the snapping index when nodes close, landmarks when elevations change (they bound the all-open graph, so
+        # closures keep them valid), the contraction hierarchy while anything is closed, and the cached routes
+        # that use a closed edge or node. Reopenings and corrections can improve any route and clear the cache.
+        # Returns a summary of the changes.
+        with self.update_lock:
+            if self.base is None:
+                self.base = (self.get_routing_graph(), self.get_index(), self.landmarks, self.contraction)
+            base, base_index, landmarks, contraction = self.base
+            state, changes = self.state.apply(base, update)
+            R = updates.patch(base, state).warm_up()
+            index = updates.open_index(base, base_index, state)
+            with self.lock:
+                self.R, self.index, self.state = R, index, state
+                if self.trees is not None:
+                    self.trees.clear()
+                self.landmarks = landmarks if not state.elevations else None
+                self.contraction = contraction if not state.closures else None
+                # workers replay the state when they start; requests pinned to the old pool keep it until they finish
+                if self.search_mode == "process":
+                    self.retire_executor()
+
+            evicted = None
+            if self.cache is None:
+                pass
+            elif changes["reopened"] or changes["elevations"]:
+                self.cache.clear()
+            else:
+                points = {(float(base.long[i]), float(base.lat[i])) for i in changes["closed_nodes"]}
+                pairs = {((float(base.long[u]), float(base.lat[u])), (float(base.long[v]), float(base.lat[v])))
+                         for k in changes["closed_edges"] for u, v in zip(base.chain(k)[:-1], base.chain(k)[1:])}
+                evicted = self.cache.discard(lambda value : any(route is not None and updates.route_touches(route[0], points, pairs) for route in value))
+        return {"closed_edges" : len(state.closed_edges), "closed_nodes" : len(state.closed_nodes), "elevations" : len(state.elevations),
+                "cache_evicted" : evicted}
+
+
+    def get_routing_graph(self):
+        # Returns the compact routing graph of G.
+        if self.R is None:
+            self.R = RoutingGraph.from_networkx(self.G)
+        return self.R
+
+
+    def get_index(self):
+        # Returns the spatial index used for snapping points to graph nodes.
+        if self.index is None:
+            R = self.get_routing_graph()
+            self.index = SpatialIndex.from_routing(R)
+        return self.index
+
+
+    def get_heuristic(self, query):
+        # Returns the distance-to-destination heuristic for a query, building it on first use.
+        if query.heuristic is None:
+            R = self.get_routing_graph()
+            end = R.index[query.end_node]
+            max_dist = (1.0+query.x)*query.shortest_dist if query.shortest_dist is not None else None
+            # exact remaining distances when the end node's tree is cached, or about to be built for the exact bound
+            tree = self.destination_tree(end, compute = self.exact_bound)
+            distances = tree[0] if tree is not None else None
+            if self.landmarks is not None:
+                query.heuristic = LandmarkHeuristic(R, end, self.landmarks, exact = self.exact_bound, max_dist = max_dist, distances = distances)
+            else:
+                query.heuristic = DistanceHeuristic(R, end, exact = self.exact_bound, max_dist = max_dist, distances = distances)
+        return query.heuristic
+
+
+    def destination_tree(self, end, compute = True):
+        # Reverse shortest path tree (distance and predecessor arrays) towards position end, from the tree cache.
+        # On a miss it is built and cached when compute is set, otherwise None is returned.
+        R = self.get_routing_graph()
+        tree = self.trees.get(R, end) if self.trees is not None else None
+        if tree is None and compute:
+            tree = R.shortest_lengths(end, reverse = True)
+            if self.trees is not None:
+                self.trees.put(R, end, tree)
+        return tree
+
+
+    def shortest_route(self, source, target, tree = None):
+        # Shortest route between two positions as (route, distance): read off tree when one is shared by several
+        # queries, otherwise off the end node's cached reverse tree, otherwise from the contraction hierarchy when
+        # there is one. Without one the reverse tree is built instead of a forward Dijkstra, which costs the same,
+        # so later queries to the same end node get it for free.
+        R = self.get_routing_graph()
+        if tree is not None:
+            return R.shortest_path(source, target, tree)
+        towards = self.destination_tree(target, compute = self.contraction is None)
+        if towards is not None:
+            return R.shortest_path_towards(source, target, towards)
+        return self.contraction.shortest_path(source, target)
+
+
+    def worker_args(self):
+        # initargs of worker_init for process pools over this graph.
+        landmarks_path = self.landmarks.path if self.landmarks is not None else None
+        state = self.state.to_dict() if self.state else None
+        return (self.store_path, self.exact_bound, self.label_bucket, self.length_bucket, landmarks_path, state, self.budget)
+
+
+    def own_query(self, engine):
+        # Runs an engine on a query built from the instance attributes (start_node, end_node, x, ...)
+        # and copies the result back to self.best, for callers that drive a search by setting them.
+        query = Query(self.start_node, self.end_node, self.x, self.elev_type, getattr(self, "shortest_dist", None))
+        query.best = self.best
+        engine(query)
+        self.best, self.expanded = query.best, query.expanded
+        return self.best
+
+
+    def better(self, a, b, elev_type):
+        # True if route a beats route b: more (maximize) or less (minimize) elevation gain, then shorter.
+        if elev_type == "maximize":
+            return (a[2] > b[2]) or (a[2] == b[2] and a[1] < b[1])
+        return (a[2] < b[2]) or (a[2] == b[2] and a[1] < b[1])
+
+
+    def route_best(self, route):
+        # [route as OSM ids, length, elevation gain, elevation drop] for a route of routing graph positions.
+        R = self.get_routing_graph()
+        total, gain, drop = R.route_stats(route)
+        return [R.to_ids(R.expand(route)), total, gain, drop]
 
 
     def get_cost(self, node1, node2, cost_type = "normal"):
@@ -41,25 +323,23 @@ class Algorithms:
         
 
 
+    def elevation_profile(self, route):
+        # Per hop elevation difference, gain and drop along a route of OSM node ids, from one vectorized pass.
+        R = self.get_routing_graph()
+        rise = np.diff(R.elevation[R.index.positions(route)]) if len(route) else np.zeros(0)
+        return {"both" : rise, "elevation_gain" : np.maximum(rise, 0.0), "elevation_drop" : np.maximum(-rise, 0.0)}
+
+
     def get_Elevation(self, route, cost_type = "both", isPiecewise = False):
         # Compute total cost or piecewise cost for a given route
-        total = 0
-        if isPiecewise : 
-            piece_elevation = []
-        for i in range(len(route)-1):
-            if cost_type == "both":
-                diff = self.get_cost(route[i],route[i+1],"elevation_difference")	
-            elif cost_type == "elevation_gain":
-                diff = self.get_cost(route[i],route[i+1],"elevation_gain")
-            elif cost_type == "elevation_drop":
-                diff = self.get_cost(route[i],route[i+1],"elevation_drop")
-            elif cost_type == "normal":
-                diff = self.get_cost(route[i],route[i+1],"normal")
-            total += diff
-            if isPiecewise : 
-                piece_elevation.append(diff)
+        # Lengths ("normal") are read from G, since the routing graph keeps them in float32 and only the shortest parallel edge.
+        if cost_type == "normal":
+            pieces = np.array([self.get_cost(u, v, "normal") for u, v in zip(route[:-1], route[1:])], dtype = np.float64)
+        else:
+            pieces = self.elevation_profile(route)[cost_type]
+        total = float(pieces.sum())
         if isPiecewise:
-            return total, piece_elevation
+            return total, pieces.tolist()
         else:
             return total
 
@@ -75,70 +355,82 @@ class Algorithms:
         return path[::-1]
 
 
-    def check_nodes(self):
+    def to_latlong(self, route):
+        # [long, lat] pairs for a route of OSM node ids, as used by the GeoJSON output.
+        R = self.get_routing_graph()
+        return R.coordinates(R.index.positions(route))
+
+
+    def check_nodes(self, query = None):
         # Checks if start or end nodes are None values
-        if self.start_node is None or self.end_node is None:
+        query = query if query is not None else self
+        if query.start_node is None or query.end_node is None:
             return False
         return True
 
 
 
     # Run the dijkstra algorithm
-    def dijkstra(self):
-        #Implements Dijkstra's Algorithm
+    def dijkstra(self, query = None):
+        #Implements Dijkstra's Algorithm on the routing graph. The result goes to query.best.
+        if query is None:
+            return self.own_query(self.dijkstra)
         
-        if not self.check_nodes() : 
+        if not self.check_nodes(query) : 
             return
-        G, x, shortest, elev_type = self.G, self.x, self.shortest_dist, self.elev_type
-        start_node, end_node = self.start_node, self.end_node
+        R, x, shortest, elev_type = self.get_routing_graph(), query.x, query.shortest_dist, query.elev_type
+        start_node, end_node = R.index[query.start_node], R.index[query.end_node]
+        heuristic = self.get_heuristic(query)
+        max_dist = shortest*(1.0+x)
 
         temp = [(0.0, 0.0, start_node)]
         seen = set()
         prior_info = {start_node: 0}
-        parent_node = defaultdict(int)
-        parent_node[start_node] = -1
+        parent_node = {start_node: -1}
 
         while temp:
             curr_priority, curr_distance, curr_node = heappop(temp)
             
             if curr_node not in seen:
                 seen.add(curr_node)
+                query.expanded += 1
                 if curr_node == end_node:
                     break
+                if query.expanded & 255 == 0 and query.expired():
+                    return
 
-                for n in G.neighbors(curr_node):
+                for n, edge_len, gain, drop in R.edges(curr_node):
                     if n in seen: 
                         continue
                     
                     prev = prior_info.get(n, None) # get past priority of the node
-                    edge_len = self.get_cost(curr_node, n, "normal")
                     
                     # Update distance btw the nodes depending on maximize(subtract) or minimize elevation(add)
                     if elev_type == "maximize":
                         if x <= 0.5:
-                            nxt = edge_len*0.1 + self.get_cost(curr_node, n, "elevation_drop")
+                            nxt = edge_len*0.1 + drop
                             nxt += curr_priority
                         else:
-                            nxt = (edge_len*0.1 - self.get_cost(curr_node, n, "elevation_difference"))* edge_len*0.1
+                            nxt = (edge_len*0.1 - (gain - drop))* edge_len*0.1
                     else:
-                        nxt = edge_len*0.1 + self.get_cost(curr_node, n, "elevation_gain")
+                        nxt = edge_len*0.1 + gain
                         nxt += curr_priority
                     
                     nxt_distance = curr_distance + edge_len
                     
-                    if nxt_distance <= shortest*(1.0+x) and (prev is None or nxt < prev):
+                    if nxt_distance <= max_dist and (prev is None or nxt < prev) and heuristic.can_reach(n, nxt_distance, max_dist):
                         parent_node[n] = curr_node
                         prior_info[n] = nxt
-                        heappush(temp, (nxt, nxt_distance, n))        
+                        heappush(temp, (nxt, nxt_distance, n))
+                        query.relaxed += 1
+                        query.heap_peak = max(query.heap_peak, len(temp))
         
-        if not curr_distance : 
+        if not curr_distance or end_node not in seen: 
             return
 
-        route = self.get_route(parent_node, end_node)
-        elevation_dist, dropDist = self.get_Elevation(route, "elevation_gain"), self.get_Elevation(route, "elevation_drop")
-        self.best = [route[:], curr_distance, elevation_dist, dropDist]
+        query.best = self.route_best(self.get_route(parent_node, end_node))
 
-        return
+        return query.best
 
 
     def retrace_path(self, from_node, curr_node):
@@ -149,168 +441,432 @@ class Algorithms:
             curr_node = from_node[curr_node]
             total.append(curr_node)
         
-        self.best = [total[:], self.get_Elevation(total, "normal"), self.get_Elevation(total, "elevation_gain"), self.get_Elevation(total, "elevation_drop")]
+        profile = self.elevation_profile(total)
+        self.best = [total[:], self.get_Elevation(total, "normal"), float(profile["elevation_gain"].sum()), float(profile["elevation_drop"].sum())]
         return
 
 
 
-    def a_star(self):
-        # Implements A* algorithm for calculating distances. 
-        evaluated = set() #evaluated node set      
-        toEval = set() # nodes that are not evaluated
-        best_node = {} # best cost to end
-        costToStart = {} # cost of node to start node
-        costToStart1 = {}
-        final_score = {} # dist between start node and end node thru a particular node
-
-
-        if not self.check_nodes() : 
+    def a_star(self, query = None):
+        # Implements A* algorithm for calculating distances on the routing graph. The result goes to query.best.
+        # The frontier is a binary heap; decrease-key is done by pushing a new entry and
+        # lazily skipping stale ones on pop. Per-node state only exists for touched nodes.
+        if query is None:
+            return self.own_query(self.a_star)
+        if not self.check_nodes(query) : 
             return
-        G, min_dist = self.G, self.shortest_dist
-        x, elev_type = self.x, self.elev_type
-        start_node= self.start_node
-        end_node = self.end_node
-        
-        toEval.add(start_node)
-   
-        for node in G.nodes():
-            costToStart[node] = float("inf")
-        
-        costToStart[start_node] = 0 
-
-        for node in G.nodes():
-            costToStart1[node] = float("inf")
-        costToStart1[start_node] = 0
-
-        final_score[start_node] = G.nodes[start_node]['dist_from_dest']*0.1
-        
-        while len(toEval):
-            curr_node = min([(node,final_score[node]) for node in toEval], key=lambda t: t[1])[0]            
+        R, min_dist = self.get_routing_graph(), query.shortest_dist
+        x, elev_type = query.x, query.elev_type
+        start_node = R.index[query.start_node]
+        end_node = R.index[query.end_node]
+        max_dist = (1+x)*min_dist
+        heuristic = self.get_heuristic(query)
+        # Lower bounds on the gain still to come, with landmarks. Maximize minimizes drops only as a stand-in for
+        # gain, and a drop bound would steer it to flatter routes, so it goes without.
+        elevation = heuristic.elevation_bounds(elev_type) if elev_type == "minimize" else None
+
+        evaluated = set() #evaluated node set
+        best_node = {start_node : -1} # best cost to end
+        costToStart = {start_node : 0.0} # elevation cost of node to start node
+        costToStart1 = {start_node : 0.0} # distance of node to start node
+        final_score = {start_node : heuristic(start_node)*0.1 + (elevation[start_node] if elevation else 0.0)} # dist between start node and end node thru a particular node
+        toEval = [(final_score[start_node], start_node)] # heap of nodes that are not evaluated
+
+        while toEval:
+            score, curr_node = heappop(toEval)
+            if curr_node in evaluated or score > final_score[curr_node]:
+                continue # stale heap entry
             if curr_node == end_node:
-                self.retrace_path(best_node, curr_node)
-                return
-            
-            toEval.remove(curr_node)
+                if curr_node != start_node:
+                    query.best = self.route_best(self.get_route(best_node, curr_node))
+                return query.best
+
             evaluated.add(curr_node)
-            for n in G.neighbors(curr_node):
+            query.expanded += 1
+            if query.expanded & 255 == 0 and query.expired():
+                return
+            for n, edge_len, gain, drop in R.edges(curr_node):
                 if n in evaluated: 
                     continue 
                 if elev_type == "minimize":
-                    pred_costToStart = costToStart[curr_node] + self.get_cost(curr_node, n, "elevation_gain")
+                    pred_costToStart = costToStart[curr_node] + gain
                 elif elev_type == "maximize":
-                    pred_costToStart = costToStart[curr_node] + self.get_cost(curr_node, n, "elevation_drop")
+                    pred_costToStart = costToStart[curr_node] + drop
 
-                pred_costToStart1 = costToStart1[curr_node] + self.get_cost(curr_node, n, "normal")
+                pred_costToStart1 = costToStart1[curr_node] + edge_len
 
-                if n not in toEval and pred_costToStart1<=(1+x)*min_dist:# Discover a new node
-                    toEval.add(n)
-                else: 
-                    if (pred_costToStart >= costToStart[n]) or (pred_costToStart1>=(1+x)*min_dist):
-                        continue 
+                if not heuristic.can_reach(n, pred_costToStart1, max_dist):
+                    continue
+                if n not in costToStart: # Discover a new node
+                    if pred_costToStart1 > max_dist:
+                        continue
+                elif (pred_costToStart >= costToStart[n]) or (pred_costToStart1 >= max_dist):
+                    continue
 
                 best_node[n] = curr_node
                 costToStart[n] = pred_costToStart
                 costToStart1[n] = pred_costToStart1
-                final_score[n] = costToStart[n] + G.nodes[n]['dist_from_dest']*0.1
+                final_score[n] = costToStart[n] + heuristic(n)*0.1 + (elevation[n] if elevation else 0.0)
+                heappush(toEval, (final_score[n], n))
+                query.relaxed += 1
+                query.heap_peak = max(query.heap_peak, len(toEval))
+
+
+
+    def on_path(self, labels, label, node, floor, depth = 32):
+        # True if node is one of the last depth nodes on the route of label. Lengths only grow along a route,
+        # so the walk up the parents also stops once it is shorter than floor, the shortest distance from the start to node.
+        node_of, length_of, parent_of = labels
+        while label != -1 and length_of[label] >= floor and depth:
+            if node_of[label] == node:
+                return True
+            label = parent_of[label]
+            depth -= 1
+        return False
+
+
+    def pareto_search(self, query, first = False):
+        # Label setting search for elevation routes no longer than (1+x)*shortest.
+        # Every node keeps a Pareto set of (length, elevation gain) labels. A label is dropped when another
+        # one at the node is no longer (within length_bucket) and has as good a gain (within label_bucket),
+        # and when even the exact remaining distance to the end (a reverse Dijkstra) takes it past the limit.
+        # Returns the routes (as positions) of the labels that reached the end as (length, gain, route)
+        # tuples, or None when the deadline passed. With first, minimize stops at the first one popped,
+        # which has the least gain since labels are popped in order of gain (plus a consistent bound on the gain to come).
+        R = self.get_routing_graph()
+        start, end = R.index[query.start_node], R.index[query.end_node]
+        max_dist = (1.0+query.x)*query.shortest_dist
+        maximize = query.elev_type == "maximize"
+        bucket, slack = self.label_bucket, self.length_bucket*max_dist
+        remaining = self.destination_tree(end)[0].tolist()
+        # maximizing gain would walk around loops, so routes may not visit a node twice; short loops are
+        # cut off during the search and routes with longer ones are dropped at the end
+        reach = R.shortest_lengths(start, cutoff = max_dist)[0].tolist() if maximize else None
+        # when minimizing, labels are popped by gain plus a landmark lower bound on the gain still to come (A* order)
+        potential = self.get_heuristic(query).elevation_bounds("minimize") if not maximize else None
+
+        node_of, length_of, gain_of, parent_of = [start], [0.0], [0.0], [-1]
+        alive = [True]
+        front = {start : [0]}
+        heap = [(0.0, 0.0, 0)] # (gain when minimizing or length when maximizing, length, label)
+        found = []
+        while heap:
+            _, length, label = heappop(heap)
+            if not alive[label]:
+                continue
+            query.expanded += 1
+            if query.expanded & 255 == 0 and query.expired():
+                return None
+            node = node_of[label]
+            if node == end:
+                found.append(label)
+                if first and not maximize:
+                    break
+                continue
+            gain = gain_of[label]
+            for n, edge_len, edge_gain, _ in R.edges(node):
+                nxt_length = length + edge_len
+                if nxt_length + remaining[n] > max_dist:
+                    continue
+                nxt_gain = gain + edge_gain
+
+                # the end node keeps its whole Pareto front, one route per length limit for sweep
+                labels, dominated, near = front.get(n, []), False, slack if n != end else 0.0
+                for other in labels:
+                    if length_of[other] <= nxt_length + near and (gain_of[other] >= nxt_gain - bucket if maximize else gain_of[other] <= nxt_gain + bucket):
+                        dominated = True
+                        break
+                if dominated:
+                    continue
+                if maximize and self.on_path((node_of, length_of, parent_of), label, n, reach[n] - 1e-6):
+                    continue
+                keep = []
+                for other in labels:
+                    if nxt_length <= length_of[other] + near and (nxt_gain >= gain_of[other] if maximize else nxt_gain <= gain_of[other]):
+                        alive[other] = False
+                    else:
+                        keep.append(other)
+
+                new = len(node_of)
+                node_of.append(n)
+                length_of.append(nxt_length)
+                gain_of.append(nxt_gain)
+                parent_of.append(label)
+                alive.append(True)
+                keep.append(new)
+                front[n] = keep
+                heappush(heap, (nxt_length if maximize else nxt_gain + (potential[n] if potential else 0.0), nxt_length, new))
+                query.relaxed += 1
+                query.heap_peak = max(query.heap_peak, len(heap))
+
+        routes = []
+        for label in found:
+            if not alive[label]:
+                continue
+            route, curr = [], label
+            while curr != -1:
+                route.append(node_of[curr])
+                curr = parent_of[curr]
+            if len(set(route)) < len(route):
+                continue # a loop longer than on_path looks back
+            routes.append((length_of[label], gain_of[label], route[::-1]))
+        return routes
+
+
+    def constrained(self, query = None):
+        # Search for the most (maximize) or least (minimize) elevation gain within the length limit, from the
+        # Pareto labels of pareto_search. Approximate: besides the buckets, dominance ignores that routes may not
+        # visit a node twice, so a label can be dropped for one that could only go on by looping back. The result goes to query.best.
+        if query is None:
+            return self.own_query(self.constrained)
+        if not self.check_nodes(query) :
+            return
+        routes = self.pareto_search(query, first = True)
+        if not routes:
+            return
+        best = None
+        for length, gain, route in routes:
+            if best is None or self.better((None, length, gain), (None, best[0], best[1]), query.elev_type):
+                best = (length, gain, route)
+        if len(best[2]) > 1:
+            query.best = self.route_best(best[2])
+        return query.best
 
 
+    def get_shortest_path(self, startpt, endpt, x, elev_type = "maximize", log=True, budget=None, info=None, nodes=None):
+        
+        # Calculates shortest path. budget overrides the per-request time budget in seconds;
+        # info, when given a dict, receives which engine produced the route and per-engine statistics.
+        # nodes are the (start_node, end_node) startpt and endpt snap to, when the caller already snapped them.
+        info = info if info is not None else {}
 
+        #get shortest path
+        if nodes is None:
+            with stage(info, "snap"):
+                nodes, _ = self.get_index().nearest_many([startpt, endpt])
+        start_node, end_node = nodes
+
+        # Routes are cached on the snapped endpoints, the x bucket and the objective
+        if self.cache is None:
+            return self.search(start_node, end_node, x, elev_type, log, budget, info)
+        key = self.cache.key(start_node, end_node, x, elev_type)
+        with stage(info, "cache"):
+            result = self.cache.get(key)
+        if result is not None:
+            info["engine"] = "cache"
+            if log:
+                print("Route served from cache")
+            return result
+        result = self.search(start_node, end_node, self.cache.bucket(x), elev_type, log, budget, info)
+        if not info.get("timed_out"):
+            self.cache.put(key, result, generation = self.generation)
+        return result
+
+
+    def get_shortest_paths(self, startpt, endpt, xs, elev_type = "maximize", log=True, budget=None, info=None):
+        # Best elevation route for every tolerance in xs (percent) from a single search, e.g. to prefetch
+        # the whole slider. Returns shortestPathStats and a list with one [route, dist, gain, drop] per x,
+        # in the shape get_shortest_path returns. The sweep is approximate (see sweep), so its routes are
+        # cached under sweep keys of their own and get_shortest_path never serves them.
+        info = info if info is not None else {}
+        (start_node, end_node), _ = self.get_index().nearest_many([startpt, endpt])
+        if self.cache is None:
+            return self.sweep(start_node, end_node, list(xs), elev_type, log, budget, info)
+        keys = [self.cache.key(start_node, end_node, x, elev_type, sweep = True) for x in xs]
+        with stage(info, "cache"):
+            cached = [self.cache.get(key) for key in keys]
+        if cached and all(value is not None for value in cached):
+            info["engine"] = "cache"
+            return cached[0][0], [value[1] for value in cached]
+        shortestPathStats, routes = self.sweep(start_node, end_node, [self.cache.bucket(x) for x in xs], elev_type, log, budget, info)
+        if shortestPathStats is None or info.get("timed_out"):
+            return shortestPathStats, routes
+        for key, route in zip(keys, routes):
+            self.cache.put(key, (shortestPathStats, route), generation = self.generation)
+        return shortestPathStats, routes
+
+
+    def sweep(self, start_node, end_node, xs, elev_type = "maximize", log=True, budget=None, info=None, tree=None):
+        # One constrained search at the largest x; the Pareto labels that reach the end node hold the
+        # best route for every smaller length limit as well. With a length_bucket the labels are pruned with the
+        # slack of the largest limit, so the routes for smaller ones can be worse than search finds for them. tree is the shortest path tree of start_node
+        # (RoutingGraph.shortest_lengths) when it is shared by several queries from the same origin.
+        info = info if info is not None else {}
+        R = self.get_routing_graph()
+        route, shortest_dist = self.shortest_route(R.index[start_node], R.index[end_node], tree)
+        if route is None:
+            return None, None
+        shortestPathStats = [R.coordinates(R.expand(route))] + list(R.route_stats(route))
+        if not xs or max(xs) == 0:
+            info["engine"] = "shortest"
+            return shortestPathStats, [shortestPathStats for x in xs]
+
+        budget = budget if budget is not None else self.budget
+        deadline = time.time() + budget if budget is not None else None
+        query = Query(start_node, end_node, max(xs)/100.0, elev_type, shortest_dist, deadline)
+        start_time = time.time()
+        labels = self.pareto_search(query)
+        info["seconds"] = {"constrained" : time.time() - start_time}
+        info["expanded"] = {"constrained" : query.expanded}
+        info["relaxed"] = {"constrained" : query.relaxed}
+        info["heap_peak"] = {"constrained" : query.heap_peak}
+        info["timed_out"] = labels is None
+        info["engine"] = "constrained"
+        if log:
+            print("Sweep of %d tolerances: %d routes at the end node in %.3f seconds" % (len(xs), len(labels or ()), info["seconds"]["constrained"]))
+
+        routes, converted = [], {}
+        for x in xs:
+            best = None
+            for i, (length, gain, _) in enumerate(labels or ()):
+                if length <= (1.0 + x/100.0)*shortest_dist and (best is None or self.better((None, length, gain), (None, labels[best][0], labels[best][1]), elev_type)):
+                    best = i
+            if x == 0 or best is None:
+                routes.append(shortestPathStats)
+                continue
+            if best not in converted:
+                converted[best] = [R.coordinates(R.expand(labels[best][2]))] + list(R.route_stats(labels[best][2]))
+            found = converted[best]
+            # Same rule as search: never worse than the shortest path
+            if (elev_type == "maximize" and found[2] < shortestPathStats[2]) or (elev_type == "minimize" and found[2] > shortestPathStats[2]):
+                found = shortestPathStats
+            routes.append(found)
+        return shortestPathStats, routes
+
+
+    def get_executor(self):
+        # Worker pool shared by all queries, created on first use.
+        with self.lock:
+            return self.create_executor()
+
+
+    def create_executor(self):
+        # get_executor with self.lock held. Sequential searches get no pool.
+        if self.executor is not None or self.search_mode == "sequential":
+            return self.executor
+        if self.search_mode == "process":
+            if self.store_path is None:
+                raise ValueError("process search mode needs the graph store path")
+            self.executor = ProcessPoolExecutor(max_workers = len(ENGINES), initializer = worker_init, initargs = self.worker_args())
+        else:
+            self.executor = ThreadPoolExecutor(max_workers = 4*len(ENGINES))
+        return self.executor
+
+
+    def run_engine(self, engine, query):
+        getattr(self, engine)(query)
+        return query
 
-    def get_shortest_path(self, startpt, endpt, x, elev_type = "maximize", log=True):
-        
-        # Calculates shortest path
-        G = self.G
-        self.x = x/100.0
-        self.elev_type = elev_type
-        self.start_node, self.end_node = None, None
 
-        #self.best = [path, totalDist, totalElevGain, totalElevDrop]
-        if elev_type == "maximize": 
-            self.best = [[], 0.0, float('-inf'), float('-inf')]
+    def run_engines(self, query, shortestPathStats, info, log):
+        # Runs every engine on its own copy of the query. Returns the finished queries by engine name.
+        results = {}
+        if self.search_mode == "sequential":
+            for engine in ENGINES:
+                q = query.copy()
+                start_time = time.time()
+                getattr(self, engine)(q)
+                info.setdefault("seconds", {})[engine] = time.time() - start_time
+                results[engine] = q
+                if log:
+                    print()
+                    print("%s route statistics" % ENGINE_NAMES[engine])
+                    print(q.best[1])
+                    print(q.best[2])
+                    print(q.best[3])
+                    print("--- Time taken = %s seconds ---" % (time.time() - start_time))
+            # only searches cut short count; one that finished just after the deadline is complete
+            info["timed_out"] = any(q.timed_out for q in results.values())
+            return results
+
+        executor = self.get_executor()
+        start_time = time.time()
+        if self.search_mode == "process":
+            futures = {executor.submit(worker_run, engine, query.copy()) : engine for engine in ENGINES}
         else:
-            self.best = [[], 0.0, float('inf'), float('-inf')]
+            futures = {executor.submit(self.run_engine, engine, query.copy()) : engine for engine in ENGINES}
+        pending = set(futures)
+        while pending:
+            timeout = None if query.deadline is None else max(0.0, query.deadline - time.time())
+            done, pending = wait(pending, timeout = timeout, return_when = FIRST_COMPLETED)
+            if not done:
+                break # deadline passed
+            for future in done:
+                engine = futures[future]
+                results[engine] = future.result()
+                info.setdefault("seconds", {})[engine] = time.time() - start_time
+                if self.first_acceptable and self.acceptable(results[engine].best, shortestPathStats, query.elev_type):
+                    pending = set()
+        info["timed_out"] = bool(pending)
+        if log and pending:
+            print("Deadline reached before %s finished" % ", ".join(ENGINE_NAMES[futures[f]] for f in pending))
+        return results
+
+
+    def acceptable(self, route, shortestPathStats, elev_type):
+        # A found route that is at least as good as the shortest path for the elevation objective.
+        if not route[0]:
+            return False
+        if elev_type == "maximize":
+            return route[2] >= shortestPathStats[2]
+        return route[2] <= shortestPathStats[2]
 
-        #get shortest path
-        self.start_node, d1 = ox.get_nearest_node(G, point=startpt, return_dist = True)
-        self.end_node, d2   = ox.get_nearest_node(G, point=endpt, return_dist = True)
+
+    def search(self, start_node, end_node, x, elev_type = "maximize", log=True, budget=None, info=None):
+        # Shortest and elevation routes between two snapped nodes, with all search state in a Query
+        info = info if info is not None else {}
+        R = self.get_routing_graph()
 
         # returns the shortest route from start to end based on distance
-        self.shortest_route = nx.shortest_path(G, source=self.start_node, target=self.end_node, weight='length')
-        
-        # ox.get_route function returns list of edge length for above route
-        self.shortest_dist  = sum(ox.get_route_edge_attributes(G, self.shortest_route, 'length'))
-        
-        shortest_route_latlong = [[G.nodes[route_node]['x'],G.nodes[route_node]['y']] for route_node in self.shortest_route] 
-        
-        shortestPathStats = [shortest_route_latlong, self.shortest_dist, \
-                            self.get_Elevation(self.shortest_route, "elevation_gain"), self.get_Elevation(self.shortest_route, "elevation_drop")]
+        with stage(info, "shortest_path"):
+            route, shortest_dist = self.shortest_route(R.index[start_node], R.index[end_node])
+        if route is None:
+            return None, None
+        with stage(info, "route_stats"):
+            shortestPathStats = [R.coordinates(R.expand(route))] + list(R.route_stats(route))
 
         
         if(x == 0):
+            info["engine"] = "shortest"
             return shortestPathStats, shortestPathStats
 
-        start_time = time.time()
-        self.dijkstra()
-        end_time = time.time()
-        dijkstra_route = self.best
-        if log:
-            print()
-            print("Dijkstra route statistics")
-            print(dijkstra_route[1])
-            print(dijkstra_route[2])
-            print(dijkstra_route[3])
-            print("--- Time taken = %s seconds ---" % (end_time - start_time))
-
-        if elev_type == "maximize": 
-            self.best = [[], 0.0, float('-inf'), float('-inf')]
-        else:
-            self.best = [[], 0.0, float('inf'), float('-inf')]
-
-        start_time = time.time()
-        self.a_star()
-        end_time = time.time()
-        a_star_route = self.best
-        if log:
+        budget = budget if budget is not None else self.budget
+        deadline = time.time() + budget if budget is not None else None
+        query = Query(start_node, end_node, x/100.0, elev_type, shortest_dist, deadline)
+
+        with stage(info, "search"):
+            results = self.run_engines(query, shortestPathStats, info, log)
+        info["expanded"] = {engine : q.expanded for engine, q in results.items()}
+        info["relaxed"] = {engine : q.relaxed for engine, q in results.items()}
+        info["heap_peak"] = {engine : q.heap_peak for engine, q in results.items()}
+
+        # Later engines win ties, so with the default order A* is kept unless Dijkstra is strictly better
+        best, winner = query.best, None
+        for engine in ENGINES:
+            if engine in results and (winner is None or not self.better(best, results[engine].best, elev_type)):
+                best, winner = results[engine].best, engine
+        info["engine"] = winner
+        if log and winner is not None:
             print()
-            print("A star route statistics")
-            print(a_star_route[1])
-            print(a_star_route[2])
-            print(a_star_route[3])
-            print("--- Time taken = %s seconds ---" % (end_time - start_time))
-
+            print("%s chosen as best route" % ENGINE_NAMES[winner])
             print()
 
-        if self.elev_type == "maximize":
-            if (dijkstra_route[2] > a_star_route[2]) or (dijkstra_route[2] == a_star_route[2] and dijkstra_route[1] < a_star_route[1]):
-                self.best = dijkstra_route
-                if log:
-                    print("Dijkstra chosen as best route")
-                    print()
-            else:
-                self.best = a_star_route
-                if log:
-                    print("A star chosen as best route")
-                    print()
-        else:
-            if (dijkstra_route[2] < a_star_route[2]) or (dijkstra_route[2] == a_star_route[2] and dijkstra_route[1] < a_star_route[1]):
-                self.best = dijkstra_route
-                if log:
-                    print("Dijkstra chosen as best route")
-                    print()
-            else:
-                self.best = a_star_route
-                if log:
-                    print("A star chosen as best route")
-                    print()
+        # Out of time before any engine found a route: the shortest path is the best known route
+        if info.get("timed_out") and not best[0]:
+            info["engine"] = "shortest"
+            return shortestPathStats, shortestPathStats
 
         # If dijkstra or A-star doesn't return a shortest path based on elevation requirements
-        if (self.elev_type == "maximize" and self.best[2] == float('-inf')) or (self.elev_type == "minimize" and self.best[3] == float('-inf')):            
+        if (elev_type == "maximize" and best[2] == float('-inf')) or (elev_type == "minimize" and best[3] == float('-inf')):            
+            info["engine"] = None
             return shortestPathStats, [[], 0.0, 0, 0]
         
-        self.best[0] = [[G.nodes[route_node]['x'],G.nodes[route_node]['y']] for route_node in self.best[0]]
+        with stage(info, "route_stats"):
+            best = [self.to_latlong(best[0])] + best[1:]
 
         # If the elevation path does not match the elevation requirements
-        if((self.elev_type == "maximize" and self.best[2] < shortestPathStats[2]) or (self.elev_type == "minimize" and self.best[2] > shortestPathStats[2])):
-            self.best = shortestPathStats
+        if((elev_type == "maximize" and best[2] < shortestPathStats[2]) or (elev_type == "minimize" and best[2] > shortestPathStats[2])):
+            info["engine"] = "shortest"
+            best = shortestPathStats
 
-        return shortestPathStats, self.best
+        return shortestPathStats, best
@@ -0,0 +1,131 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from Elena.control import algorithms
+
+
+def parse_query(query):
+    # (start, end, x, min_max) from a /route request body or from a tuple of the same four values.
+    if isinstance(query, dict):
+        return ((query['start_location']['lat'], query['start_location']['lng']),
+                (query['end_location']['lat'], query['end_location']['lng']), query['x'], query['min_max'])
+    start, end, x, min_max = query
+    return tuple(start), tuple(end), x, min_max
+
+
+def route_origin(A, start_node, items, log = False):
+    # Routes queries that share an origin: one shortest path tree for all of them and one sweep per
+    # destination and objective for all of its percentages. items are (id, end_node, x, min_max) with
+    # x already bucketed. Returns (id, shortestPathStats, elevation route, timed_out) per query, timed_out when the
+    # sweep ran out of its time budget and the route is only the shortest path or the best found so far.
+    R = A.get_routing_graph()
+    tree = R.shortest_lengths(R.index[start_node])
+    groups = OrderedDict()
+    for i, end_node, x, min_max in items:
+        groups.setdefault((end_node, min_max), []).append((i, x))
+    results = []
+    for (end_node, min_max), queries in groups.items():
+        info = {}
+        shortest, routes = A.sweep(start_node, end_node, [x for _, x in queries], min_max, log = log, info = info, tree = tree)
+        for n, (i, _) in enumerate(queries):
+            results.append((i, shortest, routes[n] if routes is not None else None, bool(info.get("timed_out"))))
+    return results
+
+
+def worker_route_origin(start_node, items):
+    # Process pool task, run on the worker's own Algorithms over the shared graph store.
+    return route_origin(algorithms.worker, start_node, items)
+
+
+class BatchRouter:
+    # Routes many (start, end, x, min_max) queries at once. All points are snapped in one call,
+    # queries are grouped by origin and the groups are spread over a process pool whose workers
+    # map the same read-only graph store. Results are yielded as they complete.
+    def __init__(self, A, mode = "process", workers = None, chunk = 64):
+        self.A = A
+        self.mode = mode # "process", or "sequential" to route in this process
+        self.workers = workers # defaults to the number of CPUs
+        self.chunk = chunk # most destinations sent to a worker in one task
+        self.executor = None
+        self.state = None # graph updates the pool's workers were started with
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def submit(self, A, tasks):
+        # Submits tasks to the worker pool, created on first use and kept for later batches until an update changes
+        # the graph. The old pool is shut down then; its queued tasks still run, and since tasks are only submitted
+        # here, under the lock, nothing is submitted to it afterwards.
+        with self.lock:
+            if self.executor is None or self.state is not A.state:
+                if self.executor is not None:
+                    self.executor.shutdown(wait = False)
+                self.executor = ProcessPoolExecutor(max_workers = self.workers or os.cpu_count(), initializer = algorithms.worker_init,
+                                                    initargs = A.worker_args())
+                self.state = A.state
+            futures = [self.executor.submit(worker_route_origin, start_node, items) for start_node, items in tasks]
+            if self.closed:
+                # a batch that started before close: its pool stops once these tasks are done
+                self.executor.shutdown(wait = False)
+                self.executor = None
+            return futures
+
+    def close(self):
+        # Shuts the worker pool down, e.g. when its region is evicted. Batches already submitted still finish.
+        with self.lock:
+            self.closed = True
+            if self.executor is not None:
+                self.executor.shutdown(wait = False)
+                self.executor = None
+
+    def result(self, i, shortest, route, routes = False, timed_out = False):
+        # One output record, with the numbers of get_data and optionally the [long, lat] coordinates.
+        # "timed_out" marks a route from a search that ran out of its time budget.
+        if shortest is None:
+            return {"id" : i, "error" : "no route"}
+        data = {"id" : i, "shortDist" : shortest[1], "gainShort" : shortest[2], "dropShort" : shortest[3],
+                "elenavDist" : route[1], "gainElenav" : route[2], "dropElenav" : route[3]}
+        if timed_out:
+            data["timed_out"] = True
+        if routes:
+            data["shortest_route"] = shortest[0]
+            data["elevation_route"] = route[0]
+        return data
+
+    def run(self, queries, routes = False, log = False):
+        # Yields one result dict per query, with its position in queries as "id", in completion order.
+        A = self.A.pinned()
+        parsed = [parse_query(query) for query in queries]
+        if not parsed:
+            return
+        nodes, _ = A.get_index().nearest_many([point for query in parsed for point in query[:2]])
+
+        # Cached routes are answered straight away, the rest is grouped by origin. Batches are routed by sweeps,
+        # which are approximate (see Algorithms.sweep), so their routes are cached under sweep keys; routes of a
+        # full search are used when cached as well.
+        origins, keys = OrderedDict(), {}
+        for i, (_, _, x, min_max) in enumerate(parsed):
+            start_node, end_node = nodes[2*i], nodes[2*i+1]
+            if A.cache is not None:
+                keys[i] = A.cache.key(start_node, end_node, x, min_max, sweep = True)
+                route_key = A.cache.key(start_node, end_node, x, min_max)
+                cached = A.cache.get(route_key if route_key in A.cache else keys[i])
+                if cached is not None:
+                    yield self.result(i, cached[0], cached[1], routes)
+                    continue
+                x = A.cache.bucket(x)
+            origins.setdefault(start_node, []).append((i, end_node, x, min_max))
+
+        tasks = [(start_node, items[k:k+self.chunk]) for start_node, items in origins.items() for k in range(0, len(items), self.chunk)]
+        if self.mode == "process" and A.store_path is not None and len(tasks) > 1:
+            done = as_completed(self.submit(A, tasks))
+            batches = (future.result() for future in done)
+        else:
+            batches = (route_origin(A, start_node, items, log) for start_node, items in tasks)
+
+        # Routes cut short by the time budget, and missing ones, are not cached, so a later request searches again
+        for batch in batches:
+            for i, shortest, route, timed_out in batch:
+                if A.cache is not None and shortest is not None and not timed_out:
+                    A.cache.put(keys[i], (shortest, route), generation = A.generation)
+                yield self.result(i, shortest, route, routes, timed_out)
@@ -0,0 +1,236 @@
+import os
+import time
+import hashlib
+import threading
+import weakref
+import pickle as p
+from collections import OrderedDict
+
+
+def copied(value):
+    # Copy of the lists and tuples in a cached value, e.g. a route and its coordinates, so callers can change
+    # what they are given without changing the cache. Numbers and strings are shared.
+    if isinstance(value, list):
+        return [copied(item) for item in value]
+    if isinstance(value, tuple):
+        return tuple(copied(item) for item in value)
+    return value
+
+
+class FileCacheBackend:
+    # Shared cache stand-in for multi-worker deployments: one pickle file per key in a directory.
+    # Every worker pointed at the same directory sees the others' routes.
+    # The directory is only listed every prune_every puts, so it can hold up to that many files (per worker) over max_entries.
+    def __init__(self, directory, max_entries = 10000, prune_every = 100):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self.puts = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok = True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".p")
+
+    def get(self, key):
+        # Returns the cached value or None when missing or expired.
+        try:
+            with open(self.path(key), "rb") as f:
+                expires, value = p.load(f)
+        except (OSError, EOFError, p.UnpicklingError):
+            return None
+        if expires is not None and expires < time.time():
+            return None
+        return value
+
+    def put(self, key, value, ttl = None):
+        path = self.path(key)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            p.dump((None if ttl is None else time.time() + ttl, value), f)
+        os.replace(tmp, path)
+        with self.lock:
+            self.puts += 1
+            due = self.puts % self.prune_every == 0
+        if due:
+            self.prune()
+
+    def prune(self):
+        # Drops the oldest files once the directory holds more than max_entries.
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".p")]
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key = os.path.getmtime)
+        for path in files[:len(files) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def discard(self, predicate):
+        # Removes the entries whose value matches predicate.
+        for name in os.listdir(self.directory):
+            if not name.endswith(".p"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "rb") as f:
+                    _, value = p.load(f)
+                if predicate(value):
+                    os.remove(path)
+            except (OSError, EOFError, p.UnpicklingError):
+                pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".p"):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+class RouteCache:
+    # In-process LRU cache of get_shortest_path results with an optional TTL (seconds)
+    # and an optional shared backend behind it. Safe to use from several threads.
+    # Values are copied on the way in and out, so neither the caller that cached a route nor the ones given it can change it.
+    def __init__(self, maxsize = 1024, ttl = None, x_bucket = 1.0, backend = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.x_bucket = x_bucket # width of an x bucket, in percent
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.generation = 0 # bumped whenever entries are invalidated
+
+    def bucket(self, x):
+        # Rounds x down to its bucket, so a cached route never exceeds the requested tolerance.
+        if not self.x_bucket:
+            return x
+        return int(x // self.x_bucket) * self.x_bucket
+
+    def key(self, start_node, end_node, x, elev_type, sweep = False):
+        # sweep keys hold the approximate routes of a sweep apart from the routes of a full search
+        key = (start_node, end_node, self.bucket(x), elev_type)
+        return key + ("sweep",) if sweep else key
+
+    def get(self, key):
+        # Returns the cached value for key, or None on a miss.
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] >= time.time()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+            elif entry is not None:
+                del self.entries[key]
+                entry = None
+        if entry is not None:
+            return copied(entry[1])
+        value = self.backend.get(key) if self.backend is not None else None
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.put(key, value, shared = False)
+        return value
+
+    def __contains__(self, key):
+        # Whether key is cached and not expired, without counting a hit or a miss.
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] >= time.time()):
+                return True
+        return self.backend is not None and self.backend.get(key) is not None
+
+    def put(self, key, value, shared = True, generation = None):
+        # generation is self.generation when the route was computed; routes from before an invalidation are dropped.
+        expires = None if self.ttl is None else time.time() + self.ttl
+        stored = copied(value)
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (expires, stored)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+        if shared and self.backend is not None:
+            self.backend.put(key, value, self.ttl)
+
+    def clear(self):
+        # Drops every entry, here and in the shared backend. Called when the graph is reloaded.
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+        if self.backend is not None:
+            self.backend.clear()
+
+    def discard(self, predicate):
+        # Drops the entries whose value matches predicate, here and in the shared backend. Returns how many were here.
+        with self.lock:
+            keys = [key for key, (_, value) in self.entries.items() if predicate(value)]
+            for key in keys:
+                del self.entries[key]
+            self.generation += 1
+        if self.backend is not None:
+            self.backend.discard(predicate)
+        return len(keys)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"size" : len(self.entries), "maxsize" : self.maxsize, "hits" : self.hits, "misses" : self.misses,
+                    "evictions" : self.evictions, "hit_rate" : self.hits / total if total else 0.0}
+
+
+class ReverseTreeCache:
+    # LRU cache of reverse shortest path trees, RoutingGraph.shortest_lengths(end, reverse = True), per routing graph
+    # and end position. Popular destinations get their exact remaining distances and shortest routes without a
+    # Dijkstra. Bounded by the bytes of the arrays held rather than a count, since a tree is as large as the graph.
+    # Entries only hold a weak reference to their graph, so a replaced graph is not kept alive. Safe to use from several threads.
+    def __init__(self, max_bytes = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # (id of graph, end) -> (weak reference to graph, tree, bytes)
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, R, end):
+        # Returns the (distance, predecessor) arrays towards position end of R, or None on a miss.
+        with self.lock:
+            entry = self.entries.get((id(R), end))
+            if entry is not None and entry[0]() is R:
+                self.entries.move_to_end((id(R), end))
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, R, end, tree):
+        size = sum(a.nbytes for a in tree)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop((id(R), end), None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self.entries[(id(R), end)] = (weakref.ref(R), tree, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, _, dropped) = self.entries.popitem(last = False)
+                self.nbytes -= dropped
+                self.evictions += 1
+
+    def clear(self):
+        # Drops every tree. Called when the graph is updated.
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"size" : len(self.entries), "bytes" : self.nbytes, "max_bytes" : self.max_bytes, "hits" : self.hits,
+                    "misses" : self.misses, "evictions" : self.evictions, "hit_rate" : self.hits / total if total else 0.0}
@@ -1,11 +1,10 @@
 import os
-import requests
-import geopy
-from flask import Flask, jsonify, session, g, request, url_for, flash, redirect,abort,render_template
-from geopy.geocoders import Nominatim
+from flask import Flask, jsonify, session, g, request, url_for, flash, redirect,abort,render_template,Response
 import json
-from Elena.abstraction.abstraction import Graph_Abstraction
-from Elena.control.algorithms import Algorithms
+import time
+from Elena.control.service import get_service, warm_up
+from Elena.control.metrics import metrics, stage, profiled
+from Elena.control import encoding
 from Elena.control.settings import *
 
 
@@ -16,8 +15,12 @@ app.config.from_envvar('APP_CONFIG_FILE', silent=True)
 
 MAPBOX_ACCESS_KEY = MAPBOX_KEY
 
-init = False
-G, M, algorithms = None, None, None
+def create_app():
+    # The app for the start script and WSGI servers. Loads the graph when the app starts rather than on the first
+    # request; importing this module loads nothing, so tests and tools can import it without a graph.
+    if WARM_UP_ON_START:
+        warm_up()
+    return app
 
 def get_geojson(coordinates):
     geojson = {}
@@ -29,39 +32,54 @@ def get_geojson(coordinates):
 
     return geojson
 
-def get_data(startpt, endpt, x, min_max, log=True):
-    # gets data for plotting the routes. 
-    global init, G, M, algorithms
+class Snapped:
+    # A query snapped once per request: the pinned Algorithms it is routed on, its (start_node, end_node),
+    # its address labels once looked up, and the request's start time and stage timings so far.
+    def __init__(self, startpt, endpt):
+        self.start_time = time.perf_counter()
+        self.info = {}
+        self.points = (startpt, endpt)
+        self.addresses = None
+        self.algorithms = get_service().algorithms_for([startpt, endpt])
+        with stage(self.info, "snap"):
+            (start_node, end_node), _ = self.algorithms.get_index().nearest_many([startpt, endpt])
+        self.nodes = (start_node, end_node)
 
-    locator = Nominatim(user_agent="myGeocoder")
-    location = locator.reverse(startpt)
-    locate = location.address.split(',')
-    
-    len_location = len(locate)
+    def labels(self, geocoder = None):
+        # (start, end) address labels, looked up on the first call.
+        # They never wait on the network unless GEOCODER_MODE is "online".
+        if self.addresses is None:
+            with stage(self.info, "geocode"):
+                if geocoder is not None:
+                    self.addresses = tuple(geocoder.reverse(point) for point in self.points)
+                else:
+                    labels = get_service().labels
+                    self.addresses = tuple(labels.label(node, point) for node, point in zip(self.nodes, self.points))
+        return self.addresses
 
-    start = locate[0] + ',' + locate[1] + ',' + locate[2] + ',' + locate[len_location-5] + ',' + locate[len_location-3] + ', USA - ' + locate[len_location-2] 
-    if log:
-        print("Start: ",start)
-    
-    location = locator.reverse(endpt)
-    locate = location.address.split(',')
-    
-    len_location = len(locate)
+def get_data(startpt, endpt, x, min_max, log=True, geocoder=None, debug=False, profile=False, fmt="geojson", precision=5, zoom=None, snapped=None):
+    # gets data for plotting the routes. Safe to call from several threads at once.
+    # geocoder replaces the app's ReverseGeocoder for address labels, e.g. a stand-in in tests.
+    # debug adds a "debug" block with stage timings and search statistics; profile also adds a cProfile report.
+    # fmt, precision and zoom pick the route encoding and simplification, see Elena.control.encoding.
+    # snapped is the request's Snapped query when the caller already snapped the points.
+    if profile:
+        data, report = profiled(get_data, startpt, endpt, x, min_max, log, geocoder, True, False, fmt, precision, zoom, snapped)
+        data["debug"]["profile"] = report
+        return data
+    snapped = snapped if snapped is not None else Snapped(startpt, endpt)
+    start_time, info, algorithms = snapped.start_time, snapped.info, snapped.algorithms
 
-    end = locate[0] + ',' + locate[1] + ',' + locate[2] + ',' + locate[len_location-5] + ',' + locate[len_location-3] + ', USA - ' + locate[len_location-2]
-    if log:
-        print("End: ",end)
-    
     if log:
         print("Percent of Total path: ",x)
         print("Elevation: ",min_max)
-    if not init:
-        abstract = Graph_Abstraction()
-        G = abstract.get_graph(endpt)
-        algorithms = Algorithms(G, x = x, elev_type = min_max)
-        init = True
+
+    start, end = snapped.labels(geocoder)
+    if log:
+        print("Start: ",start)
+        print("End: ",end)
     
-    shortestPath, elevPath = algorithms.get_shortest_path(startpt, endpt, x, elev_type = min_max, log = log)   
+    shortestPath, elevPath = algorithms.get_shortest_path(startpt, endpt, x, elev_type = min_max, log = log, info = info, nodes = snapped.nodes)
     
     if shortestPath is None and elevPath is None:
         data = {"elevation_route" : [] , "shortest_route" : []}        
@@ -72,8 +90,12 @@ def get_data(startpt, endpt, x, min_max, log=True):
         data["gainElenav"] = 0
         data["dropElenav"] = 0
         data["popup_flag"] = 0 
-        return data
-    data = {"elevation_route" : get_geojson(elevPath[0]), "shortest_route" : get_geojson(shortestPath[0])}
+        return request_done(data, info, start_time, debug)
+    with stage(info, "geojson"):
+        data = {"elevation_route" : encoding.encode_route(elevPath[0], fmt, precision, zoom),
+                "shortest_route" : encoding.encode_route(shortestPath[0], fmt, precision, zoom)}
+    if fmt != "geojson":
+        data["format"], data["precision"] = fmt, precision
     data["shortDist"] = shortestPath[1]
     data["gainShort"] = shortestPath[2]
     data["dropShort"] = shortestPath[3]
@@ -86,7 +108,35 @@ def get_data(startpt, endpt, x, min_max, log=True):
         data["popup_flag"] = 1
     else: 
         data["popup_flag"] = 2    
+    return request_done(data, info, start_time, debug)
+
+def request_done(data, info, start_time, debug):
+    # Records the request in the metrics and adds the debug block when asked for.
+    total = time.perf_counter() - start_time
+    metrics.record(info, total)
+    if debug:
+        data["debug"] = dict(info, total = total)
     return data
+
+def get_sweep_data(startpt, endpt, xs, min_max, log=True):
+    # Elevation routes for every percentage in xs from one search, for prefetching the slider.
+    # Approximate at the smaller percentages; the routes are cached apart from /route results.
+    algorithms = get_service().algorithms_for([startpt, endpt])
+    shortestPath, elevPaths = algorithms.get_shortest_paths(startpt, endpt, xs, elev_type = min_max, log = log)
+    if shortestPath is None:
+        return {"shortest_route" : [], "routes" : []}
+    data = {"shortest_route" : get_geojson(shortestPath[0])}
+    data["shortDist"] = shortestPath[1]
+    data["gainShort"] = shortestPath[2]
+    data["dropShort"] = shortestPath[3]
+    data["routes"] = [{"x" : x, "elevation_route" : get_geojson(path[0]), "elenavDist" : path[1], "gainElenav" : path[2], "dropElenav" : path[3]}
+                      for x, path in zip(xs, elevPaths)]
+    return data
+
+def route_batch(queries, routes=False, log=False):
+    # Routes many (start, end, x, min_max) tuples or /route request bodies in one go, without address labels.
+    # Yields one dict per query as it completes; "id" is the query's position in queries.
+    return get_service().run_batch(queries, routes = routes, log = log)
     
 @app.route('/presentation')
 def presentation():    
@@ -96,8 +146,85 @@ def presentation():
         ACCESS_KEY=MAPBOX_ACCESS_KEY
     )
 
+def route_etag(snapped, x, min_max, options):
+    # ETag of a /route response: the route cache key of the snapped query, the cache generation, bumped whenever
+    # the graph changes, the response options and the address labels, which change once a background lookup resolves.
+    # Also returns whether the route is cached; when it is not, it would be searched again and the response can not be skipped.
+    cache = snapped.algorithms.cache
+    if cache is None:
+        return None, False
+    key = cache.key(snapped.nodes[0], snapped.nodes[1], x, min_max)
+    return encoding.etag(key, cache.generation, options, snapped.labels()), key in cache
+
 @app.route('/route',methods=['POST'])
 def get_route():  
     data=request.get_json(force=True)
-    route_data = get_data((data['start_location']['lat'],data['start_location']['lng']),(data['end_location']['lat'],data['end_location']['lng']),data['x'],data['min_max'])
-    return json.dumps(route_data)
+    # "debug" : true adds stage timings and search statistics to the response, "profile" : true a cProfile report as well
+    debug, profile = DEBUG_REQUESTS and bool(data.get('debug')), DEBUG_REQUESTS and bool(data.get('profile'))
+    # "format" : "polyline" or "delta" encodes the routes compactly, "zoom" simplifies them for that map zoom level
+    fmt, precision, zoom = data.get('format', ROUTE_FORMAT), data.get('precision', ROUTE_PRECISION), data.get('zoom')
+    if (fmt not in encoding.FORMATS or isinstance(precision, bool) or not isinstance(precision, int) or not 0 <= precision <= 7
+            or (zoom is not None and (isinstance(zoom, bool) or not isinstance(zoom, (int, float)) or not 0 <= zoom <= 30))):
+        return json.dumps({"error" : "format must be one of %s, precision an integer between 0 and 7 and zoom a number between 0 and 30"
+                           % ", ".join(encoding.FORMATS)}), 400
+    startpt, endpt = (data['start_location']['lat'],data['start_location']['lng']),(data['end_location']['lat'],data['end_location']['lng'])
+    # A client that sends back the ETag of a route it already has gets 304 without a body while the route is cached
+    snapped, tag = Snapped(startpt, endpt), None
+    if not (debug or profile):
+        tag, cached = route_etag(snapped, data['x'], data['min_max'], (fmt, precision, zoom))
+        if tag is not None and cached and tag in request.if_none_match:
+            response = Response(status = 304)
+            response.set_etag(tag)
+            return response
+    route_data = get_data(startpt,endpt,data['x'],data['min_max'],debug=debug,profile=profile,fmt=fmt,precision=precision,zoom=zoom,snapped=snapped)
+    response = Response(json.dumps(route_data, separators = (',', ':')) if fmt != "geojson" else json.dumps(route_data), mimetype='application/json')
+    if tag is not None:
+        response.set_etag(tag)
+    return response
+
+@app.route('/metrics')
+def get_metrics():
+    # Latency histograms per stage and engine, counters of winning engines and expansions, route cache, reverse tree cache
+    # and region statistics.
+    snapshot = metrics.snapshot()
+    routing = get_service()
+    snapshot["route_cache"] = routing.cache.stats()
+    snapshot["reverse_trees"] = routing.trees.stats()
+    if routing.regions is not None:
+        snapshot["regions"] = routing.regions.stats()
+    return json.dumps(snapshot)
+
+@app.route('/graph_update',methods=['POST'])
+def post_graph_update():
+    # Body: {"close_edges" : [[u, v], ...], "open_edges" : [...], "close_nodes" : [...], "open_nodes" : [...],
+    # "elevations" : {"node" : meters}} with OSM node ids. Applied without restarting; see Elena.abstraction.updates.
+    if not GRAPH_UPDATES:
+        abort(403)
+    try:
+        summary = get_service().apply_update(request.get_json(force=True))
+    except KeyError as e:
+        return json.dumps({"error" : "unknown node or edge %s" % (e,)}), 400
+    except ValueError as e:
+        return json.dumps({"error" : str(e)}), 400
+    return json.dumps(summary)
+
+@app.route('/route_sweep',methods=['POST'])
+def get_route_sweep():
+    # Same request as /route, with an optional "xs" list of percentages instead of "x".
+    data=request.get_json(force=True)
+    sweep_data = get_sweep_data((data['start_location']['lat'],data['start_location']['lng']),(data['end_location']['lat'],data['end_location']['lng']),data.get('xs', SWEEP_TOLERANCES),data['min_max'])
+    return json.dumps(sweep_data)
+
+@app.route('/route_batch',methods=['POST'])
+def get_route_batch():
+    # Body: a JSON list of /route request bodies, {"queries" : [...], "routes" : true} to include the
+    # coordinates, or NDJSON with one request per line. Results are streamed back as NDJSON.
+    body=request.get_data(as_text=True)
+    try:
+        data=json.loads(body)
+    except ValueError:
+        data=[json.loads(line) for line in body.splitlines() if line.strip()]
+    if isinstance(data, dict) and 'queries' not in data:
+        data=[data] # a single query, or NDJSON with one line
+    queries, routes = (data['queries'], data.get('routes', False)) if isinstance(data, dict) else (data, False)
+    return Response((json.dumps(result) + "\n" for result in route_batch(queries, routes)), mimetype='application/x-ndjson')
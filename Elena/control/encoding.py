@@ -0,0 +1,112 @@
+import math
+import hashlib
+import numpy as np
+
+# Compact encodings of route coordinates for /route. Routes are lists of [long, lat] as in GeoJSON.
+#   "geojson"  GeoJSON Feature with a LineString, the default
+#   "polyline" Google encoded polyline string (lat, long order, 1e-precision degrees)
+#   "delta"    flat list of integers [lat0, long0, dlat1, dlong1, ...] in 1e-precision degrees, each point relative to the one before
+# Routes can also be simplified with Douglas-Peucker to what is visible at a map zoom level.
+FORMATS = ("geojson", "polyline", "delta")
+EARTH_RADIUS = 6371008.8
+TILE_METERS = 2 * math.pi * 6378137.0 / 256 # meters per pixel at zoom 0 on the equator, web mercator
+
+
+def quantize(coordinates, precision = 5):
+    # (n, 2) int64 array of [lat, long] in 1e-precision degrees.
+    points = np.asarray(coordinates, dtype = np.float64).reshape(-1, 2)[:, ::-1]
+    return np.round(points * 10**precision).astype(np.int64)
+
+
+def delta_encode(coordinates, precision = 5):
+    ints = quantize(coordinates, precision)
+    if len(ints):
+        ints[1:] -= ints[:-1].copy()
+    return ints.ravel().tolist()
+
+
+def delta_decode(values, precision = 5):
+    # Back to [long, lat] lists.
+    ints = np.cumsum(np.asarray(values, dtype = np.int64).reshape(-1, 2), axis = 0)
+    return (ints[:, ::-1] / 10.0**precision).tolist()
+
+
+def encode_polyline(coordinates, precision = 5):
+    deltas = np.asarray(delta_encode(coordinates, precision), dtype = np.int64)
+    # zig-zag so the sign is in the lowest bit, then 5 bit chunks, lowest first, with 0x20 on all but the last
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1).tolist()
+    chars = []
+    for value in values:
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+    return "".join(chars)
+
+
+def decode_polyline(encoded, precision = 5):
+    values, value, shift = [], 0, 0
+    for char in encoded:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    return delta_decode(values, precision)
+
+
+def tolerance(zoom, lat, pixels = 0.5):
+    # Meters covered by pixels on a map at zoom around latitude lat. Detail below it is not visible.
+    return pixels * TILE_METERS * math.cos(math.radians(lat)) / 2**zoom
+
+
+def simplify_line(coordinates, tolerance):
+    # Douglas-Peucker: the points of coordinates ([long, lat]) needed to stay within tolerance meters of the route.
+    # The first and last points are always kept.
+    points = np.asarray(coordinates, dtype = np.float64).reshape(-1, 2)
+    if len(points) < 3 or tolerance <= 0:
+        return [list(point) for point in coordinates]
+    # local equirectangular projection, in meters; routes are a few kilometers long
+    scale = math.radians(1) * EARTH_RADIUS
+    xy = np.column_stack((points[:, 0] * scale * math.cos(math.radians(points[:, 1].mean())), points[:, 1] * scale))
+    keep = np.zeros(len(points), dtype = bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a, b = xy[first], xy[last]
+        inner = xy[first + 1:last]
+        ab = b - a
+        norm = math.hypot(ab[0], ab[1])
+        if norm == 0:
+            distance = np.hypot(inner[:, 0] - a[0], inner[:, 1] - a[1])
+        else:
+            distance = np.abs(ab[0] * (inner[:, 1] - a[1]) - ab[1] * (inner[:, 0] - a[0])) / norm
+        farthest = int(np.argmax(distance))
+        if distance[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return [list(point) for point, kept in zip(coordinates, keep) if kept]
+
+
+def encode_route(coordinates, fmt = "geojson", precision = 5, zoom = None):
+    # The route in fmt, simplified for zoom when given.
+    if fmt not in FORMATS:
+        raise ValueError("unknown route format %r, expected one of %s" % (fmt, ", ".join(FORMATS)))
+    if zoom is not None and coordinates:
+        coordinates = simplify_line(coordinates, tolerance(zoom, coordinates[0][1]))
+    if fmt == "polyline":
+        return encode_polyline(coordinates, precision)
+    if fmt == "delta":
+        return delta_encode(coordinates, precision)
+    return {"properties" : {}, "type" : "Feature", "geometry" : {"type" : "LineString", "coordinates" : coordinates}}
+
+
+def etag(*parts):
+    # Strong ETag (unquoted) from the repr of parts, e.g. a route cache key, the cache generation and the response options.
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def format_address(address):
+    # Shortens a Nominatim address to "place, street, area, town, state, USA - zipcode".
+    locate = address.split(',')
+    len_location = len(locate)
+    if len_location < 6:
+        return address
+    return locate[0] + ',' + locate[1] + ',' + locate[2] + ',' + locate[len_location-5] + ',' + locate[len_location-3] + ', USA - ' + locate[len_location-2]
+
+
+class NominatimGeocoder:
+    # Network reverse geocoder. geopy is only imported when it is first used.
+    def __init__(self, user_agent = "myGeocoder"):
+        self.user_agent = user_agent
+        self.locator = None
+
+    def reverse(self, point):
+        if self.locator is None:
+            from geopy.geocoders import Nominatim
+            self.locator = Nominatim(user_agent = self.user_agent)
+        return format_address(self.locator.reverse(point).address)
+
+
+class StaticGeocoder:
+    # Stand-in geocoder for tests: answers from a dict of point -> address and never touches the network.
+    def __init__(self, addresses = None, default = None):
+        self.addresses = addresses or {}
+        self.default = default
+        self.calls = 0
+
+    def reverse(self, point):
+        self.calls += 1
+        if tuple(point) in self.addresses:
+            return format_address(self.addresses[tuple(point)])
+        return self.default
+
+
+class StreetNameGeocoder:
+    # Offline labels made from the OSM street names on the edges around a node.
+    def __init__(self, names = None):
+        self.names = names or {}
+
+    @classmethod
+    def from_graph(cls, G):
+        names = {}
+        if G is None:
+            return cls(names)
+        for u, v, data in G.edges(data = True):
+            name = data.get("name")
+            if not name:
+                continue
+            for n in (name if isinstance(name, list) else [name]):
+                names.setdefault(u, set()).add(n)
+                names.setdefault(v, set()).add(n)
+        return cls(names)
+
+    def label(self, node):
+        # "Street" or "Street & Cross Street" at an intersection, None when no edge is named.
+        names = sorted(self.names.get(node, ()))
+        if not names:
+            return None
+        return " & ".join(names[:2])
+
+
+class ReverseGeocoder:
+    # Address labels for snapped nodes, backed by a persistent JSON cache keyed by node id.
+    # mode "offline" only uses street names from the graph, "background" answers from the cache or
+    # the street names and fetches the network address in a background thread for next time,
+    # and "online" waits for the network geocoder on a cache miss.
+    # Only network addresses are saved; street name and coordinate labels are made again on every call, so a
+    # later non-offline mode still fetches the address. New addresses are written out once save_every of them
+    # are waiting or save_interval seconds after the last write, and when the process exits.
+    # A point whose lookup failed is not tried again for retry_after seconds, doubled after each failure.
+    def __init__(self, path = None, remote = None, offline = None, mode = "background", save_every = 20, save_interval = 30.0,
+                 retry_after = 60.0, max_retry_after = 3600.0):
+        self.path = path
+        self.remote = remote if remote is not None else (NominatimGeocoder() if mode != "offline" else None)
+        self.offline = offline if offline is not None else StreetNameGeocoder()
+        self.mode = mode
+        self.labels = {}
+        self.pending = set()
+        self.failures = {} # key -> (failures in a row, time.time() before which it is not tried again)
+        self.save_every, self.save_interval = save_every, save_interval
+        self.retry_after, self.max_retry_after = retry_after, max_retry_after
+        self.unsaved, self.saved_at = 0, time.time()
+        self.lock = threading.Lock()
+        self.executor = None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.labels = json.load(f)
+        if path:
+            atexit.register(self.save)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            if not self.unsaved:
+                return
+            data = json.dumps(self.labels)
+            self.unsaved, self.saved_at = 0, time.time()
+        tmp = "%s.%d.%d.tmp" % (self.path, os.getpid(), threading.get_ident())
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    def retry_at(self, key):
+        with self.lock:
+            return self.failures.get(key, (0, 0.0))[1]
+
+    def fetch(self, key, point):
+        # Looks up a network address and stores it. Failures keep the fallback label and back off.
+        try:
+            label = self.remote.reverse(point)
+        except Exception as error:
+            print("Reverse geocoding failed:", error)
+            label = None
+        with self.lock:
+            self.pending.discard(key)
+            if label:
+                self.labels[key] = label
+                self.failures.pop(key, None)
+                self.unsaved += 1
+                due = self.unsaved >= self.save_every or time.time() - self.saved_at >= self.save_interval
+            else:
+                count = self.failures.get(key, (0, 0.0))[0] + 1
+                self.failures[key] = (count, time.time() + min(self.retry_after * 2**(count - 1), self.max_retry_after))
+                due = False
+        if due:
+            self.save()
+        return label
+
+    def label(self, node, point):
+        # Returns the address label for a snapped node at (lat, long) point.
+        key = str(node)
+        with self.lock:
+            if key in self.labels:
+                return self.labels[key]
+        if self.remote is not None and self.mode != "offline" and time.time() >= self.retry_at(key):
+            if self.mode == "online":
+                label = self.fetch(key, point)
+                if label:
+                    return label
+            elif self.mode == "background":
+                with self.lock:
+                    submit = key not in self.pending
+                    self.pending.add(key)
+                    if self.executor is None:
+                        self.executor = ThreadPoolExecutor(max_workers = 1) # one at a time keeps within Nominatim's rate limit
+                if submit:
+                    self.executor.submit(self.fetch, key, point)
+        label = self.offline.label(node)
+        if label is None:
+            return "%.5f, %.5f" % (point[0], point[1])
+        return label
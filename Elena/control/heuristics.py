@@ -0,0 +1,105 @@
+import numpy as np
+
+EARTH_RADIUS = 6371008.8
+
+
+def great_circle(lat1, long1, lat2, long2):
+    # Haversine distance in meters, works element-wise on numpy arrays.
+    lat1, long1 = np.radians(lat1), np.radians(long1)
+    lat2, long2 = np.radians(lat2), np.radians(long2)
+
+    dlong, dlat = long2 - long1, lat2 - lat1
+
+    temp1 = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlong / 2)**2
+    temp2 = 2 * np.arctan2(np.sqrt(temp1), np.sqrt(1 - temp1))
+    return EARTH_RADIUS * temp2
+
+
+class DistanceHeuristic:
+    # Distance from every node to one query's end node, indexed by RoutingGraph position.
+    # Nothing is written to the graph, and the straight-line field is only computed the first time it is asked for.
+    # distances are the exact walking distances to the end node when they are already known (a cached reverse tree);
+    # they are then used to prune even without exact.
+    def __init__(self, R, end_node, exact = False, max_dist = None, distances = None):
+        self.R = R
+        self.end_node = end_node # position of the end node in R
+        self.exact = exact
+        self.max_dist = max_dist
+        self.distances = distances
+        self.straight = None
+        self.network = None
+
+    def straight_line(self, node):
+        # Great-circle distance to the end node, vectorized over all nodes on first use.
+        if self.straight is None:
+            lat, long = self.R.lat, self.R.long
+            self.straight = great_circle(lat[self.end_node], long[self.end_node], lat, long).tolist()
+        return self.straight[node]
+
+    def network_distance(self, node):
+        # Exact walking distance to the end node from a reverse Dijkstra bounded by max_dist.
+        # Nodes that cannot reach the end within max_dist get inf.
+        if self.network is None:
+            dist = self.distances
+            if dist is None:
+                dist, _ = self.R.shortest_lengths(self.end_node, cutoff = self.max_dist, reverse = True)
+            self.network = dist.tolist()
+        return self.network[node]
+
+    def __call__(self, node):
+        if self.exact:
+            return self.network_distance(node)
+        return self.straight_line(node)
+
+    def can_reach(self, node, dist_so_far, max_dist):
+        # False when node provably cannot reach the end within max_dist. Always True without exact distances.
+        if not self.exact and self.distances is None:
+            return True
+        return dist_so_far + self.network_distance(node) <= max_dist
+
+    def elevation_bounds(self, elev_type):
+        # Per node lower bounds on the elevation cost still to come, None when there are none.
+        return None
+
+
+class LandmarkHeuristic(DistanceHeuristic):
+    # DistanceHeuristic with ALT lower bounds from precomputed Landmarks. The remaining distance estimate is the larger
+    # of the straight line and the landmark bound, nodes whose bound already exceeds max_dist are pruned without the
+    # exact reverse Dijkstra, and the elevation gain (minimize) or drop (maximize) still to come is bounded too.
+    def __init__(self, R, end_node, landmarks, exact = False, max_dist = None, distances = None):
+        DistanceHeuristic.__init__(self, R, end_node, exact = exact, max_dist = max_dist, distances = distances)
+        self.landmarks = landmarks
+        self.bounds = None
+        self.lower = None
+        self.estimate = None
+        self.elevation = {}
+
+    def distance_bounds(self):
+        if self.bounds is None:
+            self.bounds = self.landmarks.distance_bounds(self.end_node)
+        return self.bounds
+
+    def lower_bound(self, node):
+        if self.lower is None:
+            self.lower = self.distance_bounds().tolist()
+        return self.lower[node]
+
+    def straight_line(self, node):
+        # The straight line distance, raised to the landmark bound where that is larger.
+        if self.estimate is None:
+            straight = great_circle(self.R.lat[self.end_node], self.R.long[self.end_node], self.R.lat, self.R.long)
+            self.estimate = np.maximum(straight, self.distance_bounds()).tolist()
+        return self.estimate[node]
+
+    def can_reach(self, node, dist_so_far, max_dist):
+        if self.exact or self.distances is not None:
+            return dist_so_far + self.network_distance(node) <= max_dist
+        return dist_so_far + self.lower_bound(node) <= max_dist
+
+    def elevation_bounds(self, elev_type):
+        # Gain still to come is at least the landmark bound and the net climb to the end; drop is that gain minus the climb.
+        if elev_type not in self.elevation:
+            climb = self.R.elevation[self.end_node] - self.R.elevation
+            gain = np.maximum(np.maximum(self.landmarks.gain_bounds(self.end_node), climb), 0.0)
+            self.elevation[elev_type] = (gain if elev_type == "minimize" else gain - climb).tolist()
+        return self.elevation[elev_type]
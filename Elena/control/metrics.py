@@ -0,0 +1,107 @@
+import io
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets, in milliseconds. The last bucket catches everything slower.
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float("inf"))
+
+
+@contextmanager
+def stage(info, name):
+    # Adds the time spent in the block to info["stages"][name], in seconds. info may be None.
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        if info is not None:
+            stages = info.setdefault("stages", {})
+            stages[name] = stages.get(name, 0.0) + time.perf_counter() - start_time
+
+
+class Histogram:
+    # Count, sum, max and bucket counts of observed durations.
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count, self.total, self.max = 0, 0.0, 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000.0
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q quantile.
+        target, seen = q * self.count, 0
+        for bound, n in zip(BUCKETS_MS, self.counts):
+            seen += n
+            if seen >= target and n:
+                return bound if bound != float("inf") else self.max
+        return 0.0
+
+    def snapshot(self):
+        return {"count" : self.count, "sum_ms" : self.total, "mean_ms" : self.total / self.count if self.count else 0.0,
+                "max_ms" : self.max, "p50_ms" : self.quantile(0.5), "p95_ms" : self.quantile(0.95), "p99_ms" : self.quantile(0.99),
+                "buckets" : {("+Inf" if bound == float("inf") else str(bound)) : n for bound, n in zip(BUCKETS_MS, self.counts)}}
+
+
+class Metrics:
+    # Process wide aggregates of request timings, served by the /metrics endpoint. Safe to use from several threads.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, info, total = None):
+        # Folds one request's info (stages, per engine seconds, winning engine, expansions) into the aggregates.
+        if total is not None:
+            self.observe("request", total)
+        for name, seconds in info.get("stages", {}).items():
+            self.observe("stage." + name, seconds)
+        for engine, seconds in info.get("seconds", {}).items():
+            self.observe("engine." + engine, seconds)
+        for engine, expanded in info.get("expanded", {}).items():
+            self.count("expanded." + engine, expanded)
+        self.count("requests")
+        self.count("winner." + str(info.get("engine")))
+        if info.get("timed_out"):
+            self.count("timed_out")
+
+    def snapshot(self):
+        with self.lock:
+            return {"histograms" : {name : h.snapshot() for name, h in sorted(self.histograms.items())},
+                    "counters" : dict(sorted(self.counters.items()))}
+
+
+metrics = Metrics()
+
+
+def profiled(function, *args, limit = 30, **kwargs):
+    # Runs function under cProfile. Returns its result and the top limit entries by cumulative time, as text.
+    # Only the calling thread is profiled, so engines running in worker threads or processes show up as waits.
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args, **kwargs)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream = out).sort_stats("cumulative").print_stats(limit)
+    return result, out.getvalue()
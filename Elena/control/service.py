@@ -0,0 +1,138 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from Elena.abstraction.abstraction import Graph_Abstraction
+from Elena.abstraction.regions import RegionManager
+from Elena.abstraction.updates import GraphUpdate
+from Elena.abstraction.landmarks import fingerprint
+from Elena.control.algorithms import Algorithms
+from Elena.control.cache import RouteCache, FileCacheBackend, ReverseTreeCache
+from Elena.control.batch import BatchRouter, parse_query
+from Elena.control.geocoding import ReverseGeocoder, StreetNameGeocoder
+from Elena.control.settings import *
+
+
+class RoutingService:
+    # Everything requests share: the graph, its indexes, the route cache and the address labels.
+    # Built once at start up and only read afterwards; each request keeps its search state in its own Query.
+    # With regions (a directory of tiles, see REGIONS_DIR) every region gets its own Algorithms, all sharing one route cache
+    # and one reverse tree cache.
+    def __init__(self, abstract = None, regions = None):
+        backend = FileCacheBackend(ROUTE_CACHE_DIR) if ROUTE_CACHE_DIR else None
+        self.cache = RouteCache(maxsize = ROUTE_CACHE_SIZE, ttl = ROUTE_CACHE_TTL, backend = backend)
+        self.trees = ReverseTreeCache(REVERSE_TREE_CACHE_BYTES)
+        if regions is None and abstract is None:
+            regions = REGIONS_DIR
+        if regions is not None:
+            self.abstract, self.G, self.algorithms, self.batch = None, None, None, None
+            self.regions = RegionManager(regions, max_bytes = REGIONS_MAX_BYTES, margin = REGIONS_MARGIN, setup = self.setup_region)
+            self.labels = ReverseGeocoder(GEOCODER_CACHE, offline = StreetNameGeocoder.from_graph(None), mode = GEOCODER_MODE)
+            return
+        abstract = abstract if abstract is not None else Graph_Abstraction()
+        if not abstract.init:
+            abstract.get_graph()
+        self.abstract = abstract
+        self.regions = None
+        self.G = abstract.G
+        self.algorithms = self.get_algorithms(self.G, abstract.index, abstract.R, abstract.store_path, abstract.landmarks, abstract.contraction)
+        self.labels = ReverseGeocoder(GEOCODER_CACHE, offline = StreetNameGeocoder.from_graph(self.G), mode = GEOCODER_MODE)
+        self.batch = BatchRouter(self.algorithms, mode = BATCH_MODE, workers = BATCH_WORKERS)
+        self.updates = []
+        self.graph_id = fingerprint(self.algorithms.get_routing_graph()) # the graph as loaded, before any update
+        self.updates_lock = threading.Lock()
+        self.replay_updates()
+        self.warm_up()
+
+    def get_algorithms(self, G, index, R, store_path, landmarks = None, contraction = None):
+        return Algorithms(G, index = index, routing = R, cache = self.cache, trees = self.trees,
+                          search_mode = SEARCH_MODE, budget = SEARCH_BUDGET, store_path = store_path,
+                          label_bucket = LABEL_BUCKET, length_bucket = LENGTH_BUCKET, landmarks = landmarks, contraction = contraction)
+
+    def setup_region(self, region):
+        # Algorithms and batch router of a newly loaded region. Stitched regions have no graph store for process workers.
+        region.algorithms = self.get_algorithms(None, region.index, region.R, region.store_path)
+        if region.store_path is None and SEARCH_MODE == "process":
+            region.algorithms.search_mode = "thread"
+        region.batch = BatchRouter(region.algorithms, mode = BATCH_MODE if region.store_path is not None else "sequential", workers = BATCH_WORKERS)
+
+    def algorithms_for(self, points):
+        # The Algorithms that routes between points: the single graph's, or that of the region covering them.
+        # Pinned, so the request keeps one graph even if an update is applied meanwhile.
+        if self.regions is None:
+            return self.algorithms.pinned()
+        return self.regions.region_for(points).algorithms.pinned()
+
+    def apply_update(self, update, save = True):
+        # Applies a GraphUpdate, or its JSON form, to the live graph (see Algorithms.apply_update) and
+        # appends it to GRAPH_UPDATES_FILE. Regions are loaded and dropped on demand and are not updated.
+        if self.regions is not None:
+            raise ValueError("graph updates are not supported with regions")
+        if isinstance(update, dict):
+            update = GraphUpdate.from_dict(update)
+        with self.updates_lock:
+            summary = self.algorithms.apply_update(update)
+            self.updates.append(update.to_dict())
+            if save and GRAPH_UPDATES_FILE:
+                tmp = GRAPH_UPDATES_FILE + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump({"graph" : self.graph_id, "updates" : self.updates}, f)
+                os.replace(tmp, GRAPH_UPDATES_FILE)
+        return summary
+
+    def replay_updates(self):
+        # Reapplies the updates saved for this graph file. A rebuilt graph starts without them.
+        if not GRAPH_UPDATES_FILE or not os.path.exists(GRAPH_UPDATES_FILE):
+            return
+        with open(GRAPH_UPDATES_FILE) as f:
+            saved = json.load(f)
+        if saved.get("graph") != self.graph_id:
+            print("%s was written for another graph and is ignored" % GRAPH_UPDATES_FILE)
+            return
+        for update in saved["updates"]:
+            try:
+                self.apply_update(update, save = False)
+            except KeyError as e:
+                print("Skipped a saved graph update, unknown node or edge %s" % (e,))
+
+    def run_batch(self, queries, routes = False, log = False):
+        # Batch routing, split by region when serving several. Yields results with "id" the position in queries.
+        if self.regions is None:
+            yield from self.batch.run(queries, routes = routes, log = log)
+            return
+        groups = OrderedDict()
+        for i, query in enumerate(queries):
+            start, end, _, _ = parse_query(query)
+            groups.setdefault(self.regions.keys_for([start, end]), []).append(i)
+        for keys, ids in groups.items():
+            for result in self.regions.get(keys).batch.run([queries[i] for i in ids], routes = routes, log = log):
+                result["id"] = ids[result["id"]]
+                yield result
+
+    def warm_up(self):
+        # Builds everything that would otherwise be created lazily by the first requests, possibly at the same time.
+        if self.regions is not None:
+            return
+        self.algorithms.get_index()
+        if self.algorithms.contraction is not None:
+            self.algorithms.contraction.warm_up()
+        self.algorithms.get_routing_graph().warm_up()
+        if self.algorithms.search_mode != "sequential":
+            self.algorithms.get_executor()
+
+
+service = None
+service_lock = threading.Lock()
+
+def get_service():
+    # The process wide RoutingService, created on first use when the app did not warm up at start.
+    global service
+    if service is None:
+        with service_lock:
+            if service is None:
+                service = RoutingService()
+    return service
+
+def warm_up():
+    # Creates the RoutingService now rather than on the first request.
+    return get_service()
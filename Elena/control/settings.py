@@ -1,3 +1,62 @@
 # settings.py
 
 MAPBOX_KEY = 'pk.eyJ1Ijoia2V2aW5qb3NlcGgxOTk1IiwiYSI6ImNqbzUxc2kwaDAybm4zanRjdm9mbndqZW8ifQ.wdJv5gB84BWVy1dAoNN6ew'
+
+# Route cache. ROUTE_CACHE_TTL is in seconds (None keeps routes until evicted or the graph is reloaded).
+# Set ROUTE_CACHE_DIR to a directory shared by all workers to share cached routes between them.
+ROUTE_CACHE_SIZE = 1024
+ROUTE_CACHE_TTL = None
+ROUTE_CACHE_DIR = None
+# Reverse shortest path trees of recent end nodes (exact remaining distances and shortest routes), at most this many bytes.
+REVERSE_TREE_CACHE_BYTES = 64 * 1024 * 1024
+
+# Address labels: "offline" (street names from the graph), "background" (cached or street names,
+# Nominatim is queried in the background for next time) or "online" (wait for Nominatim on a miss).
+GEOCODER_MODE = "background"
+GEOCODER_CACHE = "geocode_cache.json"
+
+# Elevation searches: "sequential", "thread" or "process" (parallel workers, needs graph.bin).
+# SEARCH_BUDGET is a per-request time limit in seconds (None for none); the best route found by then is returned,
+# usually the Dijkstra or A* one, since the constrained search can take seconds at high percentages on a large graph.
+# Routes of searches that ran out of time are not cached.
+SEARCH_MODE = "sequential"
+SEARCH_BUDGET = 0.5
+# Elevation in meters and length as a fraction of the length limit within which the constrained search
+# treats two routes to a node as equally good. 0 and 0 is exact; larger buckets keep fewer candidate
+# routes per node, which keeps searches at high percentages interactive for slightly worse routes. Even at 0 and 0
+# the search is approximate when maximizing: a label can be dropped for one whose route loops back over it.
+LABEL_BUCKET = 2.0
+LENGTH_BUCKET = 0.05
+# Percentages /route_sweep computes when the request does not list them.
+SWEEP_TOLERANCES = list(range(0, 101, 5))
+
+# /route_batch: "process" spreads queries over BATCH_WORKERS processes (None = one per CPU) sharing graph.bin,
+# "sequential" routes them in the web process.
+BATCH_MODE = "process"
+BATCH_WORKERS = None
+
+# Serve several towns from tiles built with "python -m Elena.abstraction.regions extract.osm tiles/" instead of graph.p/graph.bin.
+# Tiles covering a query (plus REGIONS_MARGIN meters for detours) are loaded on first use and the least recently used
+# regions are dropped once the loaded ones take more than REGIONS_MAX_BYTES.
+# Limits with regions: tiles hold no street names, so address labels fall back to coordinates until a network
+# address is fetched (never with GEOCODER_MODE "offline"), and /graph_update is rejected.
+REGIONS_DIR = None
+REGIONS_MAX_BYTES = 512 * 1024 * 1024
+REGIONS_MARGIN = 2000.0
+
+# Allow "debug" and "profile" in /route requests, which add stage timings, search statistics and a cProfile report to the response.
+# Leave off in production: any client could then have requests profiled.
+DEBUG_REQUESTS = False
+
+# Allow POST /graph_update (trail closures, reopenings, elevation corrections). Applied updates are written to
+# GRAPH_UPDATES_FILE and replayed at start up, until the graph is rebuilt; None keeps them in memory only.
+GRAPH_UPDATES = True
+GRAPH_UPDATES_FILE = "graph_updates.json"
+
+# /route response encoding when the request has no "format": "geojson", or "polyline" / "delta" for compact integer
+# coordinates in 1e-ROUTE_PRECISION degrees (see Elena.control.encoding).
+ROUTE_FORMAT = "geojson"
+ROUTE_PRECISION = 5
+
+# Load the graph and build its indexes when the app starts (create_app in control.py). Set to False to defer it to the first request.
+WARM_UP_ON_START = True
@@ -0,0 +1,533 @@
+import sys
+import os
+import time
+import math
+import random
+import pickle
+import tracemalloc
+import tempfile
+import subprocess
+import argparse
+import json
+import platform
+import numpy as np
+sys.path.insert(1, sys.path[0][:-5])
+import networkx as nx
+import osmnx as ox
+
+from Elena.abstraction.abstraction import Graph_Abstraction
+from Elena.abstraction.spatial_index import SpatialIndex
+from Elena.abstraction.routing_graph import RoutingGraph
+from Elena.abstraction import graph_store, synthetic
+from Elena.abstraction.landmarks import Landmarks
+from Elena.abstraction.contraction import ContractionHierarchy, check
+from Elena.abstraction.simplify import simplify
+from Elena.control.algorithms import Algorithms, Query, ENGINES
+from Elena.control.batch import parse_query
+from Elena.control.geocoding import StaticGeocoder
+from Elena.control import service
+
+
+def load_graph(abstract, kind = "auto"):
+    # Benchmarks run on the real graph when it has been downloaded, otherwise (or when asked) on a synthetic one.
+    if kind == "real" or (kind == "auto" and abstract.init):
+        return abstract.get_graph()
+    if kind == "geometric":
+        return synthetic.geometric_graph()
+    if kind == "auto":
+        print("graph.p not found, using a synthetic grid graph")
+    return synthetic.grid_graph()
+
+
+def sample_queries(G, count = 10, seed = 1):
+    # Random start/end pairs that are connected and not trivially close.
+    rnd = random.Random(seed)
+    nodes = list(G.nodes())
+    queries = []
+    while len(queries) < count:
+        u, v = rnd.choice(nodes), rnd.choice(nodes)
+        if u != v and nx.has_path(G, u, v):
+            queries.append((u, v))
+    return queries
+
+
+def legacy_a_star(A):
+    # The set-scanning A* this repo shipped before the heap frontier, kept as a baseline.
+    evaluated, toEval = set(), set()
+    best_node, costToStart, costToStart1, final_score = {}, {}, {}, {}
+    G, min_dist, x, elev_type = A.G, A.shortest_dist, A.x, A.elev_type
+    start_node, end_node = A.start_node, A.end_node
+    toEval.add(start_node)
+    for node in G.nodes():
+        costToStart[node] = float("inf")
+    costToStart[start_node] = 0
+    for node in G.nodes():
+        costToStart1[node] = float("inf")
+    costToStart1[start_node] = 0
+    final_score[start_node] = G.nodes[start_node]['dist_from_dest']*0.1
+    A.expanded = 0
+    while len(toEval):
+        curr_node = min([(node,final_score[node]) for node in toEval], key=lambda t: t[1])[0]
+        if curr_node == end_node:
+            A.retrace_path(best_node, curr_node)
+            return
+        toEval.remove(curr_node)
+        evaluated.add(curr_node)
+        A.expanded += 1
+        for n in G.neighbors(curr_node):
+            if n in evaluated:
+                continue
+            if elev_type == "minimize":
+                pred_costToStart = costToStart[curr_node] + A.get_cost(curr_node, n, "elevation_gain")
+            elif elev_type == "maximize":
+                pred_costToStart = costToStart[curr_node] + A.get_cost(curr_node, n, "elevation_drop")
+            pred_costToStart1 = costToStart1[curr_node] + A.get_cost(curr_node, n, "normal")
+            if n not in toEval and pred_costToStart1<=(1+x)*min_dist:
+                toEval.add(n)
+            else:
+                if (pred_costToStart >= costToStart[n]) or (pred_costToStart1>=(1+x)*min_dist):
+                    continue
+            best_node[n] = curr_node
+            costToStart[n] = pred_costToStart
+            costToStart1[n] = pred_costToStart1
+            final_score[n] = costToStart[n] + G.nodes[n]['dist_from_dest']*0.1
+
+
+def bench_a_star(abstract, G, queries, x = 0.5, elev_type = "minimize"):
+    # Compares wall time and expansions/sec of the heap based A* against the legacy one.
+    print("# A* benchmark: %d queries, %d nodes, x = %s, %s" % (len(queries), G.number_of_nodes(), x, elev_type))
+    A = Algorithms(G, x = x, elev_type = elev_type)
+    E = Algorithms(G, x = x, elev_type = elev_type, exact_bound = True, routing = A.get_routing_graph())
+    totals = {"legacy" : [0.0, 0, []], "heap" : [0.0, 0, []], "exact" : [0.0, 0, []]}
+    for u, v in queries:
+        # the legacy engine still reads the dist_from_dest node field
+        abstract.add_dist_frm_endpt(G, (G.nodes[v]['y'], G.nodes[v]['x']))
+        shortest_dist = nx.shortest_path_length(G, u, v, weight = 'length')
+        for name, B, engine in (("legacy", A, lambda: legacy_a_star(A)), ("heap", A, A.a_star), ("exact", E, E.a_star)):
+            B.start_node, B.end_node, B.x, B.elev_type, B.shortest_dist = u, v, x, elev_type, shortest_dist
+            B.best = [[], 0.0, float('inf'), float('-inf')]
+            start_time = time.time()
+            engine()
+            totals[name][0] += time.time() - start_time
+            totals[name][1] += B.expanded
+            totals[name][2].append(round(B.best[1], 3))
+    for name, (seconds, expanded, gains) in totals.items():
+        print("%-7s wall = %8.3f s  expanded = %8d  expansions/sec = %10.0f" % (name, seconds, expanded, expanded / max(seconds, 1e-9)))
+    if totals["legacy"][2] != totals["heap"][2]:
+        print("note: routes differ on tied scores between the two engines")
+    print("speedup = %.1fx" % (totals["legacy"][0] / max(totals["heap"][0], 1e-9)))
+    print()
+
+
+def bench_routing_graph(G, queries):
+    # Compares memory and shortest path query time of the networkx graph and the CSR routing graph.
+    print("# Routing graph benchmark: %d nodes, %d edges" % (G.number_of_nodes(), G.number_of_edges()))
+    data = pickle.dumps(G)
+    tracemalloc.start()
+    pickle.loads(data)
+    nx_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start_time = time.time()
+    R = RoutingGraph.from_networkx(G)
+    build = time.time() - start_time
+    print("networkx graph %10.1f MB" % (nx_bytes / 1e6))
+    print("routing graph  %10.1f MB  (built in %.3f s)" % (R.nbytes / 1e6, build))
+
+    start_time = time.time()
+    expected = [nx.shortest_path_length(G, u, v, weight = 'length') for u, v in queries]
+    nx_time = time.time() - start_time
+    start_time = time.time()
+    got = [R.shortest_path(R.index[u], R.index[v])[1] for u, v in queries]
+    csr_time = time.time() - start_time
+    print("nx.shortest_path     %8.3f ms/query" % (1000*nx_time/len(queries)))
+    print("RoutingGraph         %8.3f ms/query" % (1000*csr_time/len(queries)))
+    assert all(abs(a - b) < 1e-3*max(a, 1.0) for a, b in zip(expected, got)), "shortest distances differ"
+    print()
+
+
+def bench_engines(G, queries, tolerances = (0.25, 1.0), buckets = ((0.0, 0.0), (1.0, 0.02), (2.0, 0.05))):
+    # Route quality and time of every engine, and of the constrained search at several (elevation, length) buckets.
+    print("# Engine benchmark: %d queries, %d nodes" % (len(queries), G.number_of_nodes()))
+    A = Algorithms(G)
+    R = A.get_routing_graph()
+    runs = [(engine, A, engine) for engine in ENGINES if engine != "constrained"]
+    for label_bucket, length_bucket in buckets:
+        B = Algorithms(G, routing = R, label_bucket = label_bucket, length_bucket = length_bucket, budget = 10.0)
+        runs.append(("constrained/%g/%g" % (label_bucket, length_bucket), B, "constrained"))
+    for elev_type in ("maximize", "minimize"):
+        for x in tolerances:
+            print("%s, x = %d%%" % (elev_type, 100*x))
+            for name, B, engine in runs:
+                seconds, gain, found, expanded = 0.0, 0.0, 0, 0
+                for u, v in queries:
+                    shortest_dist = R.shortest_path(R.index[u], R.index[v])[1]
+                    query = Query(u, v, x, elev_type, shortest_dist, time.time() + B.budget if B.budget else None)
+                    start_time = time.time()
+                    getattr(B, engine)(query)
+                    seconds += time.time() - start_time
+                    expanded += query.expanded
+                    if query.best[0]:
+                        assert query.best[1] <= (1+x)*shortest_dist + 1e-3, "%s route too long" % name
+                        found += 1
+                        gain += query.best[2]
+                print("  %-20s %8.3f s/query  found %2d/%d  mean gain %8.1f m  expanded %9d" % (name, seconds/len(queries), found, len(queries), gain/max(found, 1), expanded))
+    print()
+
+
+def bench_contraction(G, queries):
+    # Preprocessing cost of the contraction hierarchy and its shortest path queries against a full Dijkstra,
+    # checked against networkx on the same pairs.
+    print("# Contraction hierarchy benchmark: %d nodes, %d queries" % (G.number_of_nodes(), len(queries)))
+    R = RoutingGraph.from_networkx(G)
+    start_time = time.time()
+    hierarchy = ContractionHierarchy.build(R).warm_up()
+    print("preprocessing %.2f s, %d shortcuts, %.1f MB" % (time.time() - start_time, hierarchy.shortcuts, hierarchy.nbytes / 1e6))
+    pairs = [(R.index[u], R.index[v]) for u, v in queries]
+    start_time = time.time()
+    for u, v in pairs:
+        R.shortest_path(u, v)
+    print("RoutingGraph         %8.3f ms/query" % (1000*(time.time() - start_time)/len(pairs)))
+    start_time = time.time()
+    for u, v in pairs:
+        hierarchy.shortest_path(u, v)
+    print("ContractionHierarchy %8.3f ms/query" % (1000*(time.time() - start_time)/len(pairs)))
+    worst, broken = check(G, R, hierarchy, queries)
+    print("largest difference to networkx %.6f m, %d broken routes" % (worst, broken))
+    assert worst < 1e-2 and not broken, "contraction hierarchy routes differ"
+    print()
+
+
+def bench_landmarks(G, queries, tolerances = (0.25, 1.0), count = 16):
+    # Nodes expanded and time per engine with and without ALT landmarks, on the same queries.
+    print("# Landmark benchmark: %d queries, %d nodes, %d landmarks" % (len(queries), G.number_of_nodes(), count))
+    A = Algorithms(G)
+    R = A.get_routing_graph()
+    start_time = time.time()
+    landmarks = Landmarks.build(R, count)
+    print("preprocessing %.2f s, %.1f MB" % (time.time() - start_time, landmarks.nbytes / 1e6))
+    B = Algorithms(G, routing = R, landmarks = landmarks)
+    for elev_type in ("maximize", "minimize"):
+        for x in tolerances:
+            print("%s, x = %d%%" % (elev_type, 100*x))
+            for engine in ENGINES:
+                for name, C in (("without", A), ("with", B)):
+                    seconds, expanded, gain = 0.0, 0, 0.0
+                    for u, v in queries:
+                        shortest_dist = R.shortest_path(R.index[u], R.index[v])[1]
+                        query = Query(u, v, x, elev_type, shortest_dist)
+                        start_time = time.time()
+                        getattr(C, engine)(query)
+                        seconds += time.time() - start_time
+                        expanded += query.expanded
+                        gain += query.best[2] if query.best[0] else 0.0
+                    print("  %-12s %-8s %8.3f s/query  expanded %9d  mean gain %8.1f m" % (engine, name, seconds/len(queries), expanded, gain/len(queries)))
+    print()
+
+
+def bench_simplify(G, queries, tolerances = (0.25, 1.0)):
+    # Nodes expanded and time per engine on the full and the simplified routing graph, between the same junctions.
+    # Graphs without shape nodes (the synthetic ones) are subdivided first.
+    R = RoutingGraph.from_networkx(G)
+    if np.count_nonzero(np.diff(R.offsets) == 2) < len(R) / 4:
+        G = synthetic.subdivide(G)
+        R = RoutingGraph.from_networkx(G)
+    start_time = time.time()
+    S = simplify(R)
+    print("# Simplification benchmark: %d of %d nodes and %d of %d edges left, in %.2f s" % (np.count_nonzero(S.routable()), len(R),
+                                                                                          len(S.targets), len(R.targets), time.time() - start_time))
+    A, B = Algorithms(G, routing = R), Algorithms(G, routing = S)
+    index = B.get_index()
+    points = [(G.nodes[node]["y"], G.nodes[node]["x"]) for pair in queries for node in pair]
+    nodes, _ = index.nearest_many(points)
+    pairs = [(u, v) for u, v in zip(nodes[0::2], nodes[1::2]) if u != v]
+    for elev_type in ("maximize", "minimize"):
+        for x in tolerances:
+            print("%s, x = %d%%" % (elev_type, 100*x))
+            for engine in ENGINES:
+                for name, C in (("full", A), ("simple", B)):
+                    seconds, expanded, gain = 0.0, 0, 0.0
+                    for u, v in pairs:
+                        shortest_dist = R.shortest_path(R.index[u], R.index[v])[1]
+                        query = Query(u, v, x, elev_type, shortest_dist)
+                        start_time = time.time()
+                        getattr(C, engine)(query)
+                        seconds += time.time() - start_time
+                        expanded += query.expanded
+                        gain += query.best[2] if query.best[0] else 0.0
+                    print("  %-12s %-8s %8.3f s/query  expanded %9d  mean gain %8.1f m" % (engine, name, seconds/len(pairs), expanded, gain/len(pairs)))
+    print()
+
+
+STARTUP = """
+import sys, time, resource, pickle
+sys.path.insert(0, %r)
+from Elena.abstraction.routing_graph import RoutingGraph
+from Elena.abstraction import graph_store, synthetic
+def rss():
+    return int(open("/proc/self/statm").read().split()[1]) * resource.getpagesize()
+before = rss()
+start_time = time.time()
+R = %s
+R.index[R.nodes[0]]
+print(time.time() - start_time, rss() - before)
+"""
+
+
+def bench_startup(G):
+    # Graph load time and RSS growth of a fresh process loading graph.p vs the mmapped graph store.
+    print("# Startup benchmark")
+    root = sys.path[1]
+    with tempfile.TemporaryDirectory() as tmp:
+        pickle_path, store_path = os.path.join(tmp, "graph.p"), os.path.join(tmp, "graph.bin")
+        pickle.dump(G, open(pickle_path, "wb"))
+        graph_store.save(RoutingGraph.from_networkx(G), store_path)
+        loaders = (("graph.p", pickle_path, "RoutingGraph.from_networkx(pickle.load(open(%r, 'rb')))" % pickle_path),
+                   ("graph.bin", store_path, "graph_store.load(%r)" % store_path))
+        for name, path, code in loaders:
+            out = subprocess.run([sys.executable, "-c", STARTUP % (root, code)], capture_output = True, text = True, check = True)
+            seconds, rss = out.stdout.split()
+            print("%-9s load %8.3f s  RSS +%8.1f MB  file %8.1f MB" % (name, float(seconds), int(rss) / 1e6, os.path.getsize(path) / 1e6))
+    print()
+
+
+SERVING = """
+import sys, time, resource
+sys.path.insert(0, %r)
+def rss():
+    return int(open("/proc/self/statm").read().split()[1]) * resource.getpagesize()
+before = rss()
+start_time = time.time()
+import Elena.control.control
+heavy = [name for name in ("osmnx", "geopandas", "shapely", "matplotlib", "pandas", "networkx", "requests", "geopy") if name in sys.modules]
+print(time.time() - start_time, rss() - before, ",".join(heavy) or "-")
+"""
+
+def bench_imports(G):
+    # Start up time and RSS of a web worker (import of the Flask app, which loads graph.bin), and the heavy
+    # packages it pulled in. Graph building (osmnx) should not be among them.
+    print("# Worker start up benchmark")
+    root = sys.path[1]
+    with tempfile.TemporaryDirectory() as tmp:
+        graph_store.save(RoutingGraph.from_networkx(G), os.path.join(tmp, "graph.bin"))
+        out = subprocess.run([sys.executable, "-c", SERVING % root], capture_output = True, text = True, check = True, cwd = tmp)
+        seconds, rss, heavy = out.stdout.split()[-3:]
+        print("import Elena.control.control %8.3f s  RSS +%8.1f MB  imported: %s" % (float(seconds), int(rss) / 1e6, heavy))
+    print()
+
+
+def bench_snap(G, count = 200, seed = 2):
+    # Compares nearest node snapping through ox.get_nearest_node with the KD-tree index.
+    print("# Snapping benchmark: %d points, %d nodes" % (count, G.number_of_nodes()))
+    rnd = random.Random(seed)
+    lats = [d['y'] for _, d in G.nodes(data = True)]
+    longs = [d['x'] for _, d in G.nodes(data = True)]
+    points = [(rnd.uniform(min(lats), max(lats)), rnd.uniform(min(longs), max(longs))) for _ in range(count)]
+
+    start_time = time.time()
+    index = SpatialIndex.from_graph(G)
+    build = time.time() - start_time
+
+    start_time = time.time()
+    expected = [ox.get_nearest_node(G, point = point) for point in points]
+    brute = time.time() - start_time
+
+    start_time = time.time()
+    single = [index.nearest(point) for point in points]
+    indexed = time.time() - start_time
+
+    start_time = time.time()
+    batch, _ = index.nearest_many(points)
+    batched = time.time() - start_time
+
+    print("index build      %8.3f s" % build)
+    print("get_nearest_node %8.3f ms/point" % (1000*brute/count))
+    print("index.nearest    %8.3f ms/point" % (1000*indexed/count))
+    print("nearest_many     %8.3f ms/point" % (1000*batched/count))
+    mismatches = sum(1 for a, b in zip(expected, batch) if a != b)
+    if mismatches or single != batch:
+        print("note: %d points snapped to a different (equidistant) node" % mismatches)
+    print()
+
+
+def record_queries(G, path, count = 50, seed = 1, xs = (25, 50, 100)):
+    # Writes a replayable query set: one /route request body per line (NDJSON).
+    rnd = random.Random(seed)
+    with open(path, "w") as f:
+        for u, v in sample_queries(G, count, seed):
+            body = {"start_location" : {"lat" : G.nodes[u]["y"], "lng" : G.nodes[u]["x"]},
+                    "end_location" : {"lat" : G.nodes[v]["y"], "lng" : G.nodes[v]["x"]},
+                    "x" : rnd.choice(xs), "min_max" : rnd.choice(("maximize", "minimize"))}
+            f.write(json.dumps(body) + "\n")
+
+
+def load_queries(path):
+    # (start, end, x, min_max) tuples from a JSON list or NDJSON of /route bodies, e.g. from record_queries.
+    text = open(path).read()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return [parse_query(query) for query in (data if isinstance(data, list) else [data])]
+
+
+def latency(samples):
+    # Latency percentiles in milliseconds.
+    ms = np.asarray(samples, dtype = np.float64) * 1000.0
+    return {"count" : len(ms), "mean_ms" : float(ms.mean()), "p50_ms" : float(np.percentile(ms, 50)),
+            "p95_ms" : float(np.percentile(ms, 95)), "p99_ms" : float(np.percentile(ms, 99))}
+
+
+def measure(run, items):
+    # Times run(item) for every item, then runs them again under tracemalloc for the peak memory.
+    samples, results = [], []
+    for item in items:
+        start_time = time.perf_counter()
+        results.append(run(item))
+        samples.append(time.perf_counter() - start_time)
+    tracemalloc.start()
+    for item in items:
+        run(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    report = latency(samples)
+    report["peak_mb"] = peak / 1e6
+    return report, results
+
+
+def suite(G, queries):
+    # Every engine, the shortest path, snapping and get_data on the same queries.
+    # Returns a JSON-serializable report; quality ratios compare each engine with the best engine per query.
+    A = Algorithms(G)
+    R = A.get_routing_graph()
+    nodes, _ = A.get_index().nearest_many([point for query in queries for point in query[:2]])
+    snapped = [(nodes[2*i], nodes[2*i+1], x, min_max) for i, (_, _, x, min_max) in enumerate(queries)]
+    report = {"graph" : {"nodes" : G.number_of_nodes(), "edges" : G.number_of_edges()}, "queries" : len(queries), "components" : {}}
+    components = report["components"]
+
+    components["shortest"], shortest = measure(lambda q: R.shortest_path(R.index[q[0]], R.index[q[1]])[1], snapped)
+
+    routes = {}
+    for engine in ENGINES:
+        def run(item):
+            (u, v, x, min_max), dist = item
+            query = Query(u, v, x/100.0, min_max, dist)
+            getattr(A, engine)(query)
+            return query
+        components[engine], done = measure(run, list(zip(snapped, shortest)))
+        components[engine]["expanded_mean"] = float(np.mean([query.expanded for query in done]))
+        components[engine]["found"] = sum(1 for query in done if query.best[0])
+        routes[engine] = done
+
+    # route quality: elevation gain against the best engine for that query, and length against the shortest path
+    for engine in ENGINES:
+        gain_ratios, length_ratios = [], []
+        for i, query in enumerate(routes[engine]):
+            if not query.best[0]:
+                continue
+            found = [routes[other][i].best[2] for other in ENGINES if routes[other][i].best[0]]
+            best = max(found) if query.elev_type == "maximize" else min(found)
+            gain = query.best[2]
+            if query.elev_type == "maximize":
+                gain_ratios.append(gain / best if best > 0 else 1.0)
+            else:
+                gain_ratios.append(best / gain if gain > 0 else 1.0)
+            length_ratios.append(query.best[1] / shortest[i])
+        components[engine]["gain_ratio"] = float(np.mean(gain_ratios)) if gain_ratios else None
+        components[engine]["length_ratio"] = float(np.mean(length_ratios)) if length_ratios else None
+
+    points = [point for query in queries for point in query[:2]]
+    index = A.get_index()
+    components["snap"], _ = measure(index.nearest, points)
+    components["snap_many"], _ = measure(index.nearest_many, [points])
+
+    # end to end through the web layer's get_data, on a RoutingService over this graph, without geocoding
+    if service.service is None or service.service.G is not G:
+        service.service = service.RoutingService(Graph_Abstraction.from_graph(G))
+    from Elena.control.control import get_data
+    cache, geocoder = service.service.algorithms.cache, StaticGeocoder(default = "")
+    def run(q):
+        cache.clear() # every call is a full search
+        return get_data(q[0], q[1], q[2], q[3], log = False, geocoder = geocoder)
+    components["get_data"], _ = measure(run, queries)
+    cache.clear()
+    return report
+
+
+def compare(report, baseline, threshold = 0.1):
+    # Prints the change of every latency and memory figure against an earlier report, flagging changes past threshold.
+    print("# Compared with the baseline")
+    for name, current in report["components"].items():
+        before = baseline.get("components", {}).get(name)
+        if before is None:
+            print("%-12s new" % name)
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "peak_mb", "gain_ratio"):
+            if current.get(metric) is None or not before.get(metric):
+                continue
+            change = current[metric] / before[metric] - 1.0
+            flag = ""
+            if abs(change) > threshold:
+                worse = change < 0 if metric == "gain_ratio" else change > 0
+                flag = "  REGRESSION" if worse else "  improved"
+            print("%-12s %-10s %10.3f -> %10.3f  %+6.1f%%%s" % (name, metric, before[metric], current[metric], 100*change, flag))
+    print()
+
+
+def print_report(report):
+    print("# Benchmark suite: %s graph, %d nodes, %d queries" % (report["graph"]["kind"], report["graph"]["nodes"], report["queries"]))
+    for name, r in report["components"].items():
+        extra = ""
+        if "gain_ratio" in r:
+            extra = "  found %3d  expanded %9.0f  gain ratio %s" % (r["found"], r["expanded_mean"], "%.3f" % r["gain_ratio"] if r["gain_ratio"] is not None else "-")
+        print("%-12s p50 %9.3f ms  p95 %9.3f ms  p99 %9.3f ms  peak %7.2f MB%s" % (name, r["p50_ms"], r["p95_ms"], r["p99_ms"], r["peak_mb"], extra))
+    print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Elena routing benchmarks")
+    parser.add_argument("--graph", choices = ("auto", "real", "grid", "geometric"), default = "auto", help = "graph to benchmark on (auto: graph.p if present, else grid)")
+    parser.add_argument("--queries", help = "replay the queries in this JSON/NDJSON file of /route bodies")
+    parser.add_argument("--record", help = "write the sampled queries to this file for later replays")
+    parser.add_argument("--count", type = int, default = 30, help = "number of sampled queries")
+    parser.add_argument("--json", help = "write the report to this file")
+    parser.add_argument("--compare", help = "compare with a report written earlier with --json")
+    parser.add_argument("--classic", action = "store_true", help = "also run the individual comparison benchmarks")
+    parser.add_argument("--landmarks", action = "store_true", help = "also compare the engines with and without ALT landmarks")
+    parser.add_argument("--contraction", action = "store_true", help = "also benchmark the contraction hierarchy shortest paths")
+    parser.add_argument("--simplify", action = "store_true", help = "also compare the engines on the full and the simplified graph")
+    args = parser.parse_args()
+
+    abstract = Graph_Abstraction()
+    G = load_graph(abstract, args.graph)
+    if args.queries:
+        queries = load_queries(args.queries)
+    else:
+        path = args.record or os.path.join(tempfile.mkdtemp(), "queries.ndjson")
+        record_queries(G, path, args.count)
+        queries = load_queries(path)
+
+    report = suite(G, queries)
+    report["graph"]["kind"] = args.graph if args.graph != "auto" else ("real" if abstract.init else "grid")
+    report["meta"] = {"time" : time.time(), "python" : platform.python_version(), "engines" : list(ENGINES), "queries" : args.queries}
+    print_report(report)
+    if args.compare:
+        compare(report, json.load(open(args.compare)))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent = 2)
+
+    if args.landmarks:
+        bench_landmarks(G, sample_queries(G))
+    if args.contraction:
+        bench_contraction(G, sample_queries(G, 100))
+    if args.simplify:
+        bench_simplify(G, sample_queries(G))
+    if args.classic:
+        pairs = sample_queries(G)
+        bench_a_star(abstract, G, pairs)
+        bench_routing_graph(G, pairs)
+        bench_engines(G, pairs)
+        bench_snap(G)
+        bench_startup(G)
+        bench_imports(G)
@@ -10,6 +10,20 @@ from Elena.abstraction.abstraction import *
 from Elena.control.algorithms import *
 from Elena.control.control import get_geojson, get_data
 from Elena.control.settings import *
+from Elena.control.geocoding import *
+from Elena.control.batch import *
+from Elena.control.metrics import *
+from Elena.abstraction.elevation import *
+from Elena.abstraction.regions import *
+from Elena.abstraction.landmarks import Landmarks
+from Elena.abstraction.contraction import ContractionHierarchy, check
+from Elena.abstraction.updates import GraphUpdate, GraphState, patch
+from Elena.abstraction.simplify import simplify
+import os
+import json
+import time
+import tempfile
+import numpy as np
 
 def Test(value = ""):
     def temp(function):
@@ -29,9 +43,12 @@ def Test(value = ""):
 def test_get_graph(end):
     print("# Testing the get_graph method in abstraction.py(Abstraction)......")
 
+    existed = os.path.exists("build")
     abstract = Graph_Abstraction()
     G = abstract.get_graph(end)
     assert isinstance(G, nx.classes.multidigraph.MultiDiGraph)
+    # a graph built on first use leaves no stage artifacts in the working directory
+    assert existed or not os.path.exists("build")
 
 @Test("")
 def test_get_route(A):
@@ -66,6 +83,142 @@ def test_get_shortest_path():
     assert best_path[1] <= (1 + x/100.0)*shortest_path[1]
     assert best_path[2] <= shortest_path[2]
 
+@Test("")
+def test_search_modes(G):
+    print("# Testing sequential and concurrent search in algorithms.py(control)....")
+
+    expected = None
+    for mode in ("sequential", "thread"):
+        A = Algorithms(G, search_mode = mode)
+        info = {}
+        shortest_path, best_path = A.search(0, 2, 100.0, elev_type = "maximize", log = False, info = info)
+        assert shortest_path[1] == 6.0
+        assert best_path[1] <= 2*shortest_path[1]
+        assert best_path[2] >= shortest_path[2]
+        assert info["engine"] is not None
+        expected = expected or best_path
+        assert best_path == expected
+
+    # a search that finished is complete even when the deadline passed meanwhile; one cut short is not
+    A, info = Algorithms(G, budget = 0.0), {}
+    A.search(0, 2, 100.0, elev_type = "maximize", log = False, info = info)
+    assert not info["timed_out"]
+    from Elena.abstraction.synthetic import grid_graph
+    grid = grid_graph(30, 30)
+    A, info = Algorithms(grid, budget = 0.0), {}
+    A.search(list(grid.nodes())[0], list(grid.nodes())[-1], 100.0, elev_type = "maximize", log = False, info = info)
+    assert info["timed_out"]
+
+@Test("")
+def test_constrained(G):
+    print("# Testing the constrained label search in algorithms.py(control)....")
+
+    A = Algorithms(G, label_bucket = 0.0, length_bucket = 0.0)
+    query = Query(0, 2, 1.0, "maximize", 6.0)
+    best = A.constrained(query)
+    assert best[0] == [0, 6, 2]
+    assert best[1] == 10.0 and best[2] == 4.0
+
+    query = Query(0, 2, 0.5, "maximize", 6.0)
+    best = A.constrained(query)
+    assert best[0] == [0, 5, 2] and best[2] == 3.0
+
+    query = Query(0, 2, 1.0, "minimize", 6.0)
+    best = A.constrained(query)
+    assert best[0] == [0, 1, 2] and best[2] == 0.0
+
+@Test("")
+def test_sweep(G):
+    print("# Testing the multi-tolerance sweep in algorithms.py(control)....")
+
+    A = Algorithms(G, label_bucket = 0.0, length_bucket = 0.0)
+    shortest_path, routes = A.sweep(0, 2, [0, 25, 50, 100], elev_type = "maximize", log = False)
+    assert [route[2] for route in routes] == [0.0, 1.0, 3.0, 4.0]
+    assert routes[0] == shortest_path
+    for x, route in zip([0, 25, 50, 100], routes):
+        assert route[1] <= (1 + x/100.0)*shortest_path[1]
+        _, single = A.search(0, 2, x, elev_type = "maximize", log = False)
+        assert single[2] == route[2]
+
+    # With the default buckets the sweep is approximate below its largest x. Its routes stay within every
+    # length limit, and /route keeps answering with what a full search finds.
+    from Elena.abstraction.synthetic import grid_graph
+    A = Algorithms(grid_graph(15, 15))
+    R = A.get_routing_graph()
+    rnd = np.random.RandomState(1)
+    xs = [10, 25, 50]
+    for u, v in rnd.randint(len(R), size = (4, 2)).tolist():
+        start, end = (R.lat[u], R.long[u]), (R.lat[v], R.long[v])
+        for elev_type in ("maximize", "minimize"):
+            shortest_path, routes = A.get_shortest_paths(start, end, xs, elev_type = elev_type, log = False)
+            info = {}
+            assert A.get_shortest_paths(start, end, xs, elev_type = elev_type, log = False, info = info)[1] == routes and info["engine"] == "cache"
+            for x, route in zip(xs, routes):
+                assert route[1] <= (1 + x/100.0)*shortest_path[1] + 1e-6
+                _, single = A.search(R.nodes[u], R.nodes[v], x, elev_type = elev_type, log = False)
+                assert A.get_shortest_path(start, end, x, elev_type = elev_type, log = False)[1][2] == single[2]
+
+@Test("")
+def test_batch(G):
+    print("# Testing BatchRouter in batch.py(control)....")
+
+    G = G.copy()
+    for i in G.nodes():
+        G.nodes[i]["y"], G.nodes[i]["x"] = 42.0 + 0.001*i, -72.0
+    A = Algorithms(G, label_bucket = 0.0, length_bucket = 0.0)
+    point = lambda i: (42.0 + 0.001*i, -72.0)
+    queries = [(point(0), point(2), 100.0, "maximize"), (point(0), point(2), 50.0, "maximize"), (point(0), point(4), 100.0, "minimize"),
+               {"start_location" : {"lat" : point(3)[0], "lng" : point(3)[1]}, "end_location" : {"lat" : point(2)[0], "lng" : point(2)[1]}, "x" : 0, "min_max" : "maximize"}]
+    results = sorted(BatchRouter(A, mode = "sequential").run(queries), key = lambda result: result["id"])
+    assert [result["id"] for result in results] == [0, 1, 2, 3]
+    # batch routes come from sweeps and are cached apart from the routes of a full search
+    assert A.cache.key(0, 2, 100.0, "maximize", sweep = True) in A.cache and A.cache.key(0, 2, 100.0, "maximize") not in A.cache
+    for query, result in zip(queries, results):
+        start, end, x, min_max = parse_query(query)
+        shortest_path, best_path = A.get_shortest_path(start, end, x, elev_type = min_max, log = False)
+        assert result["shortDist"] == shortest_path[1]
+        assert result["gainElenav"] == best_path[2]
+    assert results[0]["gainElenav"] == 4.0 and results[1]["gainElenav"] == 3.0
+
+    # sweeps that run out of time are flagged and not cached; process workers get the same budget
+    from Elena.abstraction.synthetic import grid_graph
+    grid = grid_graph(30, 30)
+    B = Algorithms(grid, label_bucket = 0.0, length_bucket = 0.0, budget = 0.0)
+    u, v = list(grid.nodes())[0], list(grid.nodes())[-1]
+    corner = lambda node: (grid.nodes[node]["y"], grid.nodes[node]["x"])
+    result = list(BatchRouter(B, mode = "sequential").run([(corner(u), corner(v), 100.0, "maximize")]))[0]
+    assert result["timed_out"] and result["gainElenav"] == result["gainShort"]
+    assert B.cache.key(u, v, 100.0, "maximize", sweep = True) not in B.cache
+    assert B.worker_args()[-1] == 0.0
+
+    # after a graph update the workers get a new pool and the old one is shut down
+    from Elena.abstraction import graph_store
+    A.store_path = os.path.join(tempfile.mkdtemp(), "graph.bin")
+    graph_store.save(A.get_routing_graph(), A.store_path)
+    router = BatchRouter(A)
+    router.submit(A, [])
+    old = router.executor
+    A.state = GraphState()
+    router.submit(A, [])
+    assert router.executor is not old and old._shutdown_thread
+    router.executor.shutdown()
+
+@Test("")
+def test_synthetic_graphs():
+    print("# Testing the synthetic graphs in synthetic.py(abstraction).....")
+
+    from Elena.abstraction import synthetic
+    for G in (synthetic.grid_graph(10, 10), synthetic.geometric_graph(300, 1000.0, 150.0)):
+        assert isinstance(G, nx.classes.multidigraph.MultiDiGraph)
+        assert nx.is_strongly_connected(G)
+        assert all("elevation" in data and "x" in data and "y" in data for _, data in G.nodes(data = True))
+        A = Algorithms(G)
+        u, v = list(G.nodes())[0], list(G.nodes())[-1]
+        point = lambda node: (G.nodes[node]["y"], G.nodes[node]["x"])
+        shortest_path, best_path = A.get_shortest_path(point(u), point(v), 50.0, log = False)
+        assert best_path[1] <= 1.5*shortest_path[1] + 1e-3
+        assert best_path[2] >= shortest_path[2]
+
 @Test("")
 def test_get_Elevation(A):
     print("# Testing get_Elevation method in algorithms.py(control)....")
@@ -100,6 +253,26 @@ def test_get_Elevation(A):
     assert p == [1.414, 4.0, 1.313]
 
 
+@Test("")
+def test_route_stats(A):
+    print("# Testing route_stats method in routing_graph.py(abstraction)....")
+
+    R = A.get_routing_graph()
+    route = R.index.positions([0, 3, 4, 2])
+    assert route.tolist() == [R.index[n] for n in [0, 3, 4, 2]]
+    total, gain, drop, profile = R.route_stats(route, profile = True)
+    assert abs(total - 6.727) < 1e-5 and gain == 1.0 and drop == 1.0
+    assert R.route_stats(route) == (total, gain, drop)
+    assert profile["elevation"].tolist() == [0.0, 1.0, 1.0, 0.0]
+    assert abs(profile["distance"][-1] - total) < 1e-9
+    assert np.allclose(profile["grade"], [1.0/1.414, 0.0, -1.0/1.313])
+    try:
+        R.edge_ids(R.index.positions([0, 4]))
+        assert False
+    except KeyError:
+        pass
+
+
 @Test("")
 def test_get_cost(A, n1 = 0, n2 = 1):
     print("# Testing get_cost method in algorithms.py(control)....")
@@ -152,24 +325,574 @@ def test_get_geojson(location):
 def test_get_data(start, end, x = 100, min_max = "maximize"):
     print("# Testing get_data method in control.py(control).....")
 
-    d = get_data(start, end, x, min_max, log=False)
-    locator = Nominatim(user_agent="myGeocoder")
-    location = locator.reverse(start)
-    locate = location.address.split(',')
+    addresses = {start : "University of Massachusetts Amherst, Stockbridge Road, North Amherst, Amherst, Hampshire County, Massachusetts, 01003, United States of America",
+                 end : "Gulliver Meadow Conservation Area, Strong Street, East Village, Amherst, Hampshire County, Massachusetts, 01002, United States of America"}
+    d = get_data(start, end, x, min_max, log=False, geocoder=StaticGeocoder(addresses))
+
+    assert isinstance(d, dict)
+    assert d["start"] == "University of Massachusetts Amherst, Stockbridge Road, North Amherst, Amherst, Massachusetts, USA -  01003"
+    assert d["end"] == "Gulliver Meadow Conservation Area, Strong Street, East Village, Amherst, Massachusetts, USA -  01002"
+
+@Test("")
+def test_metrics(start, end):
+    print("# Testing stage timings and Metrics in metrics.py(control).....")
+
+    h = Histogram()
+    for seconds in [0.0005, 0.003, 0.003, 0.04, 3.0]:
+        h.observe(seconds)
+    snapshot = h.snapshot()
+    assert snapshot["count"] == 5 and snapshot["p50_ms"] == 5 and snapshot["p99_ms"] == 5000
+    assert snapshot["buckets"]["1"] == 1 and snapshot["buckets"]["5"] == 2
+
+    metrics.reset()
+    d = get_data(start, end, 50, "minimize", log=False, geocoder=StaticGeocoder({}), debug=True)
+    info = d["debug"]
+    assert all(name in info["stages"] for name in ["geocode", "snap", "cache", "shortest_path", "search"])
+    assert info["engine"] in info["relaxed"] and info["heap_peak"][info["engine"]] > 0
+    assert sum(info["stages"].values()) <= info["total"]
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"]["requests"] == 1 and snapshot["histograms"]["request"]["count"] == 1
+    assert snapshot["histograms"]["stage.search"]["count"] == 1
+
+    # a repeated request is answered from the route cache
+    d = get_data(start, end, 50, "minimize", log=False, geocoder=StaticGeocoder({}), debug=True)
+    assert "search" not in d["debug"]["stages"] and metrics.snapshot()["counters"]["requests"] == 2
+
+@Test("")
+def test_encoding(start, end):
+    print("# Testing route encodings and conditional /route responses in encoding.py(control).....")
+
+    from Elena.control import encoding
+    from Elena.control.control import app
+    # Google's example polyline, with [long, lat] coordinates as in GeoJSON
+    coordinates = [[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]]
+    assert encoding.encode_polyline(coordinates) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    assert np.allclose(encoding.decode_polyline("_p~iF~ps|U_ulLnnqC_mqNvxq`@"), coordinates)
+    assert encoding.delta_encode(coordinates)[:4] == [3850000, -12020000, 220000, -75000]
+    assert np.allclose(encoding.delta_decode(encoding.delta_encode(coordinates, 6), 6), coordinates)
+
+    # Douglas-Peucker keeps the ends and a 50 m detour, and drops the points along straight stretches
+    line = [[-72.52 + 0.0001 * i, 42.37] for i in range(20)]
+    line[10] = [line[10][0], 42.37 + 50 / 111195.0]
+    assert encoding.simplify_line(line, 5.0) == [line[0], line[9], line[10], line[11], line[19]]
+    assert encoding.simplify_line(line, 100.0) == [line[0], line[19]]
+    assert encoding.tolerance(18, 42.37) < 0.5 < encoding.tolerance(10, 42.37)
+
+    client = app.test_client()
+    body = {"start_location" : {"lat" : start[0], "lng" : start[1]}, "end_location" : {"lat" : end[0], "lng" : end[1]}, "x" : 40, "min_max" : "maximize"}
+    full = client.post("/route", json = body)
+    compact = client.post("/route", json = dict(body, format = "polyline", zoom = 16))
+    route = full.get_json()["elevation_route"]["geometry"]["coordinates"]
+    decoded = encoding.decode_polyline(compact.get_json()["elevation_route"])
+    assert 2 <= len(decoded) <= len(route) and len(compact.data) < len(full.data)
+    assert np.allclose(decoded[0], route[0], atol = 1e-5) and np.allclose(decoded[-1], route[-1], atol = 1e-5)
+    delta = client.post("/route", json = dict(body, format = "delta")).get_json()
+    assert np.allclose(encoding.delta_decode(delta["shortest_route"]), full.get_json()["shortest_route"]["geometry"]["coordinates"], atol = 1e-5)
+    assert client.post("/route", json = dict(body, format = "svg")).status_code == 400
+    for bad in [{"precision" : "five"}, {"precision" : 2.5}, {"zoom" : "close"}, {"zoom" : -1}]:
+        assert client.post("/route", json = dict(body, **bad)).status_code == 400
+
+    # the cached route is not sent again to a client that has it, in the same encoding
+    tag = compact.headers["ETag"]
+    assert client.post("/route", json = dict(body, format = "polyline", zoom = 16), headers = {"If-None-Match" : tag}).status_code == 304
+    assert client.post("/route", json = dict(body, format = "polyline", zoom = 15), headers = {"If-None-Match" : tag}).status_code == 200
+    assert client.post("/route", json = dict(body, format = "polyline", zoom = 16, x = 60), headers = {"If-None-Match" : tag}).status_code == 200
+
+    # nor once its address labels have changed, e.g. when a background lookup resolved the start address
+    from Elena.control.control import get_service, Snapped
+    labels = get_service().labels
+    key = str(Snapped(start, end).nodes[0])
+    old = labels.labels.get(key)
+    labels.labels[key] = "1 Test Street, Amherst"
+    try:
+        revalidated = client.post("/route", json = dict(body, format = "polyline", zoom = 16), headers = {"If-None-Match" : tag})
+        assert revalidated.status_code == 200 and revalidated.get_json()["start"] == "1 Test Street, Amherst"
+        assert revalidated.headers["ETag"] != tag
+    finally:
+        if old is None:
+            labels.labels.pop(key)
+        else:
+            labels.labels[key] = old
+
+    # a request snaps its points once, for the ETag and the route together
+    index = get_service().algorithms_for([start, end]).get_index()
+    calls, nearest_many = [], index.nearest_many
+    index.nearest_many = lambda points: calls.append(points) or nearest_many(points)
+    try:
+        assert client.post("/route", json = dict(body, x = 55)).status_code == 200
+    finally:
+        del index.nearest_many
+    assert len(calls) == 1
+
+@Test("")
+def test_route_cache():
+    print("# Testing RouteCache and FileCacheBackend in cache.py(control).....")
+
+    from Elena.control.cache import RouteCache, FileCacheBackend
+    directory = tempfile.mkdtemp()
+    backend = FileCacheBackend(directory, max_entries = 5, prune_every = 4)
+    cache = RouteCache(backend = backend)
+    route = ([[-72.5, 42.3], [-72.6, 42.4]], 100.0, 2.0, 1.0)
+    key = cache.key(0, 1, 50, "maximize")
+    cache.put(key, route)
+    # neither the caller that cached a route nor the ones given it can change the cached route
+    route[0].append([-72.7, 42.5])
+    cached = cache.get(key)
+    assert len(cached[0]) == 2
+    cached[0][0][0] = 0.0
+    assert cache.get(key)[0][0] == [-72.5, 42.3] and backend.get(key)[0][0] == [-72.5, 42.3]
+
+    # the directory is only listed, and trimmed to max_entries, every prune_every puts
+    for i in range(2, 9):
+        cache.put(cache.key(0, i, 50, "maximize"), route)
+    assert len(os.listdir(directory)) == 5 and backend.puts == 8
+    cache.put(cache.key(0, 9, 50, "maximize"), route)
+    assert len(os.listdir(directory)) == 6
 
-    len_location = len(locate)
+@Test("")
+def test_reverse_trees():
+    print("# Testing ReverseTreeCache in cache.py(control).....")
+
+    from Elena.abstraction.synthetic import grid_graph
+    from Elena.control.cache import ReverseTreeCache
+    G = grid_graph(20, 20)
+    R = RoutingGraph.from_networkx(G)
+    tree = R.shortest_lengths(0, reverse = True)
+    trees = ReverseTreeCache(max_bytes = 2 * sum(a.nbytes for a in tree))
+    for end in [0, 1, 2]:
+        trees.put(R, end, R.shortest_lengths(end, reverse = True))
+    assert trees.get(R, 0) is None and trees.get(R, 2) is not None
+    assert trees.stats()["evictions"] == 1 and trees.stats()["bytes"] <= trees.max_bytes
+    assert trees.get(RoutingGraph.from_networkx(G), 2) is None
+
+    # queries to the same end node share its tree: the shortest route and exact pruning come from the cache
+    A = Algorithms(G, routing = R)
+    nodes = list(G.nodes())
+    for start in [nodes[0], nodes[15], nodes[200]]:
+        shortest, _ = A.search(start, nodes[-1], 30, "maximize", log = False)
+        assert abs(shortest[1] - R.shortest_path(R.index[start], len(R) - 1)[1]) < 1e-3
+    stats = A.trees.stats()
+    assert stats["size"] == 1 and stats["hits"] >= 2
+    query = Query(nodes[0], nodes[-1], 0.1, "maximize", shortest[1])
+    heuristic = A.get_heuristic(query)
+    assert heuristic.distances is not None and not heuristic.can_reach(len(R) // 2, 0.0, 10.0)
+
+    A.apply_update(GraphUpdate(close_nodes = [nodes[-2]]))
+    assert A.trees.stats()["size"] == 0
 
-    start_loc = locate[0] + ',' + locate[1] + ',' + locate[2] + ',' + locate[len_location-5] + ',' + locate[len_location-3] + ', USA - ' + locate[len_location-2]
+@Test("")
+def test_reverse_geocoder(G):
+    print("# Testing ReverseGeocoder in geocoding.py(control).....")
+
+    G = G.copy()
+    G.edges[0, 1]["name"] = "Main Street"
+    G.edges[0, 3]["name"] = "Pine Street"
+    remote = StaticGeocoder({(1.0, 2.0) : "Town Hall, Main Street, Center, Amherst, Hampshire County, Massachusetts, 01002, United States of America"})
+
+    labels = ReverseGeocoder(remote = remote, offline = StreetNameGeocoder.from_graph(G), mode = "online")
+    assert labels.label(0, (1.0, 2.0)) == "Town Hall, Main Street, Center, Amherst, Massachusetts, USA -  01002"
+    assert labels.label(0, (1.0, 2.0)) == "Town Hall, Main Street, Center, Amherst, Massachusetts, USA -  01002"
+    assert remote.calls == 1
+
+    labels = ReverseGeocoder(remote = remote, offline = StreetNameGeocoder.from_graph(G), mode = "offline")
+    assert labels.label(0, (1.0, 2.0)) == "Main Street & Pine Street"
+    assert labels.label(4, (1.0, 2.0)) == "1.00000, 2.00000"
+    assert remote.calls == 1
+
+    # street name labels are not saved, so a later online mode still looks the address up
+    path = os.path.join(tempfile.mkdtemp(), "geocode_cache.json")
+    labels = ReverseGeocoder(path, remote = remote, offline = StreetNameGeocoder.from_graph(G), mode = "offline")
+    assert labels.label(0, (1.0, 2.0)) == "Main Street & Pine Street" and not labels.labels
+    labels = ReverseGeocoder(path, remote = remote, offline = StreetNameGeocoder.from_graph(G), mode = "online", save_every = 2)
+    assert labels.label(0, (1.0, 2.0)).startswith("Town Hall") and remote.calls == 2
+    # addresses are written in batches
+    assert not os.path.exists(path)
+    labels.label(1, (1.0, 2.0))
+    assert len(json.load(open(path))) == 2
+
+    # a failed lookup is not retried until its back off has passed
+    failing, calls = StaticGeocoder(), []
+    failing.reverse = lambda point: calls.append(point) or None
+    labels = ReverseGeocoder(remote = failing, offline = StreetNameGeocoder.from_graph(G), mode = "online", retry_after = 0.2)
+    assert labels.label(0, (1.0, 2.0)) == "Main Street & Pine Street"
+    assert labels.label(0, (1.0, 2.0)) == "Main Street & Pine Street" and len(calls) == 1
+    time.sleep(0.25)
+    labels.label(0, (1.0, 2.0))
+    assert len(calls) == 2 and labels.failures["0"][0] == 2
 
-    location = locator.reverse(end)
-    locate = location.address.split(',')
-    len_location = len(locate)
+@Test("")
+def test_landmarks():
+    print("# Testing Landmarks in landmarks.py(abstraction).....")
+
+    from Elena.abstraction.synthetic import grid_graph
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra
+    G = grid_graph(20, 20)
+    A = Algorithms(G)
+    R = A.get_routing_graph()
+    landmarks = Landmarks.build(R, 6)
+    assert len(set(landmarks.positions.tolist())) == 6
+
+    # bounds never exceed the true distance or least gain to the end
+    gains = csr_matrix((R.gain, R.targets, R.offsets), shape = (len(R), len(R)))
+    for end in [0, 57, 399]:
+        distance, _ = R.shortest_lengths(end, reverse = True)
+        gain = dijkstra(gains.T.tocsr(), indices = end)
+        assert np.all(landmarks.distance_bounds(end) <= distance + 1e-2)
+        assert np.all(landmarks.gain_bounds(end) <= gain + 1e-2)
+        assert landmarks.distance_bounds(end).max() > 0.5 * distance.max()
+
+    path = os.path.join(tempfile.mkdtemp(), "graph.landmarks.npz")
+    landmarks.save(path)
+    assert Landmarks.load(path).matches(R) and not Landmarks.load(path).matches(RoutingGraph.from_networkx(grid_graph(20, 21)))
+    # an edit that keeps the node and edge counts and the summed lengths is still told apart
+    import copy
+    edited = copy.copy(R)
+    edited.length = R.length.copy()
+    edited.length[[0, 1]] = edited.length[[1, 0]] + np.array([0.5, -0.5])
+    assert not Landmarks.load(path).matches(edited)
+
+    # the same routes within the length limit, with fewer labels expanded
+    B = Algorithms(G, routing = R, landmarks = Landmarks.load(path), label_bucket = 0.0, length_bucket = 0.0)
+    exact = Algorithms(G, routing = R, label_bucket = 0.0, length_bucket = 0.0)
+    nodes = list(G.nodes())
+    for u, v in [(nodes[0], nodes[-1]), (nodes[25], nodes[310])]:
+        shortest_dist = R.shortest_path(R.index[u], R.index[v])[1]
+        with_landmarks, without = Query(u, v, 0.3, "minimize", shortest_dist), Query(u, v, 0.3, "minimize", shortest_dist)
+        B.constrained(with_landmarks)
+        exact.constrained(without)
+        assert abs(with_landmarks.best[2] - without.best[2]) < 1e-3 and with_landmarks.expanded <= without.expanded
+        for engine in ["dijkstra", "a_star"]:
+            query = Query(u, v, 0.3, "maximize", shortest_dist)
+            getattr(B, engine)(query)
+            assert query.best[0] and query.best[1] <= 1.3 * shortest_dist + 1e-3
+
+    # landmarks of the old graph are dropped on reload
+    B.reload(G)
+    assert B.landmarks is None
 
-    end_loc = locate[0] + ',' + locate[1] + ',' + locate[2] + ',' + locate[len_location-5] + ',' + locate[len_location-3] + ', USA - ' + locate[len_location-2]
+@Test("")
+def test_contraction():
+    print("# Testing ContractionHierarchy in contraction.py(abstraction).....")
+
+    from Elena.abstraction.synthetic import geometric_graph
+    G = geometric_graph(400, 1000.0, 110.0)
+    R = RoutingGraph.from_networkx(G)
+    hierarchy = ContractionHierarchy.build(R)
+    nodes = list(G.nodes())
+    pairs = [(nodes[i], nodes[(7*i + 3) % len(nodes)]) for i in range(0, len(nodes), 5)]
+    worst, broken = check(G, R, hierarchy, pairs)
+    assert worst < 1e-3 and broken == 0
+    assert hierarchy.shortest_path(5, 5) == ([5], 0.0)
+
+    path = os.path.join(tempfile.mkdtemp(), "graph.ch.npz")
+    hierarchy.save(path)
+    loaded = ContractionHierarchy.load(path)
+    assert loaded.matches(R) and loaded.shortest_path(0, len(R) - 1) == hierarchy.shortest_path(0, len(R) - 1)
+
+    # a drop-in for the shortest route of a search
+    A, B = Algorithms(G, routing = R), Algorithms(G, routing = R, contraction = loaded)
+    shortest, _ = A.search(nodes[0], nodes[-1], 0)
+    assert abs(B.search(nodes[0], nodes[-1], 0)[0][1] - shortest[1]) < 1e-3
+
+    # a reloaded graph does not keep the hierarchy (or reverse trees) of the old one
+    H = G.copy()
+    for _, _, data in H.edges(data = True):
+        data["length"] *= 0.5
+    B.reload(H)
+    assert B.contraction is None and B.trees.stats()["size"] == 0
+    assert abs(B.search(nodes[0], nodes[-1], 0)[0][1] - 0.5 * shortest[1]) < 1e-3
 
-    assert isinstance(d, dict)
-    assert start_loc == d["start"]
-    assert end_loc == d["end"]
+@Test("")
+def test_updates():
+    print("# Testing apply_update in algorithms.py(control) and updates.py(abstraction).....")
+
+    from Elena.abstraction.synthetic import grid_graph
+    G = grid_graph(20, 20)
+    R = RoutingGraph.from_networkx(G)
+    A = Algorithms(G, routing = R, landmarks = Landmarks.build(R, 4))
+    u, v = 0, len(R) - 1
+    start, end = (R.lat[u], R.long[u]), (R.lat[v], R.long[v])
+    shortest, _ = A.get_shortest_path(start, end, 20, log = False)
+    route, distance = R.shortest_path(u, v)
+    a, b = R.nodes[route[5]], R.nodes[route[6]]
+
+    # closing an edge of the shortest route reroutes around it and evicts the cached route
+    view = A.pinned()
+    summary = A.apply_update(GraphUpdate(close_edges = [(a, b)]))
+    assert summary["closed_edges"] == 2 and summary["cache_evicted"] == 1
+    assert np.isinf(A.R.length[R.edge_id(route[5], route[6])]) and np.isinf(A.R.length[R.edge_id(route[6], route[5])])
+    assert A.landmarks is not None and A.R.nodes is R.nodes
+    rerouted, _ = A.get_shortest_path(start, end, 20, log = False)
+    pair = [[R.long[route[5]], R.lat[route[5]]], [R.long[route[6]], R.lat[route[6]]]]
+    assert rerouted[1] > shortest[1] and all(rerouted[0][k:k+2] != pair for k in range(len(rerouted[0])))
+    # a request that started before the update finishes on the old graph
+    assert view.R is R and view.search(R.nodes[u], R.nodes[v], 20, log = False)[0][1] == shortest[1]
+
+    # a closed node is not snapped to and no route passes it
+    A.apply_update(GraphUpdate(close_nodes = [R.nodes[route[10]]]))
+    point = (R.lat[route[10]], R.long[route[10]])
+    assert A.get_index().nearest_many([point])[0][0] != R.nodes[route[10]]
+    assert [R.long[route[10]], R.lat[route[10]]] not in A.get_shortest_path(start, end, 0, log = False)[0][0]
+
+    # reopening restores the original graph
+    A.apply_update(GraphUpdate(open_edges = [(a, b)], open_nodes = [R.nodes[route[10]]]))
+    assert np.array_equal(A.R.length, R.length) and not A.state
+    assert abs(A.get_shortest_path(start, end, 0, log = False)[0][1] - distance) < 1e-3
+
+    # an elevation correction only changes the edges at the node, and drops the landmarks
+    w = route[3]
+    summary = A.apply_update(GraphUpdate(elevations = {R.nodes[w] : R.elevation[w] + 100.0}))
+    changed = np.flatnonzero((A.R.gain != R.gain) | (A.R.drop != R.drop))
+    assert len(changed) == 2 * (R.offsets[w+1] - R.offsets[w]) and np.all((R.sources[changed] == w) | (R.targets[changed] == w))
+    assert A.landmarks is None and A.route_best(route)[2] > R.route_stats(route)[1]
+
+    # worker processes rebuild the same graph from the state
+    state = GraphState.from_dict(A.state.to_dict())
+    assert np.array_equal(patch(R, state).gain, A.R.gain)
+    try:
+        A.apply_update(GraphUpdate(close_edges = [(R.nodes[0], R.nodes[len(R) - 1])]))
+        assert False
+    except KeyError:
+        pass
+
+    # in process mode the pool an update replaces is shut down once the requests pinned to it are done
+    from Elena.abstraction import graph_store
+    path = os.path.join(tempfile.mkdtemp(), "graph.bin")
+    graph_store.save(R, path)
+    A = Algorithms(None, routing = graph_store.load(path), search_mode = "process", store_path = path)
+    view = A.pinned()
+    old = view.executor
+    A.apply_update(GraphUpdate(close_edges = [(a, b)]))
+    assert A.executor is None and not old._shutdown_thread
+    del view
+    assert old._shutdown_thread and not A.users
+    A.pinned().executor.shutdown()
+
+@Test("")
+def test_simplify():
+    print("# Testing simplify in simplify.py(abstraction).....")
+
+    from Elena.abstraction.synthetic import geometric_graph, subdivide
+    from Elena.abstraction import graph_store
+    G = subdivide(geometric_graph(300, 1000.0, 110.0))
+    R = RoutingGraph.from_networkx(G)
+    S = simplify(R)
+    assert np.count_nonzero(S.routable()) < len(R) / 3 and len(S.targets) < len(R.targets) / 3
+
+    # the same routes and statistics, with far fewer nodes expanded
+    A = Algorithms(G, routing = R, label_bucket = 0.0, length_bucket = 0.0)
+    B = Algorithms(G, routing = S, label_bucket = 0.0, length_bucket = 0.0)
+    junctions = np.flatnonzero(np.diff(R.offsets) >= 3)
+    u, v = int(R.nodes[junctions[0]]), int(R.nodes[junctions[-1]])
+    for x in [0, 20]:
+        full, simple = A.search(u, v, x, "maximize", log = False), B.search(u, v, x, "maximize", log = False)
+        for a, b in zip(full, simple):
+            assert a[0] == b[0] and np.allclose(a[1:], b[1:], atol = 1e-3)
+    shortest_dist = simple[0][1]
+    q1, q2 = Query(u, v, 0.2, "maximize", shortest_dist), Query(u, v, 0.2, "maximize", shortest_dist)
+    A.constrained(q1)
+    B.constrained(q2)
+    assert q2.expanded * 4 < q1.expanded and abs(q1.best[2] - q2.best[2]) < 1e-3 and q1.best[0] == q2.best[0]
+
+    # profiles run over the chain nodes and queries snap to junctions only
+    route, _ = S.shortest_path(S.index[u], S.index[v])
+    total, gain, drop, profile = S.route_stats(route, profile = True)
+    assert len(profile["elevation"]) == len(S.expand(route)) == len(profile["grade"]) + 1 and abs(profile["distance"][-1] - total) < 1e-2
+    inner = S.expand(route)[1]
+    assert not S.routable()[inner] and B.get_index().nearest((R.lat[inner], R.long[inner])) != R.nodes[inner]
+
+    # the command line tools build over the simplified graph the server routes on
+    import subprocess
+    from Elena.abstraction.build import routing_graph
+    from Elena.abstraction.landmarks import fingerprint
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "graph.p"), "wb") as f:
+        p.dump(G, f)
+    served = fingerprint(routing_graph(G))
+    assert fingerprint(graph_store.convert(os.path.join(directory, "graph.p"), os.path.join(directory, "graph.bin"))) == served
+    for module, name in [("landmarks", "graph.landmarks.npz"), ("contraction", "graph.ch.npz")]:
+        subprocess.run([sys.executable, "-m", "Elena.abstraction." + module, "graph.bin", name, "4"], cwd = directory, check = True, stdout = subprocess.DEVNULL)
+    assert Landmarks.load(os.path.join(directory, "graph.landmarks.npz")).graph == served
+    assert ContractionHierarchy.load(os.path.join(directory, "graph.ch.npz")).graph == served
+
+    path = os.path.join(tempfile.mkdtemp(), "graph.bin")
+    graph_store.save(S, path)
+    assert np.array_equal(graph_store.load(path).via, S.via)
+
+    # closing an edge inside a chain closes its super-edge
+    B.apply_update(GraphUpdate(close_edges = [(R.nodes[inner], R.nodes[S.expand(route)[2]])]))
+    assert B.search(u, v, 0, log = False)[0][1] > shortest_dist
+
+@Test("")
+def test_regions():
+    print("# Testing RegionManager and tile building in regions.py(abstraction).....")
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "extract.osm")
+    with open(path, "w") as f:
+        f.write('<osm><node id="1" lat="42.30" lon="-72.50"/><node id="2" lat="42.30" lon="-72.501"/><node id="3" lat="42.301" lon="-72.501"/>')
+        f.write('<way id="10"><nd ref="1"/><nd ref="2"/><nd ref="3"/><tag k="highway" v="footway"/><tag k="name" v="Main Street"/></way>')
+        f.write('<way id="11"><nd ref="1"/><nd ref="3"/><tag k="highway" v="motorway"/></way></osm>')
+    G = read_osm(path)
+    assert sorted(G.edges()) == [(1, 2), (2, 1), (2, 3), (3, 2)]
+    assert abs(G.edges[1, 2, 0]["length"] - 82.2) < 0.5 and G.edges[1, 2, 0]["name"] == "Main Street"
+
+    # 60 x 60 grid, about 3 km across, cut into tiles of about 1.1 km
+    from Elena.abstraction.synthetic import grid_graph
+    G = grid_graph()
+    R = RoutingGraph.from_networkx(G)
+    index = build_tiles(G, os.path.join(directory, "tiles"), size = 0.01, overlap = 200.0)
+    assert len(index["tiles"]) > 4
+
+    manager = RegionManager(os.path.join(directory, "tiles"), margin = 300.0)
+    u, v = 0, len(R) - 1
+    points = [(R.lat[u], R.long[u]), (R.lat[v], R.long[v])]
+    region = manager.region_for(points)
+    assert len(region.keys) > 4 and region.store_path is None
+    # the stitched tiles route exactly like the whole graph
+    assert abs(region.R.shortest_path(region.R.index[R.nodes[u]], region.R.index[R.nodes[v]])[1] - R.shortest_path(u, v)[1]) < 1e-3
+    assert manager.region_for(points) is region
+
+    # regions over the byte limit are evicted, least recently used first
+    manager = RegionManager(os.path.join(directory, "tiles"), max_bytes = 1, margin = 10.0)
+    near = [(R.lat[u], R.long[u])]
+    first = manager.region_for(near)
+    assert len(first.keys) == 1 and first.store_path is not None
+    manager.region_for([(R.lat[v], R.long[v])])
+    assert manager.stats()["evictions"] == 1 and len(manager.loaded) == 1
+    assert manager.region_for(near) is not first
+    try:
+        manager.region_for([(0.0, 0.0)])
+        assert False
+    except ValueError:
+        pass
+
+    # an evicted region's pool keeps serving the requests that pinned it, and stops after the last one
+    import gc
+    def attach(region):
+        region.algorithms = Algorithms(None, index = region.index, routing = region.R, search_mode = "thread")
+    manager = RegionManager(os.path.join(directory, "tiles"), max_bytes = 1, margin = 10.0, setup = attach)
+    view = manager.region_for(near).algorithms.pinned()
+    manager.region_for([(R.lat[v], R.long[v])])
+    executor = view.executor
+    assert executor.submit(len, "abc").result() == 3
+    del view
+    gc.collect()
+    assert executor._shutdown
+
+    # a region is loaded once by the first query needing it, while queries on loaded regions go on
+    import threading
+    started, release = threading.Event(), threading.Event()
+    def setup(region):
+        if region.keys == slow:
+            started.set()
+            release.wait(10)
+    manager = RegionManager(os.path.join(directory, "tiles"), margin = 10.0, setup = setup)
+    fast, slow = manager.keys_for(near), manager.keys_for([(R.lat[v], R.long[v])])
+    loaded = manager.get(fast)
+    results = []
+    threads = [threading.Thread(target = lambda: results.append(manager.get(slow))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    assert started.wait(10)
+    assert manager.get(fast) is loaded and manager.stats()["loads"] == 1
+    release.set()
+    for thread in threads:
+        thread.join(10)
+    assert len(results) == 3 and all(region is results[0] for region in results)
+    assert manager.stats()["loads"] == 2 and not manager.loading
+
+@Test("")
+def test_build_pipeline():
+    print("# Testing the staged build Pipeline in build.py(abstraction).....")
+
+    from Elena.abstraction.build import Pipeline
+    from Elena.abstraction import graph_store, landmarks, contraction
+    directory = tempfile.mkdtemp()
+    # 12 x 12 blocks of streets about 80 m apart, each drawn with a bend in the middle, on a slope
+    path = os.path.join(directory, "extract.osm")
+    with open(path, "w") as f:
+        f.write('<osm>')
+        for i in range(25):
+            for j in range(25):
+                f.write('<node id="%d" lat="%.6f" lon="%.6f"/>' % (1000 + 25 * i + j, 42.30 + 0.00036 * i, -72.50 + 0.00049 * j))
+        for i in range(25):
+            f.write('<way id="%d">%s<tag k="highway" v="footway"/></way>' % (10 + i, "".join('<nd ref="%d"/>' % (1000 + 25 * i + j) for j in range(25))))
+        for j in range(0, 25, 2):
+            f.write('<way id="%d">%s<tag k="highway" v="path"/></way>' % (100 + j, "".join('<nd ref="%d"/>' % (1000 + 25 * i + j) for i in range(25))))
+        f.write('</osm>')
+    dem = os.path.join(directory, "dem.asc")
+    with open(dem, "w") as f:
+        f.write("ncols 20\nnrows 20\nxllcorner -72.501\nyllcorner 42.299\ncellsize 0.001\nNODATA_value -9999\n")
+        f.write("".join(" ".join(str(100 + 3 * row + (col * 7) % 5) for col in range(20)) + "\n" for row in range(20)))
+    provider = StaticElevation(DEMProvider(dem))
+    work, out, tiles = os.path.join(directory, "build"), os.path.join(directory, "out"), os.path.join(directory, "tiles")
+
+    def pipeline():
+        return Pipeline(work, out, osm = path, tiles = tiles, tile_size = 0.004, overlap = 100.0, landmark_count = 4, workers = 2,
+                        provider = provider, log = False)
+
+    report = pipeline().run()
+    assert [entry["stage"] for entry in report] == ["extract", "elevation", "edges", "indexes", "serialize"]
+    assert not any(entry["skipped"] for entry in report) and all(entry["seconds"] >= 0 and entry["peak_mb"] > 0 for entry in report)
+    assert report[0]["nodes"] == 625 and provider.points == 625
+    assert report[3]["landmarks"] == 4 and report[3]["workers"]["landmarks"]["peak_mb"] > 0 and report[4]["tiles"] > 1
+    R = graph_store.load(os.path.join(out, "graph.bin"))
+    assert R.via is not None and report[3]["routable"] < len(R)
+    assert landmarks.load_for(R, os.path.join(out, landmarks.LANDMARKS_FILE)) is not None
+    hierarchy = contraction.load_for(R, os.path.join(out, contraction.CONTRACTION_FILE))
+    u, v = R.index[1002], R.index[1000 + 25 * 24 + 22] # junctions, the corners are chain nodes
+    assert abs(hierarchy.shortest_path(u, v)[1] - R.shortest_path(u, v)[1]) < 1e-3
+    assert len(RegionManager(tiles).tiles["tiles"]) == report[4]["tiles"]
+
+    # a rerun resumes: nothing is done again, elevations are not fetched again
+    assert all(entry["skipped"] for entry in pipeline().run()) and provider.points == 625
+    # a lost artifact, or a rerun from a stage on, redoes only what is needed
+    os.remove(os.path.join(out, "graph.bin"))
+    assert [entry["skipped"] for entry in pipeline().run()] == [True, True, True, True, False]
+    assert [entry["skipped"] for entry in pipeline().run("indexes")] == [True, True, True, False, False]
+    assert os.path.exists(os.path.join(out, "graph.bin")) and provider.points == 625
+
+    # a rerun without landmarks and hierarchy removes the ones of the earlier build
+    Pipeline(work, out, osm = path, tiles = tiles, tile_size = 0.004, overlap = 100.0, landmark_count = 0, contraction = False,
+             workers = 2, provider = provider, log = False).run()
+    assert not os.path.exists(os.path.join(out, landmarks.LANDMARKS_FILE)) and not os.path.exists(os.path.join(out, contraction.CONTRACTION_FILE))
+
+@Test("")
+def test_elevation_providers():
+    print("# Testing DEMProvider and ElevationCache in elevation.py(abstraction).....")
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "dem.asc")
+    with open(path, "w") as f:
+        f.write("ncols 3\nnrows 2\nxllcorner 0.0\nyllcorner 0.0\ncellsize 1.0\nNODATA_value -9999\n")
+        f.write("10 20 30\n0 10 -9999\n")
+    dem = DEMProvider(path)
+    # cell centers are at long 0.5, 1.5, 2.5 and lat 1.5 (first row), 0.5 (second row)
+    e = dem.elevations([1.5, 1.0, 0.5, 5.0], [0.5, 1.0, 2.5, 0.5])
+    assert e[0] == 10.0 and e[1] == 10.0
+    assert np.isnan(e[2]) and np.isnan(e[3])
+
+    provider = CachedProvider(StaticElevation(dem), ElevationCache(os.path.join(directory, "cache.sqlite")))
+    assert provider.elevations([1.5, 1.0], [0.5, 1.0]).tolist() == [10.0, 10.0]
+    assert provider.elevations([1.5, 1.0, 1.5], [0.5, 1.0, 1.5]).tolist() == [10.0, 10.0, 20.0]
+    assert provider.provider.points == 3
+
+    # lookups of more points than one query can bind parameters for are split up
+    lat, long = np.linspace(0.0, 1.0, 1200), np.zeros(1200)
+    provider.cache.put_many(lat, long, np.arange(1200.0))
+    assert provider.cache.get_many(lat, long).tolist() == list(range(1200))
+
+class StaticElevation:
+    # Counts the points the cache asks the wrapped provider for.
+    def __init__(self, provider):
+        self.provider = provider
+        self.points = 0
+
+    def elevations(self, lat, long):
+        self.points += len(lat)
+        return self.provider.elevations(lat, long)
 
 
 if __name__ == "__main__":
@@ -190,9 +913,27 @@ if __name__ == "__main__":
     test_get_graph(end)
     test_get_route(A)
     test_get_shortest_path()
+    test_search_modes(G)
+    test_constrained(G)
+    test_sweep(G)
+    test_batch(G)
+    test_synthetic_graphs()
     test_get_Elevation(A)
+    test_route_stats(A)
     test_get_cost(A)
     test_get_geojson(start)
     test_get_data(start, end)
+    test_metrics(start, end)
+    test_encoding(start, end)
+    test_route_cache()
+    test_reverse_trees()
+    test_reverse_geocoder(G)
+    test_landmarks()
+    test_contraction()
+    test_updates()
+    test_simplify()
+    test_regions()
+    test_build_pipeline()
+    test_elevation_providers()
 
 